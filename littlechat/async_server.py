@@ -0,0 +1,120 @@
+import time
+import asyncio
+import logging
+
+from littlechat.server import Server
+from littlechat.stuff.msg_boxes import *
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.outbound import PRIORITY_CHAT
+
+logger = logging.getLogger("server")
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server: "AsyncServer"):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        # noinspection PyBroadException
+        try:
+            self.server.on_datagram(data, addr)
+        except Exception as exp:
+            # one bad datagram must not stop the receiving
+            logger.error(f"datagram from {addr} dropped: {exp!r}")
+
+    def error_received(self, exc):
+        logger.error(f"udp error: {exc}")
+
+
+class AsyncServer(Server):
+    """
+        single threaded engine on an asyncio event loop, datagrams are handled
+        and answered inside the loop, no queues and no polling threads,
+        heartbeat expiry is driven by a loop timer over the timing wheel of
+        the `PresenceRegistry`
+    """
+    EXPIRE_TICK = 0.1
+
+    def __init__(self, port=Server.DEFAULT_PORT, batch_io=False):
+        if batch_io:
+            logger.warning("batch io is not supported by the async engine, "
+                           "ignored")
+        super().__init__(port=port, batch_io=False)
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _push_raw(self, payload: bytes, addrs: List[Tuple], started: float,
+                  priority: int = PRIORITY_CHAT, coalesce: Optional[Hashable] = None):
+        # sent inside the loop as they come, nothing queues in the server
+        if self.transport is None:
+            return
+        for addr in addrs:
+            self.transport.sendto(payload, addr)
+        self.m_datagrams_out.inc(len(addrs))
+        self.m_bytes_out.inc(len(payload) * len(addrs))
+        latency = time.perf_counter() - started
+        self.fanout_stats.note_sent(latency)
+        self.m_stage["queue"].observe(latency)
+
+    def on_heartbeat(self, uhb: UserHeartbeat):
+        self.refresh_presence(uhb)
+
+    def _expire_users(self):
+        if self.is_close:
+            return
+        started = time.perf_counter()
+        self.expire_presence()
+        if self.history is not None:
+            self.history.sync_if_due()
+        self.m_stage["alive_check"].observe(time.perf_counter() - started)
+        self.dump_metrics_if_due()
+        self.loop.call_later(self.EXPIRE_TICK, self._expire_users)
+
+    def _reliable_tick(self):
+        if self.is_close:
+            return
+        if self._reliable_of:
+            self.poll_reliable()
+        self.loop.call_later(MsgConfig.RELIABLE_TICK, self._reliable_tick)
+
+    async def _start(self):
+        await self.loop.create_datagram_endpoint(
+            lambda: _ServerProtocol(self), sock=self.udp_socket)
+        self.loop.call_later(self.EXPIRE_TICK, self._expire_users)
+        self.loop.call_later(MsgConfig.RELIABLE_TICK, self._reliable_tick)
+
+    def serve(self):
+        self._update_last_server()
+        self.start_metrics()
+        logger.info(f"-----async server in {self.local_addr}---------")
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._start())
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+            self.loop.close()
+
+    def close(self):
+        if self.is_close:
+            return
+        self.is_close = True
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.udp_socket.close()
+        if self.history is not None:
+            self.history.close()
+        self.stop_metrics()
+        self.export_traces()
+        if self.loop is not None and self.loop.is_running():
+            self.loop.stop()
+        logger.info(f"fanout stats: {self.fanout_stats.snapshot()}")
+        logger.info(f"rate limit stats: addr {self.addr_limiter.stats()}, "
+                    f"user {self.user_limiter.stats()}")
@@ -1,5 +1,6 @@
 import argparse
 from littlechat import __version__
+from littlechat.stuff.config import MsgConfig
 
 from littlechat.server import server
 from littlechat.client import client
@@ -16,6 +17,48 @@ parser.add_argument("-sh", "--server-host",
 parser.add_argument("-sp", "--server-port",
                     help="choose the port of the server, default: 32898",
                     default=0, type=int)
+parser.add_argument("-wc", "--wire-codec",
+                    help="choose the wire codec, binary or pickle (to talk to "
+                         "version 0.0.7 and before), default: binary",
+                    default=MsgConfig.WIRE_CODEC, type=str)
+parser.add_argument("--pickle-compat",
+                    help="also accept the pickle format of version 0.0.7 and "
+                         "before, only while they are rolled out, a pickle "
+                         "can run code of whoever sent it",
+                    action="store_true")
+parser.add_argument("-r", "--reliable",
+                    help="client only, ask the server for acked and ordered "
+                         "delivery with retransmissions of lost datagrams",
+                    action="store_true")
+parser.add_argument("--batch-io",
+                    help="server only, receive and send many datagrams per "
+                         "syscall (recvmmsg/sendmmsg on Linux)",
+                    action="store_true")
+parser.add_argument("-e", "--engine",
+                    help="server only, choose the server engine, thread or "
+                         "async (asyncio), default: thread",
+                    default="thread", type=str)
+parser.add_argument("-w", "--workers",
+                    help="server only, run N worker processes sharing the "
+                         "port with SO_REUSEPORT (Linux), default: 1",
+                    default=1, type=int)
+parser.add_argument("--metrics-port",
+                    help="server only, serve the metrics in the prometheus "
+                         "text format on http://127.0.0.1:PORT/metrics, they "
+                         "are dumped under ~/.littlechat/metrics anyway",
+                    default=MsgConfig.METRICS_PORT, type=int)
+parser.add_argument("--trace-rate",
+                    help="client only, share of the msgs sent traced to the "
+                         "screens of the peers, e.g. 0.01, default: 0",
+                    default=MsgConfig.TRACE_SAMPLE_RATE, type=float)
+parser.add_argument("--msg-list-cap",
+                    help="client only, msgs of the chat page kept in memory, "
+                         "older ones are read back from a temporary file "
+                         "when scrolled to, 0: all, default: 2000",
+                    default=MsgConfig.MSG_LIST_CAP, type=int)
+parser.add_argument("--log-json",
+                    help="write the log file as json lines",
+                    action="store_true")
 
 parser.version = str(__version__)
 parser.add_argument('-v', action='version', help='print the version and exit')
@@ -26,10 +69,18 @@ args = parser.parse_args()
 def main():
     start_type = args.start_type.lower()
     host, port = args.server_host, args.server_port
+    MsgConfig.WIRE_CODEC = args.wire_codec.lower()
+    MsgConfig.PICKLE_COMPAT = MsgConfig.PICKLE_COMPAT or args.pickle_compat
+    MsgConfig.RELIABLE = MsgConfig.RELIABLE or args.reliable
+    MsgConfig.METRICS_PORT = args.metrics_port
+    MsgConfig.LOG_JSON = MsgConfig.LOG_JSON or args.log_json
+    MsgConfig.TRACE_SAMPLE_RATE = args.trace_rate
+    MsgConfig.MSG_LIST_CAP = args.msg_list_cap
     if start_type == "client":
         client(host, port)
     elif start_type == "server":
-        server(port)
+        server(port, batch_io=args.batch_io, engine=args.engine.lower(),
+               workers=args.workers)
     else:
         print(f"invalid type: {start_type}, please assign 'server' or client")
 
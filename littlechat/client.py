@@ -1,7 +1,7 @@
 import json
 import os
+import time
 import logging
-import pickle
 import socket
 import traceback
 
@@ -9,8 +9,17 @@ from queue import Queue, Empty
 
 from littlechat.stuff.msg_boxes import *
 from littlechat.stuff.errors import *
+from littlechat.stuff.chunks import ChunkAssembler, ChunkSplitter
+from littlechat.stuff.rooms import DEFAULT_ROOM
+from littlechat.stuff.compression import (PayloadCompressor, ZlibCompressor,
+                                          available_compressors)
 from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.reliable import ReliableChannel, is_reliable_frame
+from littlechat.stuff.tracing import (Tracer, stamp, STAGE_INPUT,
+                                      STAGE_CLIENT_SEND, STAGE_PEER_RECV,
+                                      STAGE_PEER_SHOW, STAGE_PEER_DRAW)
 from littlechat.front.main_page import MainPage
+from littlechat.front.front_text_layout import LAYOUT_CACHE
 from littlechat.front.front_config import Palette
 from littlechat.utils.util_thread import new_thread
 from littlechat.utils.util_path import get_cache_data_filepath
@@ -45,17 +54,56 @@ class Client(object):
         with open(self._LAST_CLIENT_FILE, "w") as fp:
             json.dump(self._LAST_CLIENT, fp)
 
+    @property
+    def _server_key(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def _cache_last_seq(self):
+        if not self.last_seq:
+            return
+        self._LAST_CLIENT.setdefault("history_seqs", {})[
+            self._server_key] = self.last_seq
+        self._cache_this_client()
+
     def __init__(self, host, port):
         self._load_last_client()
         self.host = host
         self.port = port
         self._check_last_client()
         self.username = None
+        # the room `send_user_msg` sends to, switched by "/join <room>"
+        self.room = DEFAULT_ROOM
 
         # socket.SOCK_DGRAM - udp
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sending_msg_q = Queue()
         self.receiving_msg_q = Queue()
+        self.codec = get_codec()
+        # granted by the server at login, None when it did not negotiate
+        self.heartbeat_interval: Optional[float] = None
+        # `time.monotonic` of the last datagram sent to the server
+        self._last_send_time = 0.0
+        # whether the server relays `MsgChunk`s, decided at login
+        self.chunking = False
+        self._chunk_splitter: Optional[ChunkSplitter] = None
+        self.chunk_assembler = ChunkAssembler()
+        self.compressor = PayloadCompressor()
+        # the algorithm chosen by the server at login, "" for none
+        self.compression = ""
+        # opened when the server grants it at login, dropped when the server
+        # forgets this client
+        self.reliable: Optional[ReliableChannel] = None
+        # newest history seq seen from this server, kept between sessions
+        self.last_seq = self._LAST_CLIENT.get("history_seqs", {}).get(
+            self._server_key, 0)
+        # seq of the first live `UserMsg`, the history stops before it
+        self._live_seq_floor: Optional[int] = None
+        # msgs still to fetch to catch up with the last session
+        self._history_budget = 0
+        # starts the traces of the msgs sent, records the ones received
+        self.tracer = Tracer()
+        # granted at login, see `NewUser.traces`
+        self.traced = False
 
         self.front_main_page: Optional[MainPage] = None
         self.page_loop: Optional[urwid.MainLoop] = None
@@ -65,39 +113,172 @@ class Client(object):
         self.front_main_page = MainPage(
             self.username,
             send_msg_callback=self.send_user_msg,
-            flush_page_callback=self.flush_page_draw)
-        self.page_loop = urwid.MainLoop(self.front_main_page, Palette.PALETTE)
+            flush_page_callback=self.flush_page_draw,
+            resync_presence_callback=self.request_presence_resync)
+        self.page_loop = urwid.MainLoop(self.front_main_page, Palette.PALETTE,
+                                        input_filter=self._filter_input)
         self.page_loop.screen.set_terminal_properties(colors=256)
 
+    @staticmethod
+    def _filter_input(keys, raw):
+        if "window resize" in keys:
+            # the layouts of the old width are not shown any more
+            LAYOUT_CACHE.clear()
+        return keys
+
     def flush_page_draw(self):
         self.page_loop.draw_screen()
 
     def start_page_loop(self):
         self.page_loop.run()
 
-    def send_user_msg(self, msg_text: str):
-        self.send_msg(UserMsg(username=self.username, msg=msg_text))
+    def send_user_msg(self, msg_text: str) -> bool:
+        """False if `msg_text` is a command, the page does not show it"""
+        command, _, room = msg_text.strip().partition(" ")
+        if command == "/join" and room.strip():
+            self.switch_room(room.strip())
+            return False
+        if command == "/leave" and not room:
+            self.switch_room(DEFAULT_ROOM)
+            return False
+        msg = UserMsg(username=self.username, msg=msg_text, room=self.room)
+        if self.traced:
+            msg.trace = self.tracer.start(STAGE_INPUT)
+        self.send_msg(msg)
+        return True
+
+    def switch_room(self, room: str):
+        """leave the current room but the lobby, then join `room`"""
+        if room == self.room:
+            return
+        if self.room != DEFAULT_ROOM:
+            self.send_msg(LeaveRoom(self.username, self.room))
+        self.room = room
+        if self.front_main_page is not None:
+            self.front_main_page.switch_room(room)
+        # answered with the members of `room`, the lobby is joined at login
+        self.send_msg(JoinRoom(self.username, room))
+
+    def request_history(self):
+        """the msgs missed since the last session, or the last few ones"""
+        if self.last_seq:
+            self._history_budget = MsgConfig.HISTORY_CATCH_UP
+            self.send_msg(HistoryRequest(
+                self.username, self.last_seq,
+                min(MsgConfig.HISTORY_PAGE, self._history_budget)))
+            return
+        self.send_msg(HistoryRequest(self.username, 0,
+                                     MsgConfig.HISTORY_ON_LOGIN, latest=True))
+
+    def on_history_batch(self, batch: HistoryBatch):
+        msgs = []
+        for seq, payload in batch.records:
+            if self._live_seq_floor and seq >= self._live_seq_floor:
+                # already shown live
+                continue
+            msg_box: UserMsg = self.codec.decode(payload)
+            msg_box.seq = seq
+            msg_box.is_self = msg_box.username == self.username
+            msgs.append(msg_box)
+        self._history_budget -= len(batch.records)
+        self.last_seq = max(self.last_seq, batch.last_seq)
+        if msgs:
+            self.front_main_page.show_history(msgs)
+            self.flush_page_draw()
+        if (batch.done and batch.last_seq < batch.head_seq
+                and self._history_budget > 0
+                and not (self._live_seq_floor
+                         and batch.last_seq + 1 >= self._live_seq_floor)):
+            self.send_msg(HistoryRequest(
+                self.username, batch.last_seq,
+                min(MsgConfig.HISTORY_PAGE, self._history_budget)))
+
+    def note_live_msg(self, msg_box: MsgBox):
+        seq = getattr(msg_box, "seq", 0)
+        if not seq:
+            return
+        if self._live_seq_floor is None:
+            self._live_seq_floor = seq
+        self.last_seq = max(self.last_seq, seq)
+
+    def request_presence_resync(self):
+        self.send_msg(PresenceResync(username=self.username, room=self.room))
 
     def send_msg(self, msg: MsgBox, direct=False):
         if not msg.msg:
             return
-        msg_byte = pickle.dumps(msg)
+        stamp(msg, STAGE_CLIENT_SEND)
+        raw_byte = self.codec.encode(msg)
+        if len(raw_byte) > MsgConfig.MAX_CHUNKED_LENGTH:
+            # the receivers cap what they inflate, not what they receive
+            raise MsgTooLong(len(raw_byte), MsgConfig.MAX_CHUNKED_LENGTH)
+        msg_byte = self.compressor.pack(raw_byte, self.compression)
+        if self.chunking and len(msg_byte) > MsgConfig.CHUNK_SIZE:
+            if getattr(msg, "trace", None) is not None:
+                # chunks are relayed as is, the peers which did not ask for
+                # traces could not decode the msg
+                msg.trace = None
+                raw_byte = self.codec.encode(msg)
+                msg_byte = self.compressor.pack(raw_byte, self.compression)
+            if self.compression:
+                # chunks are relayed as is to every user, whatever they
+                # negotiated, zlib is what every client since 0.0.8 reads
+                msg_byte = self.compressor.pack(raw_byte, ZlibCompressor.name)
+            chunks = self._chunk_splitter.split(
+                msg_byte, msg.WIRE_TAG,
+                room=getattr(msg, "room", DEFAULT_ROOM))
+            for chunk in chunks:
+                self._send_payload(self.codec.encode(chunk), direct)
+            logger.debug(f"msg length: {len(msg_byte)}, chunked")
+            return
         if len(msg_byte) > MsgConfig.MSG_LENGTH:
             raise MsgTooLong(len(msg_byte))
+        self._send_payload(msg_byte, direct)
+        if not isinstance(msg, UserHeartbeat):
+            logger.debug(f"msg length: {len(msg_byte)}")
+
+    def _send_payload(self, msg_byte: bytes, direct=False):
+        channel = self.reliable
+        if channel is not None:
+            msg_byte = channel.send(msg_byte)
+            if msg_byte is None:
+                # waits for the window, `keep_reliable` sends it
+                return
+        self._send_raw(msg_byte, direct)
+
+    def _send_raw(self, data: bytes, direct=False):
         if direct:
-            self.udp_socket.sendto(msg_byte, (self.host, self.port))
+            self.udp_socket.sendto(data, (self.host, self.port))
+            self._last_send_time = time.monotonic()
             return
-        self.sending_msg_q.put((msg_byte, (self.host, self.port)))
-        if not isinstance(msg, UserHeartbeat):
-            logger.info(f"msg length2: {len(msg_byte)}")
+        self.sending_msg_q.put((data, (self.host, self.port)))
 
     def recv_server_msg(self, timeout=0.5):
         self.udp_socket.settimeout(timeout)
         response, addr = self.udp_socket.recvfrom(MsgConfig.MSG_LENGTH)
-        rsp: MsgBox = pickle.loads(response)
+        rsp: MsgBox = self.codec.decode(self.compressor.unpack(response))
 
         return rsp
 
+    def on_pong(self):
+        """
+            the server forgot this client, its reliable channel too, log in
+            again to negotiate it anew, a lost login is asked again by the
+            pong of the next ping
+        """
+        if self.reliable is not None:
+            logger.warning(f"reliable channel dropped by the server: "
+                           f"{self.reliable.stats()}")
+            self.reliable = None
+        self.send_msg(self.new_user_msg(self.username))
+
+    def on_login_again(self, rsp: NewUser):
+        self.apply_login(rsp)
+        logger.info(f"logged in again, reliable: {self.reliable is not None}")
+        if self.room != DEFAULT_ROOM:
+            # the server puts a new login in the lobby only
+            self.send_msg(JoinRoom(self.username, self.room))
+
     @new_thread
     def receiving_server_msg(self):
 
@@ -108,13 +289,61 @@ class Client(object):
             try:
                 self.udp_socket.settimeout(0.5)
                 response, addr = self.udp_socket.recvfrom(MsgConfig.MSG_LENGTH)
-                recv_msg_box: MsgBox = pickle.loads(response)
-                self.front_main_page.show_msg(recv_msg_box, is_self=False)
-                self.flush_page_draw()
+                if is_ping_payload(response):
+                    self.on_pong()
+                    continue
+                channel = self.reliable
+                if not is_reliable_frame(response):
+                    self.on_server_payload(response)
+                    continue
+                if channel is None:
+                    continue
+                # in order, a lost frame holds back the ones after it
+                for payload in channel.receive(response):
+                    self.on_server_payload(payload)
             except Exception as exp:
                 if self.is_closed:
                     return
 
+    def on_server_payload(self, payload: bytes):
+        recv_msg_box: MsgBox = self.codec.decode(
+            self.compressor.unpack(payload))
+        if isinstance(recv_msg_box, MsgChunk):
+            recv_msg_box = self.reassemble(recv_msg_box)
+            if recv_msg_box is None:
+                return
+        if isinstance(recv_msg_box, HistoryBatch):
+            self.on_history_batch(recv_msg_box)
+            return
+        if isinstance(recv_msg_box, NewUser):
+            self.on_login_again(recv_msg_box)
+            return
+        self.note_live_msg(recv_msg_box)
+        trace = getattr(recv_msg_box, "trace", None)
+        if trace is None:
+            self.front_main_page.show_msg(recv_msg_box, is_self=False)
+            self.flush_page_draw()
+            return
+        trace.stamp(STAGE_PEER_RECV)
+        self.front_main_page.show_msg(recv_msg_box, is_self=False)
+        trace.stamp(STAGE_PEER_SHOW)
+        self.flush_page_draw()
+        trace.stamp(STAGE_PEER_DRAW)
+        self.tracer.record(trace)
+
+    def reassemble(self, chunk: MsgChunk) -> Optional[MsgBox]:
+        payload = self.chunk_assembler.add((chunk.username, chunk.msg_id),
+                                           chunk)
+        if payload is None:
+            return None
+        msg_box = self.codec.decode(self.compressor.unpack(payload))
+        # the server checked the sender of the chunks only
+        if (isinstance(msg_box, MsgChunk)
+                or msg_box.username != chunk.username):
+            logger.warning(f"invalid chunked msg of {chunk.username}")
+            return None
+        return msg_box
+
     @new_thread
     def sending_msg_proxy(self):
         while True:
@@ -122,14 +351,11 @@ class Client(object):
                 break
             # noinspection PyBroadException
             try:
-                logger.info("tset in sending_msg_proxy")
                 msg, addr = self.sending_msg_q.get(timeout=0.5)
-                # logger.info(f"send msg proxy, msg length: {len(msg)}")
                 if not msg:
                     continue
                 self.udp_socket.sendto(msg, addr)
-                # if not isinstance(msg, UserHeartbeat):
-                #     logger.info(f"send msg: {msg.__dict__}")
+                self._last_send_time = time.monotonic()
             except Empty:
                 continue
             except Exception as exp:
@@ -138,6 +364,42 @@ class Client(object):
                 if self.is_closed:
                     break
 
+    def send_heartbeat(self):
+        self.send_msg(UserHeartbeat(username=self.username,
+                                    heartbeat_interval=self.heartbeat_interval
+                                    or 0, room=self.room))
+
+    def send_ping(self):
+        channel = self.reliable
+        if channel is not None:
+            # a bare ack proves the liveness as well
+            self._send_raw(channel.ack_frame())
+            return
+        self._send_raw(PING_PAYLOAD)
+
+    @new_thread
+    def keep_reliable(self):
+        """
+            the retransmissions and acks of the reliable channel, kept
+            running while the channel is gone when it was asked for, the
+            login again after a pong opens a new one
+        """
+        while True:
+            if self.is_closed or (self.reliable is None
+                                  and not MsgConfig.RELIABLE):
+                return
+            # noinspection PyBroadException
+            try:
+                time.sleep(MsgConfig.RELIABLE_TICK)
+                channel = self.reliable
+                if channel is None:
+                    continue
+                for frame in channel.poll():
+                    self._send_raw(frame, direct=True)
+            except Exception:
+                if self.is_closed:
+                    return
+
     @new_thread
     def keep_sending_heartbeat(self):
         while True:
@@ -146,7 +408,13 @@ class Client(object):
             # noinspection PyBroadException
             try:
                 time.sleep(1)
-                self.send_msg(UserHeartbeat(username=self.username))
+                if self.heartbeat_interval is None:
+                    self.send_heartbeat()
+                    continue
+                # any msg sent keeps this client alive, only ping when idle
+                idle = time.monotonic() - self._last_send_time
+                if idle >= self.heartbeat_interval:
+                    self.send_ping()
             except Exception:
                 if self.is_closed:
                     return
@@ -157,14 +425,44 @@ class Client(object):
             username = username.strip()
             if not username:
                 continue
-            self.send_msg(NewUser(username=username), direct=True)
+            self.send_msg(self.new_user_msg(username), direct=True)
             rsp: MsgBox = self.recv_server_msg()
             print(rsp.msg)
             if not isinstance(rsp, ExceptionMsg):
+                self.apply_login(rsp)
                 self.username = username
+                self._chunk_splitter = ChunkSplitter(username)
                 self._init_front_main_page()
                 self._cache_this_client()
                 break
+        if self.chunking:
+            # servers before 0.0.8 keep no history
+            self.request_history()
+
+    def new_user_msg(self, username: str) -> NewUser:
+        """the login, with everything this client asks the server for"""
+        compression = [name for name in MsgConfig.COMPRESSION
+                       if name in available_compressors()]
+        return NewUser(username=username,
+                       heartbeat_interval=MsgConfig.HEARTBEAT_INTERVAL,
+                       compression=compression,
+                       reliable=MsgConfig.RELIABLE,
+                       traces=self.tracer.sample_rate > 0)
+
+    def apply_login(self, rsp: NewUser):
+        """what the server granted in the response of `NewUser`"""
+        # servers before 0.0.8 answer without `expire_seconds`, they
+        # neither negotiate liveness nor relay chunks
+        if getattr(rsp, "expire_seconds", 0):
+            self.heartbeat_interval = rsp.heartbeat_interval
+            self.chunking = True
+        compression = getattr(rsp, "compression", None)
+        self.compression = compression[0] if compression else ""
+        if getattr(rsp, "reliable", False):
+            self.reliable = ReliableChannel()
+        # the msgs of an older server or of one that did not grant the
+        # traces are not traced
+        self.traced = bool(getattr(rsp, "traces", False))
 
     def check_con(self):
         try:
@@ -181,6 +479,7 @@ class Client(object):
             self.login()
             self.receiving_server_msg()
             self.keep_sending_heartbeat()
+            self.keep_reliable()
             self.start_page_loop()
         except ServerNotReachable as exp:
             print(f"server: {self.host}:{self.port} is not reachable !!!, exp: {exp}")
@@ -192,7 +491,14 @@ class Client(object):
     def close(self):
         if not self.is_closed and self.username:
             self.send_msg(UserOffline(username=self.username), direct=True)
+            self._cache_last_seq()
+            self.export_traces()
+            logger.info(f"layout cache stats: {LAYOUT_CACHE.stats()}")
             if self.front_main_page:
+                walker = self.front_main_page.msg_walker
+                logger.info(f"msg list: {len(walker)} msgs, "
+                            f"{walker.spilled} spilled, "
+                            f"{walker.paged_in} pages read back")
                 self.front_main_page.close()
             if self.page_loop:
                 self.page_loop.stop()
@@ -201,6 +507,20 @@ class Client(object):
 
         self.is_closed = True
 
+    def export_traces(self):
+        if not self.tracer.recorded:
+            return
+        logger.info(f"trace stats: {self.tracer.summary()}")
+        if not MsgConfig.TRACE_EXPORT:
+            return
+        path = get_cache_data_filepath("traces",
+                                       f"client-{self.username}.json")
+        try:
+            traces = self.tracer.export_chrome(path)
+            logger.info(f"{traces} traces exported to {path}")
+        except OSError as exp:
+            logger.error(f"traces export to {path} failed: {exp}")
+
     def __del__(self):
         self.close()
 
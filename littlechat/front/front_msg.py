@@ -1,3 +1,5 @@
+from typing import *
+
 import urwid
 from urwid import WHSettings
 
@@ -6,24 +8,71 @@ from littlechat.front.front_config import Palette
 from littlechat.front.front_text import FrontText
 
 
+class FrontMsgWidget(urwid.WidgetWrap):
+    """
+        a msg shown, its text never changes, so the canvas and the rows of
+        the last `CACHED_SIZES` sizes are kept, a redraw of the msg list
+        renders the new msgs only, unlike urwid's `CanvasCache` which lets
+        a canvas go with the screen that showed it
+    """
+    CACHED_SIZES = 2
+    ignore_focus = True
+
+    def __init__(self, w: urwid.Widget):
+        self._canvases: Dict[tuple, urwid.Canvas] = {}
+        self._rows: Dict[tuple, int] = {}
+        super().__init__(w)
+
+    def _keep(self, cache: dict, size: tuple, value):
+        if self.CACHED_SIZES <= 0:
+            return
+        if len(cache) >= self.CACHED_SIZES:
+            # the oldest size, a terminal resized does not come back often
+            del cache[next(iter(cache))]
+        cache[size] = value
+
+    def render(self, size, focus: bool = False) -> urwid.Canvas:
+        canvas = self._canvases.get(size)
+        if canvas is None:
+            canvas = self._w.render(size, focus)
+            self._keep(self._canvases, size, canvas)
+        return canvas
+
+    def rows(self, size, focus: bool = False) -> int:
+        rows = self._rows.get(size)
+        if rows is None:
+            rows = self._w.rows(size, focus)
+            self._keep(self._rows, size, rows)
+        return rows
+
+    def _invalidate(self):
+        self._canvases.clear()
+        self._rows.clear()
+        super()._invalidate()
+
+
 class FrontMsg(object):
 
+    @staticmethod
+    def get_user_widget(username: str) -> urwid.Padding:
+        return urwid.Padding(
+            urwid.AttrMap(
+                FrontText((Palette.USER_LIST, username)),
+                Palette.MSG_PURPLE
+            ), "left", "pack")
+
     @staticmethod
     def get_user_list_widgets(msg_box: UserDict) -> list:
         users = msg_box.user_dict.keys()
         user_list_widgets = []
         for user in users:
-            user_list_widgets.append(
-                urwid.Padding(
-                    urwid.AttrMap(
-                        FrontText((Palette.USER_LIST, user)),
-                        Palette.MSG_PURPLE
-                    ), "left", "pack"))
+            user_list_widgets.append(FrontMsg.get_user_widget(user))
             user_list_widgets.append(urwid.Divider())
         return user_list_widgets
 
     @staticmethod
     def get_msg_widget(msg_box: MsgBox) -> urwid.Columns:
+        """bare, the msg list wraps it in the `FrontMsgWidget` it keeps"""
         if isinstance(msg_box, ServerMsg):
             cols = [
                 ("weight", 0.1, urwid.Divider()),
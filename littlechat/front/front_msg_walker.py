@@ -0,0 +1,250 @@
+"""
+    the msgs of the chat page as records, not widgets:
+
+        (username, text, is_self), username None for the server and time
+        stamp rows
+
+    the last `MsgConfig.MSG_LIST_CAP` records are kept in memory, older ones
+    are moved to a `MessageLog` in a temporary directory and read back a
+    page at a time when scrolled to, the widgets are built when the
+    `ListBox` asks for them and only the ones within
+    `MsgConfig.MSG_LIST_MARGIN` of the focus are kept
+
+    a position is the number of a record since the page opened, -1 the
+    header above the first one
+"""
+import json
+import shutil
+import tempfile
+from typing import *
+from threading import Lock
+from collections import deque, OrderedDict
+
+import urwid
+
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.history import MessageLog, FSYNC_OFF
+from littlechat.stuff.msg_boxes import MsgBox, ServerMsg, UserMsg
+from littlechat.front.front_msg import FrontMsg, FrontMsgWidget
+
+MsgRecord = Tuple[Optional[str], str, bool]
+
+HEADER_POSITION = -1
+
+
+def msg_record(msg_box: MsgBox) -> MsgRecord:
+    if isinstance(msg_box, ServerMsg):
+        return None, f"{msg_box.msg}", False
+    return msg_box.username, f"{msg_box.msg}", bool(msg_box.is_self)
+
+
+def record_msg_box(record: MsgRecord) -> MsgBox:
+    username, text, is_self = record
+    if username is None:
+        return ServerMsg(text)
+    msg_box = UserMsg(username, text)
+    msg_box.is_self = is_self
+    return msg_box
+
+
+class MsgListWalker(urwid.ListWalker):
+    # pages of spilled records kept once read back
+    PAGES_KEPT = 2
+
+    def __init__(self, header: urwid.Widget, cap: Optional[int] = None,
+                 margin: Optional[int] = None,
+                 spill: Optional[bool] = None):
+        self.header = header
+        self.cap = MsgConfig.MSG_LIST_CAP if cap is None else cap
+        self.margin = MsgConfig.MSG_LIST_MARGIN if margin is None else margin
+        self.spill = MsgConfig.MSG_LIST_SPILL if spill is None else spill
+        self.page_size = MsgConfig.MSG_LIST_PAGE
+        self._lock = Lock()
+        self._records: Deque[MsgRecord] = deque()
+        # position of `_records[0]`, the ones before are spilled or dropped
+        self._first = 0
+        self._log: Optional[MessageLog] = None
+        self._log_dir: Optional[str] = None
+        # page number -> the spilled records read back
+        self._pages: Dict[int, Dict[int, MsgRecord]] = OrderedDict()
+        self._widgets: Dict[int, urwid.Widget] = {}
+        self.focus = HEADER_POSITION
+        self.spilled = 0
+        self.paged_in = 0
+
+    @property
+    def first_position(self) -> int:
+        """the oldest record still readable"""
+        if self._log is not None and len(self._log):
+            return self._log.first_seq - 1
+        return self._first
+
+    @property
+    def end_position(self) -> int:
+        """the position of the next record appended"""
+        return self._first + len(self._records)
+
+    @property
+    def last_position(self) -> int:
+        return max(HEADER_POSITION, self.end_position - 1)
+
+    def __len__(self):
+        return self.end_position - self.first_position + 1
+
+    def positions(self, reverse: bool = False) -> Iterable[int]:
+        positions = [HEADER_POSITION, *range(self.first_position,
+                                             self.end_position)]
+        return reversed(positions) if reverse else iter(positions)
+
+    def _spill_locked(self):
+        """move the records beyond the cap to the log, oldest first"""
+        while self.cap and len(self._records) > self.cap:
+            record = self._records.popleft()
+            if self.spill:
+                if self._log is None:
+                    self._log_dir = tempfile.mkdtemp(
+                        prefix="littlechat-msgs-")
+                    self._log = MessageLog(
+                        self._log_dir, fsync=FSYNC_OFF,
+                        segment_bytes=MsgConfig.MSG_LIST_SPILL_BYTES // 4,
+                        retention_bytes=MsgConfig.MSG_LIST_SPILL_BYTES)
+                # the log seqs start at 1, a record at position p is seq p+1
+                self._log.append(json.dumps(
+                    record, ensure_ascii=False).encode())
+                self.spilled += 1
+            self._widgets.pop(self._first, None)
+            self._first += 1
+
+    def append(self, record: MsgRecord) -> int:
+        with self._lock:
+            position = self.end_position
+            self._records.append(record)
+            self._spill_locked()
+        self._modified()
+        return position
+
+    def insert(self, position: int, records: List[MsgRecord]) -> int:
+        """
+            `records` from `position` on, the ones there move down, return
+            the position after them, a position already spilled is taken as
+            the oldest one in memory, the log is append only
+        """
+        if not records:
+            return position
+        with self._lock:
+            index = min(max(position - self._first, 0), len(self._records))
+            self._records.rotate(-index)
+            self._records.extend(records)
+            self._records.rotate(index + len(records))
+            end = self._first + index + len(records)
+            # the positions after the insertion point moved
+            self._widgets = {pos: widget for pos, widget
+                             in self._widgets.items()
+                             if pos < self._first + index}
+            if self.focus >= self._first + index:
+                self.focus += len(records)
+            self._spill_locked()
+        self._modified()
+        return end
+
+    def _paged_record_locked(self, position: int) -> Optional[MsgRecord]:
+        page = position // self.page_size
+        records = self._pages.get(page)
+        if records is None:
+            records = {seq - 1: tuple(json.loads(payload))
+                       for seq, payload in self._log.read_range(
+                           page * self.page_size + 1, self.page_size)}
+            self._pages[page] = records
+            self.paged_in += 1
+            while len(self._pages) > self.PAGES_KEPT:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(page)
+        return records.get(position)
+
+    def _record_locked(self, position: int) -> Optional[MsgRecord]:
+        if position >= self._first:
+            index = position - self._first
+            if index < len(self._records):
+                return self._records[index]
+            return None
+        if self._log is None or position < self.first_position:
+            return None
+        return self._paged_record_locked(position)
+
+    def _prune_widgets_locked(self):
+        if len(self._widgets) <= 2 * self.margin + 2:
+            return
+        low, high = self.focus - self.margin, self.focus + self.margin
+        self._widgets = {pos: widget for pos, widget
+                         in self._widgets.items() if low <= pos <= high}
+
+    def _widget_locked(self, position: int) -> Optional[urwid.Widget]:
+        if position == HEADER_POSITION:
+            return self.header
+        widget = self._widgets.get(position)
+        if widget is None:
+            record = self._record_locked(position)
+            if record is None:
+                return None
+            widget = FrontMsgWidget(urwid.Pile([
+                FrontMsg.get_msg_widget(record_msg_box(record)),
+                urwid.Divider(),
+            ]))
+            self._widgets[position] = widget
+            self._prune_widgets_locked()
+        return widget
+
+    def __getitem__(self, position: int) -> urwid.Widget:
+        with self._lock:
+            widget = self._widget_locked(position)
+        if widget is None:
+            raise IndexError(position)
+        return widget
+
+    def get_focus(self):
+        with self._lock:
+            if HEADER_POSITION < self.focus < self.first_position:
+                # dropped from the log while in focus
+                self.focus = self.first_position
+            return self._widget_locked(self.focus), self.focus
+
+    def set_focus(self, position: int):
+        with self._lock:
+            if (position != HEADER_POSITION
+                    and not self.first_position <= position
+                    < self.end_position):
+                raise IndexError(position)
+            self.focus = position
+            self._prune_widgets_locked()
+        self._modified()
+
+    def get_next(self, position: int):
+        with self._lock:
+            if position == HEADER_POSITION:
+                position = self.first_position
+            else:
+                position += 1
+            widget = self._widget_locked(position)
+        return (widget, position) if widget is not None else (None, None)
+
+    def get_prev(self, position: int):
+        with self._lock:
+            if position == HEADER_POSITION:
+                return None, None
+            position -= 1
+            if position < self.first_position:
+                position = HEADER_POSITION
+            widget = self._widget_locked(position)
+        return (widget, position) if widget is not None else (None, None)
+
+    def close(self):
+        with self._lock:
+            self._widgets.clear()
+            self._pages.clear()
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if self._log_dir is not None:
+                shutil.rmtree(self._log_dir, ignore_errors=True)
+                self._log_dir = None
@@ -204,6 +204,8 @@ class FrontText(urwid.Text):
             trans = self.get_line_translation(adjust_max_col, (text, attr))
 
             if adjusted:
+                # shared with `render` and the layout cache, changed on a copy
+                trans = [list(tran) for tran in trans]
                 for tran in trans:
                     adjust_col = tran[0][0] + 2
                     if adjust_col >= maxcol:
@@ -11,6 +11,11 @@ _byte_encoding = "utf8"
 
 import re
 import typing
+from threading import Lock
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, Optional, Tuple
 
 if typing.TYPE_CHECKING:
     from typing_extensions import Literal
@@ -67,10 +72,8 @@ widths = [
 ]
 
 
-# ACCESSOR FUNCTIONS
-def get_width(o: int):
-    """Return the screen column width for unicode ordinal o."""
-    global widths
+def _scan_width(o: int):
+    """the first entry of `widths` reaching `o`, how `get_width` once was"""
     if o == 0xe or o == 0xf:
         return 0
     for num, wid in widths:
@@ -79,6 +82,158 @@ def get_width(o: int):
     return 1
 
 
+def _width_ranges(table) -> Tuple[List[int], List[int]]:
+    """
+        the bounds, ascending, and the widths of `table` as a first match
+        scan sees it: an entry below the ones before it is never reached,
+        like `(9000, 1)` after `(9996, 2)`
+    """
+    bounds, values = [], []
+    for num, wid in table:
+        if bounds and num <= bounds[-1]:
+            continue
+        bounds.append(num)
+        values.append(wid)
+    return bounds, values
+
+
+_WIDTH_BOUNDS, _WIDTH_VALUES = _width_ranges(widths)
+_WIDTH_VALUES.append(1)  # beyond the table
+
+# a width per code point of the bmp and the emoji plane, built from the
+# ranges, the rest of unicode is searched
+_FLAT_LIMIT = 0x20000
+
+
+def _flat_widths(limit: int) -> bytearray:
+    flat = bytearray(limit)
+    start = 0
+    for num, wid in zip(_WIDTH_BOUNDS, _WIDTH_VALUES):
+        end = min(num + 1, limit)
+        if start < end:
+            flat[start:end] = bytes([wid]) * (end - start)
+        start = end
+    if start < limit:
+        flat[start:limit] = bytes([_WIDTH_VALUES[-1]]) * (limit - start)
+    flat[0xe] = flat[0xf] = 0
+    return flat
+
+
+_FLAT_WIDTHS = _flat_widths(_FLAT_LIMIT)
+
+
+# ACCESSOR FUNCTIONS
+def get_width(o: int):
+    """Return the screen column width for unicode ordinal o."""
+    if o < _FLAT_LIMIT:
+        return _FLAT_WIDTHS[o]
+    return _WIDTH_VALUES[bisect_left(_WIDTH_BOUNDS, o)]
+
+
+# 1 for the bytes starting an utf8 char, 0 for the continuation bytes
+_LEAD_BYTES = bytes(0 if 0x80 <= b <= 0xbf else 1 for b in range(256))
+_FLAT_CHAR_LIMIT = chr(_FLAT_LIMIT)
+# shorter texts are walked char by char, a table costs more than it saves
+_COLUMNS_MIN_LENGTH = 64
+
+
+class TextColumns(object):
+    """
+        the screen columns of a whole text, decoded and mapped to widths
+        once, widths and positions are then searches of the prefix sums
+
+        an offset which is not the start of a char has no answer, the caller
+        walks the text instead
+    """
+    __slots__ = ("text_length", "lead_bytes", "char_at", "columns")
+
+    def __init__(self, text):
+        self.text_length = len(text)
+        if isinstance(text, bytes):
+            chars = text.decode("utf8")
+            self.lead_bytes = text.translate(_LEAD_BYTES)
+            # byte offset -> index of the char starting there
+            self.char_at = list(accumulate(self.lead_bytes, initial=0))
+        else:
+            chars = text
+            self.lead_bytes = self.char_at = None
+        if chars and max(chars) >= _FLAT_CHAR_LIMIT:
+            widths = map(get_width, map(ord, chars))
+        else:
+            widths = map(_FLAT_WIDTHS.__getitem__, map(ord, chars))
+        # char index -> screen column it starts at
+        self.columns = list(accumulate(widths, initial=0))
+
+    def _index(self, offs: int) -> Optional[int]:
+        if self.char_at is None:
+            return offs
+        if offs < self.text_length and not self.lead_bytes[offs]:
+            return None
+        return self.char_at[offs]
+
+    def _offset(self, index: int) -> int:
+        if self.char_at is None or index >= len(self.columns) - 1:
+            return index if self.char_at is None else self.text_length
+        # the byte after the lead byte of the char is the first to count it
+        return bisect_left(self.char_at, index + 1) - 1
+
+    def width(self, start_offs: int, end_offs: int) -> Optional[int]:
+        start, end = self._index(start_offs), self._index(end_offs)
+        if start is None or end is None:
+            return None
+        return self.columns[end] - self.columns[start]
+
+    def text_pos(self, start_offs: int, end_offs: int, pref_col: int
+                 ) -> Optional[Tuple[int, int]]:
+        """like `TextLayoutCommon.calc_text_pos`"""
+        start, end = self._index(start_offs), self._index(end_offs)
+        if start is None or end is None:
+            return None
+        base = self.columns[start]
+        # the last char start within `pref_col`, zero width chars included
+        index = bisect_right(self.columns, base + pref_col, start,
+                             end + 1) - 1
+        return self._offset(index), self.columns[index] - base
+
+
+# the text too long for `_COLUMNS_CACHE` laid out last and its columns, a
+# layout asks for them once per line
+_long_columns: Tuple[object, Optional[TextColumns]] = (None, None)
+
+
+def _new_text_columns(text) -> Optional[TextColumns]:
+    try:
+        return TextColumns(text)
+    except UnicodeDecodeError:
+        # `decode_one` has its own way with invalid utf8
+        return None
+
+
+def _text_columns(text) -> Optional[TextColumns]:
+    global _long_columns
+    if len(text) > _COLUMNS_CACHE.max_bytes // 8:
+        long_text, columns = _long_columns
+        if long_text is not text and long_text != text:
+            columns = _new_text_columns(text)
+            _long_columns = (text, columns)
+        return columns
+    columns = _COLUMNS_CACHE.get((text,))
+    if columns is None:
+        columns = _new_text_columns(text)
+        if columns is not None:
+            _COLUMNS_CACHE.put((text,), columns, len(text))
+    return columns
+
+
+def text_columns(text) -> Optional[TextColumns]:
+    """the cached columns of a long utf8 or unicode text, else None"""
+    if len(text) < _COLUMNS_MIN_LENGTH:
+        return None
+    if isinstance(text, bytes) and _byte_encoding != "utf8":
+        return None
+    return _text_columns(text)
+
+
 def decode_one(text, pos: int):
     """
     Return (ordinal at pos, next position) for UTF-8 encoded text.
@@ -387,6 +542,11 @@ class TextLayoutCommon(StandardTextLayout):
         Returns (position, actual_col).
         """
         assert start_offs <= end_offs, repr((start_offs, end_offs))
+        columns = text_columns(text)
+        if columns is not None:
+            result = columns.text_pos(start_offs, end_offs, pref_col)
+            if result is not None:
+                return result
         utfs = isinstance(text, bytes) and _byte_encoding == "utf8"
         unis = isinstance(text, str)
         if unis or utfs:
@@ -416,6 +576,11 @@ class TextLayoutCommon(StandardTextLayout):
     @classmethod
     def calc_width(cls, text, start_offs: int, end_offs: int):
         assert start_offs <= end_offs, repr((start_offs, end_offs))
+        columns = text_columns(text)
+        if columns is not None:
+            width = columns.width(start_offs, end_offs)
+            if width is not None:
+                return width
 
         utfs = isinstance(text, bytes) and _byte_encoding == "utf8"
         unis = not isinstance(text, bytes)
@@ -521,6 +686,74 @@ class TextLayoutCommon(StandardTextLayout):
         return cls.calc_text_pos(text, s.offs, s.end, s.sc - 1)[0]
 
 
+class LayoutCache(object):
+    """
+        the layouts of the texts shown, shared by every `FrontTextLayout`,
+        `_COLUMNS_CACHE` keeps the `TextColumns` of the long ones alike
+
+        a layout is handed out as is, whoever changes one copies it first,
+        a text changed is another key, a resize of the terminal makes the
+        old widths useless, `clear` them
+
+        bounded by entries and by the `size` given to `put`, the length of
+        the text a layout keeps alive, a text larger than `max_bytes / 8` is
+        not kept, a few chunked msgs would push every other one out
+    """
+
+    def __init__(self, maxsize: int = 4096, max_bytes: int = 8 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        # key -> (layout, size)
+        self._layouts: "OrderedDict[tuple, Tuple[list, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._layouts)
+
+    def get(self, key: tuple) -> Optional[list]:
+        with self._lock:
+            entry = self._layouts.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._layouts.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, layout: list, size: int = 0):
+        if size > self.max_bytes // 8:
+            return
+        with self._lock:
+            old = self._layouts.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._layouts[key] = (layout, size)
+            self.bytes += size
+            while (len(self._layouts) > self.maxsize
+                   or self.bytes > self.max_bytes):
+                _, (_, evicted_size) = self._layouts.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._layouts.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._layouts), "bytes": self.bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+LAYOUT_CACHE = LayoutCache()
+# the columns of the long texts, tens of bytes per char, bounded by the
+# chars of the texts
+_COLUMNS_CACHE = LayoutCache(maxsize=256, max_bytes=256 * 1024)
+
+
 class FrontTextLayout(TextLayoutCommon):
 
     def calculate_text_segments(self, text, width: int, wrap):
@@ -665,10 +898,67 @@ class FrontTextLayout(TextLayoutCommon):
             align,
             wrap,
     ):
-        """Return a layout structure for text."""
+        """
+        Return a layout structure for text, shared through
+        `LAYOUT_CACHE`, copy it before changing it.
+        """
+        key = (type(self), text, width, align, wrap)
+        cached = LAYOUT_CACHE.get(key)
+        if cached is not None:
+            return cached
         try:
             segs = self.calculate_text_segments(text, width, wrap)
             test = self.align_layout(text, width, segs, wrap, align)
-            return test
         except CanNotDisplayText:
-            return [[]]
+            test = [[]]
+        LAYOUT_CACHE.put(key, test, len(text))
+        return test
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    # the same widths as the scan of `widths`, for every code point
+    for o in range(0x110000 + 16):
+        assert get_width(o) == _scan_width(o), hex(o)
+
+    # per char throughput on mixed cjk/emoji/ascii chat text
+    line = "hello 你好世界 👋😀 ok, see you ✌ at 10:30 明天见 🎉"
+    text = line * 200
+    ordinals = [ord(char) for char in text]
+    for name, width_of in (("scan", _scan_width), ("flat+bisect", get_width)):
+        start = time.perf_counter()
+        for _ in range(10):
+            for o in ordinals:
+                width_of(o)
+        cost = (time.perf_counter() - start) / (10 * len(ordinals))
+        print(f"{name:<12} {cost * 1e9:.0f} ns per char, "
+              f"{1 / cost / 1e6:.1f}M chars/s")
+
+    # layout of a long cjk msg as `FrontText` renders it, utf8 bytes
+    message = ("长消息的渲染时间, 包括 emoji 😀 和 ascii text. " * 40).encode()
+    layout = FrontTextLayout()
+    min_length = _COLUMNS_MIN_LENGTH
+    for name, length in (("walk", sys.maxsize), ("columns", min_length)):
+        _COLUMNS_MIN_LENGTH = length
+        _COLUMNS_CACHE.clear()
+        _long_columns = (None, None)
+        # every round computes its layouts, none is read from the last one
+        LAYOUT_CACHE.clear()
+        start = time.perf_counter()
+        for width in range(40, 80):
+            layout.layout(message, width, "left", "space")
+        cost = (time.perf_counter() - start) / 40
+        print(f"layout {len(message)} bytes, {name:<8}: "
+              f"{cost * 1000:.2f} ms per width")
+
+    # `LAYOUT_CACHE`, a miss computes the layout, a hit hands it out
+    LAYOUT_CACHE.clear()
+    for name in ("miss", "hit"):
+        start = time.perf_counter()
+        for width in range(40, 80):
+            layout.layout(message, width, "left", "space")
+        cost = (time.perf_counter() - start) / 40
+        print(f"layout cache {name:<4}: {cost * 1e6:.1f} us per width")
+    print(f"layout cache stats: {LAYOUT_CACHE.stats()}")
@@ -3,17 +3,21 @@ from typing import *
 
 import time
 import logging
+from datetime import datetime
 from queue import Empty, Queue
 from threading import Lock
 
 import urwid
 from urwid import WHSettings
 
-from littlechat.stuff.msg_boxes import MsgBox, UserMsg, UserDict, TimeStamp
+from littlechat.stuff.msg_boxes import (MsgBox, UserMsg, UserDict, TimeStamp,
+                                        PresenceSnapshot, PresenceDelta)
+from littlechat.stuff.rooms import DEFAULT_ROOM
 from littlechat.utils.util_thread import new_thread
 from littlechat.stuff.errors import *
 from littlechat.front.front_config import Palette
 from littlechat.front.front_msg import FrontMsg
+from littlechat.front.front_msg_walker import MsgListWalker, msg_record
 from littlechat.front.front_text_layout import FrontTextLayout
 from littlechat.front.front_edit import FrontEdit
 from littlechat.front.front_button import FrontButton
@@ -32,9 +36,10 @@ class _EditBoxCaption(object):
         self.username = username
         self.attr_name = attr_name
         self._is_locked = is_locked
+        self.room = DEFAULT_ROOM
 
     def update_caption(self):
-        c_username = f" {self.username} | "
+        c_username = f" {self.username} @ {self.room} | "
         c_is_locked = f"| LOCKED " if self._is_locked else ""
         caption = (self.attr_name, f"{c_username}INPUT BOX: {c_is_locked}\n")
         self.edit_box.set_caption(caption)
@@ -50,15 +55,19 @@ class _EditBoxCaption(object):
 
 
 class MainPage(urwid.Columns):
+    # seconds to wait for a requested presence snapshot before asking again
+    PRESENCE_RESYNC_INTERVAL = 1
 
     def __init__(self, username=None,
                  send_msg_callback: Optional[Callable] = None,
-                 flush_page_callback: Optional[Callable] = None):
-        msg_box = [urwid.Text(("title", "Message box\n"))]
+                 flush_page_callback: Optional[Callable] = None,
+                 resync_presence_callback: Optional[Callable] = None):
         user_box = [urwid.Text(("title", "User box\n"))]
         self.is_close = False
         self.username = username
-        self.msg_list = urwid.ListBox(urwid.SimpleFocusListWalker(msg_box))
+        self.msg_walker = MsgListWalker(
+            urwid.Text(("title", "Message box\n")))
+        self.msg_list = urwid.ListBox(self.msg_walker)
         self.u_list = urwid.ListBox(urwid.SimpleFocusListWalker(user_box))
         self.msg_list_line = urwid.LineBox(self.msg_list)
         self.user_list_line = urwid.LineBox(self.u_list)
@@ -97,6 +106,9 @@ class MainPage(urwid.Columns):
                                       focus_part="footer")
 
         self.last_msg_time: Optional[int] = 0
+        # logged msgs go between the header and the live msgs
+        self._history_end = 0
+        self._history_last_time: Optional[datetime] = None
 
         super().__init__([
             ("weight", 1.5, self.user_list_line),
@@ -108,6 +120,13 @@ class MainPage(urwid.Columns):
         self.msg = None
         self.send_msg_callback = send_msg_callback
         self.flush_page_callback = flush_page_callback
+        self.resync_presence_callback = resync_presence_callback
+        # the room msgs are sent to, u_list shows its members
+        self.room = DEFAULT_ROOM
+        # presence version shown in u_list, None until the first snapshot
+        self._presence_version: Optional[int] = None
+        self._presence_resync_time = 0
+        self._user_widgets: Dict[str, urwid.Widget] = {}
         self.lock_sig = Queue()
         self._keep_focus_on_edit_box()
         self._show_msg_lock = Lock()
@@ -232,37 +251,128 @@ class MainPage(urwid.Columns):
                 if lock_focus:
                     self.focus_on_edit_box()
 
-    def send_msg(self, msg):
+    def send_msg(self, msg) -> bool:
+        """False if the callback took `msg` as a command, not shown"""
         # noinspection PyBroadException
         try:
             if self.send_msg_callback is not None:
-                self.send_msg_callback(msg)
+                return self.send_msg_callback(msg) is not False
         except MsgTooLong:
             raise
         except Exception as exp:
             logger.error(f"send msg failed, {traceback.format_exc()}")
-        return msg
+        return True
+
+    def _reset_user_list(self, usernames: Iterable[str]):
+        self._user_widgets = {}
+        widgets = []
+        for username in usernames:
+            user_widget = FrontMsg.get_user_widget(username)
+            self._user_widgets[username] = user_widget
+            widgets.extend([user_widget, urwid.Divider()])
+        self.u_list.body[1:] = widgets
+
+    def switch_room(self, room: str):
+        """show the members of `room`, until its snapshot comes none"""
+        with self._show_msg_lock:
+            self.room = room
+            self._presence_version = None
+            self._reset_user_list([])
+            self._edit_box_caption.room = room
+            self._edit_box_caption.update_caption()
+
+    def _request_presence_resync(self):
+        if time.time() - self._presence_resync_time < \
+                self.PRESENCE_RESYNC_INTERVAL:
+            return
+        self._presence_resync_time = time.time()
+        if self.resync_presence_callback is not None:
+            self.resync_presence_callback()
+
+    def _apply_presence_delta(self, delta: PresenceDelta):
+        if delta.room != self.room:
+            return
+        if (self._presence_version is not None
+                and delta.version <= self._presence_version):
+            # already in the snapshot
+            return
+        if (self._presence_version is None
+                or delta.base_version != self._presence_version):
+            # missed a delta, or the login snapshot, wait for a resync
+            self._request_presence_resync()
+            return
+
+        for username in delta.left:
+            user_widget = self._user_widgets.pop(username, None)
+            if user_widget is None:
+                continue
+            index = self.u_list.body.index(user_widget)
+            # the user widget and its divider
+            del self.u_list.body[index:index + 2]
+        for username in delta.joined:
+            if username in self._user_widgets:
+                continue
+            user_widget = FrontMsg.get_user_widget(username)
+            self._user_widgets[username] = user_widget
+            self.u_list.body.extend([user_widget, urwid.Divider()])
+        self._presence_version = delta.version
 
     def show_msg(self, msg_box: MsgBox, is_self=True):
         with self._show_msg_lock:
+            if isinstance(msg_box, PresenceSnapshot):
+                if msg_box.room != self.room:
+                    return
+                if (self._presence_version is None
+                        or msg_box.version >= self._presence_version):
+                    self._reset_user_list(msg_box.usernames)
+                    self._presence_version = msg_box.version
+                return
+
+            if isinstance(msg_box, PresenceDelta):
+                self._apply_presence_delta(msg_box)
+                return
+
             if isinstance(msg_box, UserDict):
-                self.u_list.body[1:] = FrontMsg.get_user_list_widgets(msg_box)
+                # a server of version 0.0.7 and before
+                self._reset_user_list(msg_box.user_dict.keys())
                 return
 
             msg_box.is_self = is_self
+            room = getattr(msg_box, "room", self.room)
+            if isinstance(msg_box, UserMsg) and room != self.room:
+                # still a member of the lobby while in another room
+                msg_box.msg = f"[{room}] {msg_box.msg}"
             if time.time() - self.last_msg_time > 60:
-                time_widget = FrontMsg.get_msg_widget(
-                    TimeStamp(msg_box.get_msg_time_str()))
-                self.msg_list.body.append(time_widget)
-                self.msg_list.body.append(urwid.Divider())
-
-            msg_widget = FrontMsg.get_msg_widget(msg_box)
+                self.msg_walker.append(msg_record(
+                    TimeStamp(msg_box.get_msg_time_str())))
 
-            self.msg_list.body.append(msg_widget)
-            self.msg_list.body.append(urwid.Divider())
-            self.msg_list.focus_position = len(self.msg_list.body) - 1
+            # through the walker, the list box would build the widget of the
+            # last focus, the focus row is kept, the list follows the msgs
+            self.msg_walker.set_focus(self.msg_walker.append(
+                msg_record(msg_box)))
             self.last_msg_time = time.time()
 
+    def show_history(self, msgs: List[UserMsg]):
+        """
+            insert logged msgs, oldest first, after the ones shown before and
+            before the live ones, as a single change of the list
+        """
+        with self._show_msg_lock:
+            records = []
+            for msg_box in msgs:
+                if msg_box.room != self.room:
+                    msg_box.msg = f"[{msg_box.room}] {msg_box.msg}"
+                if (self._history_last_time is None
+                        or (msg_box.msg_time - self._history_last_time
+                            ).total_seconds() > 60):
+                    records.append(msg_record(
+                        TimeStamp(msg_box.get_msg_time_str())))
+                self._history_last_time = msg_box.msg_time
+                records.append(msg_record(msg_box))
+            self._history_end = self.msg_walker.insert(self._history_end,
+                                                       records)
+            self.msg_walker.set_focus(self.msg_walker.last_position)
+
     def keypress(self, size, key):
         # print(f"\n\nmain_page keypress: {key} cost: {cost} ns")
         this_keypress_time = time.time_ns()
@@ -307,20 +417,24 @@ class MainPage(urwid.Columns):
 
         self._fold_emoji_box()
         try:
-            self.send_msg(msg)
+            shown = self.send_msg(msg)
         except MsgTooLong:
             self.edit_box.insert_text("[Msg is too long]")
             return key
+        if not shown:
+            self.edit_box.edit_text = ""
+            return
 
         username = "Me" if self.username is None else self.username
 
-        self.show_msg(UserMsg(username=username, msg=msg))
+        self.show_msg(UserMsg(username=username, msg=msg, room=self.room))
 
         self.edit_box.edit_text = ""
         self._update_fav_emojis()
 
     def close(self):
         self.is_close = True
+        self.msg_walker.close()
 
     def __del__(self):
         self.close()
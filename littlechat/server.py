@@ -1,35 +1,266 @@
 import os
 import json
 import logging
-import pickle
+import time
 import socket as soc
 from queue import Queue, Empty
+from threading import Lock
+from collections import OrderedDict
 
 from littlechat.stuff.msg_boxes import *
+from littlechat.stuff.chunks import ChunkAssembler
+from littlechat.stuff.compression import PayloadCompressor
+from littlechat.stuff.history import MessageLog
+from littlechat.stuff.outbound import (OutboundQueues, PRIORITY_CONTROL,
+                                       PRIORITY_CHAT, PRIORITY_PRESENCE)
+from littlechat.stuff.presence import PresenceRecord, PresenceRegistry
+from littlechat.stuff.ratelimit import RateLimiter
+from littlechat.stuff.reliable import (ReliableChannel, is_reliable_frame,
+                                       MAX_HEADER_LENGTH)
+from littlechat.stuff.rooms import DEFAULT_ROOM
+from littlechat.stuff.tracing import (Tracer, stamp, STAGE_SERVER_RECV,
+                                      STAGE_SERVER_FANOUT)
 from littlechat.utils.util_thread import new_thread
+from littlechat.utils.util_udp import BatchedUdpIO
+from littlechat.utils.util_log import get_logging_stats
+from littlechat.utils.util_metrics import (MetricsRegistry, MetricsFileDumper,
+                                           MetricsHttpServer, SIZE_BUCKETS)
 from littlechat.stuff.config import MsgConfig
-from littlechat.utils.util_path import get_cache_data_filepath
+from littlechat.utils.util_path import (get_cache_data_dir,
+                                        get_cache_data_filepath)
 
 logger = logging.getLogger("server")
 
 
+class FanoutStats(object):
+    """counters of `Server.broadcast`, latency in seconds"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.messages = 0
+        self.destinations = 0
+        self.serializations = 0
+        self.serializations_saved = 0
+        self.sent_batches = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def note_encoded(self, destinations: int, serializations: int):
+        with self._lock:
+            self.messages += 1
+            self.destinations += destinations
+            self.serializations += serializations
+            self.serializations_saved += destinations - serializations
+
+    def note_sent(self, latency: float):
+        with self._lock:
+            self.sent_batches += 1
+            self.last_latency = latency
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            avg_latency = (self.total_latency / self.sent_batches
+                           if self.sent_batches else 0.0)
+            return {
+                "messages": self.messages,
+                "destinations": self.destinations,
+                "serializations": self.serializations,
+                "serializations_saved": self.serializations_saved,
+                "last_latency": self.last_latency,
+                "avg_latency": avg_latency,
+                "max_latency": self.max_latency,
+            }
+
+
 class Server(object):
     _LAST_SERVER_FILE = get_cache_data_filepath(filename="last_server.json")
     _LAST_SERVER = {}
     DEFAULT_PORT = 12345
+    PRUNE_INTERVAL = 10
+    # verdicts of the user bucket on the chunked msgs last seen
+    CHUNK_VERDICTS = 4096
 
-    def __init__(self, port=DEFAULT_PORT):
+    def __init__(self, port=DEFAULT_PORT, batch_io=False):
         self._load_last_server()
         self.port = port
         self._check_last_server()
         self.local_addr = ("0.0.0.0", self.port)
 
-        self.udp_socket = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
-        self.udp_socket.bind(self.local_addr)
+        self.udp_socket = self._new_socket()
+        # drain/flush many datagrams per wakeup, see `BatchedUdpIO`
+        self.batch_io = batch_io
+        self._udp_io = BatchedUdpIO(self.udp_socket,
+                                    buf_size=MsgConfig.MSG_LENGTH)
         self.client_heartbeat_q = Queue()
-        self.sending_msg_queue = Queue()
+        # per peer, see `littlechat.stuff.outbound`
+        self.outbound = OutboundQueues()
+        self.codec = get_codec()
+        # peers still sending pickle (version <= 0.0.7) are answered in pickle
+        self._legacy_codec = PickleCodec()
+        self._legacy_addrs = set()
+        self.compressor = PayloadCompressor()
+        # addr -> compression algorithm negotiated at login
+        self._compression_of: Dict[Tuple, str] = {}
+        # addr -> reliable channel negotiated at login
+        self._reliable_of: Dict[Tuple, ReliableChannel] = {}
+        # peers which asked for the traces at login, the others get the
+        # traced msgs encoded without them
+        self._traced_addrs = set()
+        self._untraced_codec = self.codec
+        if isinstance(self.codec, BinaryCodec):
+            self._untraced_codec = BinaryCodec(self.codec.pickle_compat,
+                                               traces=False)
+        self.fanout_stats = FanoutStats()
+        self.presence = PresenceRegistry(
+            expire_seconds=NewUser.EXPIRE_SECONDS,
+            on_change=self._on_presence_change,
+            on_room_change=self._on_room_change)
+        # only used from the receiving side, expired lazily on `add`
+        self.chunk_assembler = ChunkAssembler()
+        # the log is always binary, whatever the peers speak, a replayed msg
+        # is not traced again
+        self._history_codec = BinaryCodec(pickle_compat=False, traces=False)
+        self.history = self._new_history()
+        self._last_prune = time.monotonic()
+        self.addr_limiter = RateLimiter(MsgConfig.RATE_LIMIT_ADDR_RATE,
+                                        MsgConfig.RATE_LIMIT_ADDR_BURST)
+        self.user_limiter = RateLimiter(MsgConfig.RATE_LIMIT_USER_RATE,
+                                        MsgConfig.RATE_LIMIT_USER_BURST)
+        # (addr, msg_id) -> whether the chunked msg was let through, its
+        # chunks follow the verdict on the first one seen
+        self._chunk_verdicts: "OrderedDict[Tuple, bool]" = OrderedDict()
+        # the reject of a throttled sender, encoded once
+        throttled = ExceptionMsg(msg="too many datagrams, slow down")
+        self._throttled_payload = self.codec.encode(throttled)
+        self._legacy_throttled_payload = self._legacy_codec.encode(throttled)
+        self.metrics = MetricsRegistry()
+        self._init_metrics()
+        # the traced msgs fanned out, see `littlechat.stuff.tracing`
+        self.tracer = Tracer(registry=self.metrics)
+        self._metrics_dumper: Optional[MetricsFileDumper] = None
+        self._metrics_http: Optional[MetricsHttpServer] = None
         self.is_close = False
 
+    def _init_metrics(self):
+        metrics = self.metrics
+        self.m_datagrams_in = metrics.counter(
+            "datagrams_received_total", "datagrams received")
+        self.m_bytes_in = metrics.counter(
+            "bytes_received_total", "bytes of the datagrams received")
+        self.m_datagrams_out = metrics.counter(
+            "datagrams_sent_total", "datagrams sent")
+        self.m_bytes_out = metrics.counter(
+            "bytes_sent_total", "bytes of the datagrams sent")
+        self.m_send_errors = metrics.counter(
+            "send_errors_total", "datagrams the socket refused")
+        self.m_decode_errors = metrics.counter(
+            "decode_errors_total", "datagrams refused as invalid")
+        metrics.counter("throttled_total", "datagrams over the addr rate",
+                        function=lambda: self.addr_limiter.throttled,
+                        scope="addr")
+        metrics.counter("throttled_total", "chat msgs over the user rate",
+                        function=lambda: self.user_limiter.throttled,
+                        scope="user")
+        self.m_fanout = metrics.histogram(
+            "fanout_destinations", "destinations of a broadcast",
+            buckets=SIZE_BUCKETS)
+        self.m_stage = {stage: metrics.histogram(
+            "stage_seconds", "seconds spent per stage", stage=stage)
+            for stage in ("handle", "queue", "alive_check")}
+        metrics.gauge("outbound_queued", "datagrams queued to send",
+                      function=lambda: len(self.outbound))
+        metrics.counter("outbound_dropped_total",
+                        "datagrams dropped by a full peer queue",
+                        function=lambda: self.outbound.dropped)
+        metrics.counter("outbound_coalesced_total",
+                        "queued datagrams replaced by a newer one",
+                        function=lambda: self.outbound.coalesced)
+        metrics.gauge("heartbeat_queued", "heartbeats waiting",
+                      function=self.client_heartbeat_q.qsize)
+        metrics.gauge("online_users", "users online",
+                      function=lambda: len(self.presence))
+        metrics.gauge("rooms", "rooms with members",
+                      function=lambda: len(self.presence.rooms))
+        metrics.gauge("reliable_channels", "peers with a reliable channel",
+                      function=lambda: len(self._reliable_of))
+        metrics.gauge("history_head_seq", "seq of the newest history record",
+                      function=lambda: (self.history.next_seq - 1
+                                        if self.history else 0))
+        metrics.counter("log_records_dropped_total",
+                        "log records dropped by a lagging log writer",
+                        function=lambda: get_logging_stats(logger)["dropped"])
+
+    def _metrics_name(self) -> str:
+        return str(self.port)
+
+    def start_metrics(self):
+        """the http endpoint and the periodic dump, as configured"""
+        if MsgConfig.METRICS_DUMP_INTERVAL:
+            self._metrics_dumper = MetricsFileDumper(
+                self.metrics,
+                get_cache_data_filepath("metrics",
+                                        f"{self._metrics_name()}.prom"),
+                MsgConfig.METRICS_DUMP_INTERVAL)
+        if MsgConfig.METRICS_PORT:
+            try:
+                self._metrics_http = MetricsHttpServer(
+                    self.metrics, self._metrics_port())
+                self._metrics_http.start()
+            except OSError as exp:
+                logger.error(f"metrics endpoint not started: {exp}")
+
+    def _metrics_port(self) -> int:
+        return MsgConfig.METRICS_PORT
+
+    def dump_metrics_if_due(self):
+        if self._metrics_dumper is not None:
+            self._metrics_dumper.dump_if_due()
+
+    def stop_metrics(self):
+        if self._metrics_http is not None:
+            self._metrics_http.close()
+            self._metrics_http = None
+        if self._metrics_dumper is not None:
+            self._metrics_dumper.dump()
+
+    def export_traces(self):
+        logger.info(f"trace stats: {self.tracer.summary()}")
+        if not MsgConfig.TRACE_EXPORT or not self.tracer.recorded:
+            return
+        path = get_cache_data_filepath("traces",
+                                       f"{self._metrics_name()}.json")
+        try:
+            traces = self.tracer.export_chrome(path)
+            logger.info(f"{traces} traces exported to {path}")
+        except OSError as exp:
+            logger.error(f"traces export to {path} failed: {exp}")
+
+    def _new_socket(self) -> soc.socket:
+        udp_socket = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+        udp_socket.bind(self.local_addr)
+        return udp_socket
+
+    def _new_history(self) -> Optional[MessageLog]:
+        if not MsgConfig.HISTORY:
+            return None
+        return MessageLog(get_cache_data_dir(
+            os.path.join("history", str(self.port))))
+
+    def record_history(self, msg: UserMsg) -> int:
+        """append a fanned out `UserMsg` to the history, return its seq"""
+        if self.history is None:
+            return 0
+        try:
+            return self.history.append(self._history_codec.encode(msg))
+        except OSError as exp:
+            # a full disk must not stop the chat
+            logger.error(f"history append failed: {exp}")
+            return 0
+
     def _load_last_server(self):
         if not os.path.exists(self._LAST_SERVER_FILE):
             return
@@ -47,24 +278,202 @@ class Server(object):
             self._LAST_SERVER["port"] = self.port
             json.dump(self._LAST_SERVER, fp)
 
-    def broadcast_expired_users(self, expired_users):
+    @staticmethod
+    def send_priority(msg: MsgBox) -> int:
+        """control responses, then chat, then presence"""
+        if isinstance(msg, (UserMsg, MsgChunk, HistoryBatch)):
+            return PRIORITY_CHAT
+        if isinstance(msg, (PresenceSnapshot, PresenceDelta, UserDict,
+                            UserComeLeave)):
+            return PRIORITY_PRESENCE
+        return PRIORITY_CONTROL
+
+    def broadcast(self, msg: MsgBox, addrs: Iterable[Tuple],
+                  coalesce: Optional[Hashable] = None):
+        """
+            encode `msg` once (once more if legacy peers are among `addrs`,
+            or peers which did not ask for the `trace` of a traced msg) and
+            queue the shared payload for all `addrs`, a payload with a
+            `coalesce` key replaces the one still queued with the same key
+        """
+        started = time.perf_counter()
+        priority = self.send_priority(msg)
+        addrs = list(addrs)
+        if not addrs:
+            return
+        self.m_fanout.observe(len(addrs))
+        legacy_addrs = []
+        if self._legacy_addrs:
+            legacy_addrs = [a for a in addrs if a in self._legacy_addrs]
+            if legacy_addrs:
+                addrs = [a for a in addrs if a not in self._legacy_addrs]
+
+        peers = len(addrs) + len(legacy_addrs)
+        serializations = 0
+        if addrs and getattr(msg, "trace", None) is not None:
+            traced_addrs = [a for a in addrs if a in self._traced_addrs]
+            if traced_addrs:
+                addrs = [a for a in addrs if a not in self._traced_addrs]
+                self._push_compressed(self.codec.encode(msg), traced_addrs,
+                                      started, priority, coalesce)
+                serializations += 1
+            if addrs:
+                self._push_compressed(self._untraced_codec.encode(msg),
+                                      addrs, started, priority, coalesce)
+                serializations += 1
+        elif addrs:
+            self._push_compressed(self.codec.encode(msg), addrs, started,
+                                  priority, coalesce)
+            serializations += 1
+        if legacy_addrs:
+            self.push_payload(self._legacy_codec.encode(msg), legacy_addrs,
+                              started, priority, coalesce)
+            serializations += 1
+        self.fanout_stats.note_encoded(peers, serializations)
+
+    def _push_compressed(self, payload: bytes, addrs: List[Tuple],
+                         started: float, priority: int = PRIORITY_CHAT,
+                         coalesce: Optional[Hashable] = None):
+        """compress `payload` once per algorithm negotiated among `addrs`"""
+        if not self._compression_of:
+            self.push_payload(payload, addrs, started, priority, coalesce)
+            return
+        by_compression: Dict[str, List[Tuple]] = {}
+        for addr in addrs:
+            by_compression.setdefault(self._compression_of.get(addr, ""),
+                                      []).append(addr)
+        for name, group in by_compression.items():
+            self.push_payload(self.compressor.pack(payload, name), group,
+                              started, priority, coalesce)
+
+    def push_payload(self, payload: bytes, addrs: List[Tuple],
+                     started: float, priority: int = PRIORITY_CHAT,
+                     coalesce: Optional[Hashable] = None):
+        """
+            hand an encoded payload to the sending side, framed apart for
+            every peer of a reliable channel
+        """
+        if self._reliable_of:
+            plain_addrs = []
+            for addr in addrs:
+                channel = self._reliable_of.get(addr)
+                if channel is None:
+                    plain_addrs.append(addr)
+                    continue
+                frame = channel.send(payload)
+                # None: waits for the window, `poll_reliable` sends it, a
+                # frame has its seq, it is never coalesced
+                if frame is not None:
+                    self._push_raw(frame, [addr], started, priority)
+            if not plain_addrs:
+                return
+            addrs = plain_addrs
+        self._push_raw(payload, addrs, started, priority, coalesce)
+
+    def _push_raw(self, payload: bytes, addrs: List[Tuple], started: float,
+                  priority: int = PRIORITY_CHAT,
+                  coalesce: Optional[Hashable] = None):
+        self.outbound.put(payload, addrs, started, priority, coalesce)
+
+    def poll_reliable(self):
+        """send the retransmissions and acks due on every channel"""
+        started = time.perf_counter()
+        for addr, channel in list(self._reliable_of.items()):
+            for frame in channel.poll():
+                self._push_raw(frame, [addr], started, PRIORITY_CONTROL)
+
+    def broadcast_expired_users(self, expired_users: List[PresenceRecord]):
         if not expired_users:
             return
 
-        for user in NewUser.USER_DICT.values():
-            for expired_user in expired_users:
-                self.sending_msg_queue.put(
-                    (UserOfflineServer(expired_user.username),
-                     (user.ip, user.port)
-                     )
-                )
+        addrs = self.presence.rooms.addrs(DEFAULT_ROOM)
+        for expired_user in expired_users:
+            self.broadcast(UserOfflineServer(expired_user.username), addrs)
 
-    def broadcast_online_users(self):
-        user_dict = UserDict(NewUser.USER_DICT)
-        for user in NewUser.USER_DICT.values():
-            self.sending_msg_queue.put(
-                (user_dict, (user.ip, user.port))
-            )
+    def _on_presence_change(self, version: int, joined: List[PresenceRecord],
+                            left: List[PresenceRecord]):
+        """called by the registry under its lock, see `_on_room_change`"""
+        for record in left:
+            self._compression_of.pop(record.addr, None)
+            self._traced_addrs.discard(record.addr)
+            self.outbound.forget(record.addr)
+            channel = self._reliable_of.pop(record.addr, None)
+            if channel is not None:
+                logger.info(f"reliable channel of {record.username} "
+                            f"closed: {channel.stats()}")
+
+    def _on_room_change(self, room: str, base_version: int, version: int,
+                        joined: List[PresenceRecord],
+                        left: List[PresenceRecord]):
+        """
+            called by the registry under its lock, the members of the room
+            get a delta, the joined ones get a full snapshot by
+            `send_presence_snapshot` after their response
+        """
+        members = self.presence.rooms.get_members(room)
+        joined_names = {record.username for record in joined}
+        addrs = []
+        legacy_addrs = []
+        for username, addr in members.items():
+            if username in joined_names:
+                continue
+            if addr in self._legacy_addrs:
+                legacy_addrs.append(addr)
+            else:
+                addrs.append(addr)
+        self.broadcast(PresenceDelta(version,
+                                     [record.username for record in joined],
+                                     [record.username for record in left],
+                                     base_version=base_version, room=room),
+                       addrs)
+        if legacy_addrs:
+            # version 0.0.7 and before only know the full list of the lobby,
+            # a newer one makes the one still queued stale
+            self.broadcast(UserDict(dict.fromkeys(members.keys())),
+                           legacy_addrs, coalesce=("snapshot", room))
+
+    def send_presence_snapshot(self, addr: Tuple, room: str = DEFAULT_ROOM):
+        version, members = self.presence.rooms.versioned_members(room)
+        if addr in self._legacy_addrs:
+            self.broadcast(UserDict(dict.fromkeys(members.keys())), [addr],
+                           coalesce=("snapshot", room))
+            return
+        # the deltas queued behind a newer snapshot are no-ops to the client
+        self.broadcast(PresenceSnapshot(version, members.keys(), room=room),
+                       [addr], coalesce=("snapshot", room))
+
+    def refresh_presence(self, uhb: UserHeartbeat):
+        # a pickled UserHeartbeat of version 0.0.7 lacks the interval
+        _, expire_seconds = NewUser.negotiate_liveness(
+            getattr(uhb, "heartbeat_interval", 0))
+        if self.presence.refresh(uhb.username, uhb.get_addr(),
+                                 expire_seconds=expire_seconds):
+            logger.info(f"user {uhb.username} is back online !!")
+            self.presence.join_room(uhb.username, DEFAULT_ROOM)
+            self.send_presence_snapshot(uhb.get_addr())
+            # a pickled UserHeartbeat lacks the room, its client has none
+            room = getattr(uhb, "room", DEFAULT_ROOM)
+            if room != DEFAULT_ROOM:
+                # the client still sends to its room
+                self.presence.join_room(uhb.username, room)
+                self.send_presence_snapshot(uhb.get_addr(), room)
+
+    def expire_presence(self):
+        expired_users = self.presence.expire()
+        for user in expired_users:
+            logger.info(f"user: {user.username} exit")
+
+        if expired_users:
+            self.broadcast_expired_users(expired_users)
+
+    def prune_outbound(self):
+        """the queues of the peers never logged in, every PRUNE_INTERVAL"""
+        now = time.monotonic()
+        if now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        self.outbound.prune(
+            lambda addr: self.presence.get_by_addr(addr) is not None)
 
     @new_thread
     def client_alive_check(self):
@@ -73,95 +482,409 @@ class Server(object):
                 return
             try:
                 uhb: UserHeartbeat = self.client_heartbeat_q.get(timeout=0.5)
-                NewUser.update_user_heartbeat_time(uhb)
+                self.refresh_presence(uhb)
             except Empty:
                 pass
-            expired_users = NewUser.check_and_clear_expired_users()
-            for user in expired_users:
-                logger.info(f"user: {user.username} exit")
+            started = time.perf_counter()
+            self.expire_presence()
+            self.prune_outbound()
+            if self.history is not None:
+                self.history.sync_if_due()
+            self.m_stage["alive_check"].observe(time.perf_counter() - started)
+            self.dump_metrics_if_due()
 
-            if expired_users:
-                self.broadcast_expired_users(expired_users)
-                self.broadcast_online_users()
+    @new_thread
+    def reliable_timer(self):
+        while not self.is_close:
+            time.sleep(MsgConfig.RELIABLE_TICK)
+            if self._reliable_of:
+                self.poll_reliable()
+
+    def _note_peer_codec(self, recv_data: bytes, addr: Tuple):
+        if is_legacy_payload(recv_data):
+            self._legacy_addrs.add(addr)
+        elif self._legacy_addrs:
+            self._legacy_addrs.discard(addr)
 
     @new_thread
     def sending_msg_proxy(self):
         while True:
             if self.is_close:
                 return
-            try:
-                msg, addr = self.sending_msg_queue.get(timeout=0.5)
-                self.udp_socket.sendto(pickle.dumps(msg), addr)
-            except Empty:
+            # a batch is short, a response queued meanwhile waits for it only
+            items = self.outbound.get_batch(self._udp_io.batch_size,
+                                            timeout=0.5)
+            if not items:
                 continue
+            sent_bytes = 0
+            if self.batch_io:
+                # the failures are logged by `send_batch`
+                self._udp_io.send_batch([(payload, addr)
+                                         for payload, addr, _ in items])
+                sent = len(items)
+                sent_bytes = sum(len(payload) for payload, _, _ in items)
+            else:
+                sent = 0
+                for payload, addr, _ in items:
+                    try:
+                        self.udp_socket.sendto(payload, addr)
+                        sent += 1
+                        sent_bytes += len(payload)
+                    except OSError as exp:
+                        logger.error(f"send to {addr} failed: {exp}")
+            self.m_datagrams_out.inc(sent)
+            self.m_bytes_out.inc(sent_bytes)
+            self.m_send_errors.inc(len(items) - sent)
+            # the oldest datagram of the batch
+            latency = time.perf_counter() - min(started
+                                                for _, _, started in items)
+            self.fanout_stats.note_sent(latency)
+            self.m_stage["queue"].observe(latency)
 
     def serve(self):
         self.client_alive_check()
         self.sending_msg_proxy()
+        self.reliable_timer()
+        self.start_metrics()
         self._update_last_server()
         # self.keep_check_user_dict()
-        logger.info(f"-----server in {self.local_addr}---------")
+        logger.info(f"-----server in {self.local_addr}, "
+                    f"batch_io: {self.batch_io}---------")
         while True:
-            recv_data, addr = self.udp_socket.recvfrom(MsgConfig.MSG_LENGTH)
-            # noinspection PyBroadException
             try:
-                msg_box: UserMsg = pickle.loads(recv_data)
-                msg_box.ip, msg_box.port = addr
-                if not isinstance(msg_box, ClientMsg):
-                    raise
-                if not msg_box.check_valid():
-                    raise
-
-                if isinstance(msg_box, UserHeartbeat):
-                    self.client_heartbeat_q.put(msg_box)
-                    continue
-
-                rsp_msg = msg_box.get_response_msg()
-                broadcast_msg = msg_box.get_broadcast_msg()
-                self._send_responses(addr, msg_box.username, rsp_msg,
-                                     broadcast_msg)
-
+                if self.batch_io:
+                    datagrams = self._udp_io.recv_batch(timeout=0.5)
+                else:
+                    datagrams = [
+                        self.udp_socket.recvfrom(MsgConfig.MSG_LENGTH)]
+                for recv_data, addr in datagrams:
+                    # noinspection PyBroadException
+                    try:
+                        self.on_datagram(recv_data, addr)
+                    except Exception as exp:
+                        # one bad datagram must not stop the receiving
+                        logger.error(f"datagram from {addr} dropped: "
+                                     f"{exp!r}")
             except KeyboardInterrupt:
                 self.close()
                 return
-            except Exception as exp:
-                # not allow msg
-                rsp_msg = ExceptionMsg(msg=f"not allow msg format: {recv_data},"
-                                           f"exp: {exp}")
-                self._send_responses(addr, None, rsp_msg, None)
+
+    def on_datagram(self, recv_data: bytes, addr: Tuple):
+        """a datagram off the socket, a throttled addr costs no decoding"""
+        self.m_datagrams_in.inc()
+        self.m_bytes_in.inc(len(recv_data))
+        if MsgConfig.RATE_LIMIT and not self.addr_limiter.allow(addr):
+            if self.addr_limiter.should_notify(addr):
+                self._push_raw(self._legacy_throttled_payload
+                               if addr in self._legacy_addrs
+                               else self._throttled_payload,
+                               [addr], time.perf_counter(), PRIORITY_CONTROL)
+            return
+        started = time.perf_counter()
+        self.handle_datagram(recv_data, addr)
+        self.m_stage["handle"].observe(time.perf_counter() - started)
+
+    def check_user_rate(self, msg_box: ClientMsg) -> bool:
+        """False if the chat msgs of the user are over its rate"""
+        if not MsgConfig.RATE_LIMIT:
+            return True
+        if isinstance(msg_box, MsgChunk):
+            if msg_box.inner_tag != UserMsg.WIRE_TAG:
+                return True
+            # a chunked msg counts once, whichever chunk comes first, the
+            # others share its verdict
+            key = (msg_box.get_addr(), msg_box.msg_id)
+            verdict = self._chunk_verdicts.get(key)
+            if verdict is not None:
+                return verdict
+        elif not isinstance(msg_box, UserMsg):
+            return True
+        record = self.presence.get_by_addr(msg_box.get_addr())
+        if record is None or record.username != msg_box.username:
+            # refused anyway, must not drain the bucket of that user
+            return True
+        verdict = self.user_limiter.allow(msg_box.username)
+        if isinstance(msg_box, MsgChunk):
+            if len(self._chunk_verdicts) >= self.CHUNK_VERDICTS:
+                self._chunk_verdicts.popitem(last=False)
+            self._chunk_verdicts[key] = verdict
+        if verdict:
+            return True
+        if self.user_limiter.should_notify(msg_box.username):
+            self.broadcast(ExceptionMsg(msg="too many msgs, slow down"),
+                           [msg_box.get_addr()])
+        return False
+
+    def handle_datagram(self, recv_data: bytes, addr: Tuple
+                        ) -> Optional[ClientMsg]:
+        """handle one datagram, return the accepted msg box if any"""
+        if is_ping_payload(recv_data):
+            self.on_ping(addr)
+            return None
+        if is_reliable_frame(recv_data):
+            self.on_reliable_frame(recv_data, addr)
+            return None
+        # noinspection PyBroadException
+        try:
+            recv_data = self.compressor.unpack(recv_data)
+            self._note_peer_codec(recv_data, addr)
+            msg_box: UserMsg = self.codec.decode(recv_data)
+            msg_box.ip, msg_box.port = addr
+            stamp(msg_box, STAGE_SERVER_RECV)
+            if not isinstance(msg_box, ClientMsg):
+                raise
+            if not msg_box.check_valid():
+                raise
+
+            if isinstance(msg_box, UserHeartbeat):
+                self.on_heartbeat(msg_box)
+                return msg_box
+            # any msg of a user proves it is alive
+            self.presence.touch_addr(addr)
+            if not self.check_user_rate(msg_box):
+                return None
+            if isinstance(msg_box, MsgChunk):
+                self.on_chunk(msg_box, recv_data, addr)
+                return msg_box
+            if isinstance(msg_box, HistoryRequest):
+                self.on_history_request(msg_box)
+                return msg_box
+
+            rsp_msg = msg_box.get_response_msg(self.presence)
+            if isinstance(rsp_msg, NewUser):
+                self.negotiate_compression(msg_box, rsp_msg)
+                self.negotiate_reliability(msg_box, rsp_msg)
+                self.negotiate_tracing(msg_box, rsp_msg)
+            broadcast_msg = msg_box.get_broadcast_msg(self.presence)
+            self._send_responses(addr, msg_box.username, rsp_msg,
+                                 broadcast_msg)
+            if isinstance(rsp_msg, NewUser) and rsp_msg.reliable:
+                # the response went out bare, the client opens its side of
+                # the channel on it
+                self._reliable_of[addr] = ReliableChannel()
+            if isinstance(msg_box, NewUser) and msg_box.is_new:
+                self.send_presence_snapshot(addr)
+            return msg_box
+        except KeyboardInterrupt:
+            raise
+        except Exception as exp:
+            self.m_decode_errors.inc()
+            # not allow msg, capped, an answer larger than the datagram
+            # would amplify a flood
+            echo_length = MsgConfig.EXCEPTION_ECHO_LENGTH
+            rsp_msg = ExceptionMsg(
+                msg=f"not allow msg format: {recv_data[:echo_length]},"
+                    f"exp: {str(exp)[:echo_length]}")
+            self._send_responses(addr, None, rsp_msg, None)
+            return None
+
+    def on_heartbeat(self, uhb: UserHeartbeat):
+        self.client_heartbeat_q.put(uhb)
+
+    def negotiate_compression(self, new_user: NewUser, rsp_msg: NewUser):
+        # a pickled NewUser of version 0.0.7 lacks the offer
+        chosen = self.compressor.choose(getattr(new_user, "compression", []))
+        addr = new_user.get_addr()
+        if chosen:
+            self._compression_of[addr] = chosen
+            rsp_msg.compression = [chosen]
+        else:
+            self._compression_of.pop(addr, None)
+
+    def negotiate_reliability(self, new_user: NewUser, rsp_msg: NewUser):
+        # a new login starts the channel over
+        self._reliable_of.pop(new_user.get_addr(), None)
+        # a pickled NewUser of version 0.0.7 lacks the flag
+        rsp_msg.reliable = bool(getattr(new_user, "reliable", False))
+
+    def negotiate_tracing(self, new_user: NewUser, rsp_msg: NewUser):
+        addr = new_user.get_addr()
+        # a pickled NewUser of version 0.0.7 lacks the flag
+        if getattr(new_user, "traces", False):
+            self._traced_addrs.add(addr)
+            rsp_msg.traces = True
+        else:
+            self._traced_addrs.discard(addr)
+
+    def on_reliable_frame(self, frame: bytes, addr: Tuple):
+        """
+            the payloads a frame completes are handled in order, a bare ack
+            proves the liveness of an idle client like a ping
+        """
+        channel = self._reliable_of.get(addr)
+        if channel is None:
+            # the channel went with the user, the client falls back to bare
+            # datagrams on the pong
+            self.on_ping(addr)
+            return
+        try:
+            payloads = channel.receive(frame)
+        except MsgDecodeError as exp:
+            logger.warning(f"invalid reliable frame from {addr}: {exp}")
+            return
+        self.presence.touch_addr(addr)
+        for payload in payloads:
+            if is_reliable_frame(payload) or is_ping_payload(payload):
+                # a frame carries msgs only, a nested one would be handled
+                # as deep as it is nested
+                logger.warning(f"nested frame from {addr}, dropped")
+                continue
+            self.handle_datagram(payload, addr)
+
+    def on_chunk(self, chunk: MsgChunk, recv_data: bytes, addr: Tuple):
+        """
+            the chunks of a `UserMsg` are relayed to the other users as they
+            come, they are only reassembled here for the history, for legacy
+            peers, which can not decode chunks, and for any other chunked msg
+            box
+        """
+        record = self.presence.get_by_addr(addr)
+        if record is None or record.username != chunk.username:
+            logger.warning(f"chunk of {chunk.username} from unknown {addr}, "
+                           f"dropped")
+            return
+
+        legacy_addrs = []
+        if chunk.inner_tag == UserMsg.WIRE_TAG:
+            if chunk.room not in record.rooms:
+                return
+            started = time.perf_counter()
+            addrs = self.presence.rooms.addrs(chunk.room, chunk.username)
+            if self._legacy_addrs:
+                legacy_addrs = [a for a in addrs if a in self._legacy_addrs]
+                addrs = [a for a in addrs if a not in self._legacy_addrs]
+            if addrs:
+                self.push_payload(recv_data, addrs, started)
+                self.fanout_stats.note_encoded(len(addrs), 0)
+            if not legacy_addrs and self.history is None:
+                return
+        elif chunk.inner_tag == MsgChunk.WIRE_TAG:
+            raise MsgDecodeError("nested chunks")
+
+        payload = self.chunk_assembler.add((addr, chunk.msg_id), chunk)
+        if payload is None:
+            return
+        if chunk.inner_tag != UserMsg.WIRE_TAG:
+            self.handle_datagram(payload, addr)
+            return
+        msg_box = self.codec.decode(self.compressor.unpack(payload))
+        if (not isinstance(msg_box, UserMsg)
+                or msg_box.username != chunk.username
+                or getattr(msg_box, "room", DEFAULT_ROOM) != chunk.room):
+            raise MsgDecodeError(f"invalid chunked msg of {chunk.username}")
+        msg_box.ip, msg_box.port = addr
+        self.record_history(msg_box)
+        if legacy_addrs:
+            self.broadcast(msg_box, legacy_addrs)
+
+    def on_history_request(self, request: HistoryRequest):
+        """
+            answer with as many `HistoryBatch` datagrams as the records need,
+            only the msgs of the rooms the user is in now, the records too
+            large for a datagram are skipped
+        """
+        addr = request.get_addr()
+        record = self.presence.get_by_addr(addr)
+        if record is None or record.username != request.username:
+            return
+        head_seq = self.history.next_seq - 1 if self.history else 0
+        limit = min(request.limit, MsgConfig.HISTORY_PAGE)
+        if not self.history or not head_seq:
+            self.broadcast(HistoryBatch([], head_seq, head_seq, True), [addr])
+            return
+        start_seq = request.since_seq + 1
+        if request.latest:
+            start_seq = max(start_seq, head_seq - limit + 1)
+        records = self.history.read_range(start_seq, limit)
+        last_seq = records[-1][0] if records else max(request.since_seq,
+                                                      head_seq)
+
+        # room for the frame of the batch and the varints of a record
+        budget = MsgConfig.MSG_LENGTH - 64
+        if addr in self._reliable_of:
+            budget -= MAX_HEADER_LENGTH
+        batch: List[Tuple[int, bytes]] = []
+        batch_size = 0
+        for seq, payload in records:
+            if len(payload) + 16 > budget:
+                logger.warning(f"history record {seq} too large, skipped")
                 continue
+            msg_box = self._history_codec.decode(payload)
+            if msg_box.room not in record.rooms:
+                continue
+            if batch_size + len(payload) + 16 > budget:
+                self.broadcast(HistoryBatch(batch, last_seq, head_seq, False),
+                               [addr])
+                batch, batch_size = [], 0
+            batch.append((seq, payload))
+            batch_size += len(payload) + 16
+        self.broadcast(HistoryBatch(batch, last_seq, head_seq, True), [addr])
+
+    def on_ping(self, addr: Tuple):
+        """
+            the liveness ping of an idle client, answered only when `addr` is
+            unknown (expired or the server restarted), the client then
+            re-registers with a full heartbeat
+        """
+        if self.presence.touch_addr(addr) is None:
+            self._push_raw(PING_PAYLOAD, [addr], time.perf_counter(),
+                           PRIORITY_CONTROL)
 
     def _send_responses(self, addr: Tuple, from_username: [str, None],
                         rsp_msg: [MsgBox, None],
                         broadcast_msg: [MsgBox, None]):
         if rsp_msg:
-            self.sending_msg_queue.put(
-                (rsp_msg, addr)
-            )
+            self.broadcast(rsp_msg, [addr])
 
         if broadcast_msg:
-            for user, msg in NewUser.USER_DICT.items():
-                if from_username != user:
-                    self.sending_msg_queue.put(
-                        (broadcast_msg, (msg.ip, msg.port))
-                    )
-            if isinstance(broadcast_msg, UserComeLeave):
-                self.broadcast_online_users()
+            if isinstance(broadcast_msg, UserMsg):
+                broadcast_msg.seq = self.record_history(broadcast_msg)
+            # only the members of the room, the announcements of the server
+            # go to the lobby
+            room = getattr(broadcast_msg, "room", DEFAULT_ROOM)
+            trace = getattr(broadcast_msg, "trace", None)
+            if trace is not None:
+                trace.stamp(STAGE_SERVER_FANOUT)
+            self.broadcast(broadcast_msg,
+                           self.presence.rooms.addrs(room, from_username))
+            self.tracer.record(trace)
 
     def close(self):
         self.is_close = True
         self.udp_socket.close()
+        if self.history is not None:
+            self.history.close()
+        self.stop_metrics()
+        self.export_traces()
+        logger.info(f"fanout stats: {self.fanout_stats.snapshot()}")
+        logger.info(f"outbound stats: {self.outbound.stats()}")
+        logger.info(f"rate limit stats: addr {self.addr_limiter.stats()}, "
+                    f"user {self.user_limiter.stats()}")
 
     def __del__(self):
         self.udp_socket.close()
 
 
-def server(port=12345):
+def get_server_class(engine="thread"):
+    if engine == "thread":
+        return Server
+    if engine == "async":
+        from littlechat.async_server import AsyncServer
+        return AsyncServer
+    raise ValueError(f"unknown server engine: {engine}, "
+                     f"choose from ['thread', 'async']")
+
+
+def server(port=12345, batch_io=False, engine="thread", workers=1):
     from littlechat.utils.util_log import set_scripts_logging
 
     set_scripts_logging(__file__, logger=logger, level=logging.DEBUG,
                         console_log=True, file_mode="a")
-    Server(port=port).serve()
+    if workers > 1:
+        from littlechat.workers import serve_workers
+        serve_workers(port, workers, engine=engine, batch_io=batch_io)
+        return
+    get_server_class(engine)(port=port, batch_io=batch_io).serve()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""
+    msg boxes larger than one datagram travel as `MsgChunk`s of at most
+    `MsgConfig.CHUNK_SIZE` bytes, so a lost ip fragment can not take a whole
+    large msg with it and a paste of a stack trace is not `MsgTooLong`
+
+    the server relays the chunks of a `UserMsg` as they come, every receiver
+    reassembles them with a `ChunkAssembler`
+"""
+import time
+import logging
+import itertools
+from typing import *
+from collections import OrderedDict
+
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.rooms import DEFAULT_ROOM
+from littlechat.stuff.msg_boxes import MsgChunk
+
+logger = logging.getLogger("server")
+
+
+def split_payload(payload: bytes, username: str, msg_id: int, inner_tag: int,
+                  chunk_size: Optional[int] = None,
+                  room: str = DEFAULT_ROOM) -> List[MsgChunk]:
+    """split an encoded msg box into the chunks to send"""
+    chunk_size = chunk_size or MsgConfig.CHUNK_SIZE
+    count = max(1, -(-len(payload) // chunk_size))
+    view = memoryview(payload)
+    return [MsgChunk(username, msg_id, index, count, inner_tag,
+                     bytes(view[index * chunk_size:(index + 1) * chunk_size]),
+                     room=room)
+            for index in range(count)]
+
+
+class ChunkSplitter(object):
+    """split the msgs of one sender, with its own msg ids"""
+
+    def __init__(self, username: str, chunk_size: Optional[int] = None):
+        self.username = username
+        self.chunk_size = chunk_size or MsgConfig.CHUNK_SIZE
+        self._msg_ids = itertools.count(1)
+
+    def split(self, payload: bytes, inner_tag: int,
+              room: str = DEFAULT_ROOM) -> List[MsgChunk]:
+        return split_payload(payload, self.username, next(self._msg_ids),
+                             inner_tag, self.chunk_size, room=room)
+
+
+class _PartialMsg(object):
+    __slots__ = ("count", "inner_tag", "chunks", "received", "size",
+                 "started")
+
+    def __init__(self, count: int, inner_tag: int, started: float):
+        self.count = count
+        self.inner_tag = inner_tag
+        self.chunks: List[Optional[bytes]] = [None] * count
+        self.received = 0
+        self.size = 0
+        self.started = started
+
+
+class ChunkAssembler(object):
+    """
+        reassembly buffers of chunked msgs, keyed by whatever identifies a
+        sender and its msg id
+
+        - a msg not complete after `timeout` seconds is dropped
+        - at most `max_bytes` are buffered over all msgs, the oldest msgs are
+          dropped to make room
+        - a msg announcing more than `max_msg_bytes` is refused at once
+    """
+
+    def __init__(self, timeout: Optional[float] = None,
+                 max_bytes: Optional[int] = None,
+                 max_msg_bytes: Optional[int] = None,
+                 chunk_size: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.timeout = timeout or MsgConfig.REASSEMBLY_TIMEOUT
+        self.max_bytes = max_bytes or MsgConfig.REASSEMBLY_MAX_BYTES
+        self.max_msg_bytes = max_msg_bytes or MsgConfig.MAX_CHUNKED_LENGTH
+        self.chunk_size = chunk_size or MsgConfig.CHUNK_SIZE
+        self.clock = clock
+        # insertion order is start order, the oldest msg comes first
+        self._partials: "OrderedDict[Hashable, _PartialMsg]" = OrderedDict()
+        self.buffered_bytes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._partials)
+
+    def _drop(self, key) -> Optional[_PartialMsg]:
+        partial = self._partials.pop(key, None)
+        if partial is not None:
+            self.buffered_bytes -= partial.size
+        return partial
+
+    def expire(self) -> int:
+        """drop the msgs older than `timeout`, return how many"""
+        deadline = self.clock() - self.timeout
+        expired = 0
+        while self._partials:
+            key, partial = next(iter(self._partials.items()))
+            if partial.started > deadline:
+                break
+            self._drop(key)
+            expired += 1
+        self.dropped += expired
+        return expired
+
+    def add(self, key: Hashable, chunk: MsgChunk) -> Optional[bytes]:
+        """buffer `chunk`, return the whole payload once it is complete"""
+        if chunk.count * self.chunk_size > self.max_msg_bytes + self.chunk_size:
+            logger.warning(f"chunked msg {key} refused, {chunk.count} chunks")
+            return None
+        if len(chunk.data) > self.chunk_size:
+            logger.warning(f"chunk of {key} refused, {len(chunk.data)} bytes")
+            return None
+        if chunk.count == 1:
+            return chunk.data
+
+        self.expire()
+        partial = self._partials.get(key)
+        if partial is None:
+            partial = _PartialMsg(chunk.count, chunk.inner_tag, self.clock())
+            self._partials[key] = partial
+        elif (partial.count != chunk.count
+              or partial.inner_tag != chunk.inner_tag):
+            logger.warning(f"inconsistent chunks of {key}, dropped")
+            self._drop(key)
+            self.dropped += 1
+            return None
+        if partial.chunks[chunk.index] is not None:
+            # duplicated datagram
+            return None
+
+        while (self.buffered_bytes + len(chunk.data) > self.max_bytes
+               and self._partials):
+            oldest = next(iter(self._partials))
+            self._drop(oldest)
+            self.dropped += 1
+            if oldest == key:
+                return None
+
+        partial.chunks[chunk.index] = chunk.data
+        partial.received += 1
+        partial.size += len(chunk.data)
+        self.buffered_bytes += len(chunk.data)
+        if partial.received < partial.count:
+            return None
+        self._drop(key)
+        return b"".join(partial.chunks)
+
+
+if __name__ == "__main__":
+    from littlechat.stuff.msg_boxes import UserMsg, get_codec
+
+    codec = get_codec()
+    big = UserMsg("walker", "Traceback (most recent call last):\n" * 3000)
+    payload = codec.encode(big)
+    chunks = ChunkSplitter("walker").split(payload, UserMsg.WIRE_TAG)
+    datagrams = [codec.encode(chunk) for chunk in chunks]
+    print(f"{len(payload)} bytes -> {len(chunks)} chunks, largest datagram "
+          f"{max(len(datagram) for datagram in datagrams)} bytes")
+
+    assembler = ChunkAssembler()
+    start = time.perf_counter()
+    whole = None
+    # out of order and duplicated
+    for datagram in datagrams[::-1] + datagrams[:3]:
+        chunk: MsgChunk = codec.decode(datagram)
+        whole = assembler.add((chunk.username, chunk.msg_id), chunk) or whole
+    cost = time.perf_counter() - start
+    print(f"reassembled: {codec.decode(whole).msg == big.msg}, "
+          f"{cost * 1000:.2f} ms, buffered after: {assembler.buffered_bytes}")
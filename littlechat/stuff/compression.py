@@ -0,0 +1,306 @@
+"""
+    optional compression of the encoded msg boxes, negotiated at login by
+    `NewUser.compression`
+
+    compressed datagram:
+        version(1B) | COMPRESSED_TAG(1B) | algorithm id(1B) | dict id(1B)
+        | compressed encoded msg box
+
+    zlib is always there, zstd only when the `zstandard` package is installed,
+    every receiver unpacks whatever it can, the negotiation only decides what
+    a peer sends
+"""
+import zlib
+import base64
+import hashlib
+import threading
+from typing import *
+from abc import ABC, abstractmethod
+
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.errors import MsgDecodeError
+from littlechat.stuff.msg_boxes import (WIRE_VERSION, UserMsg, UserDict,
+                                        BinaryCodec)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSED_TAG = 0xff
+_FRAME_SIZE = 4
+
+NO_DICT = 0
+CHAT_DICT = 1
+# `CHAT_DICT` with the presence msgs of the rooms
+CHAT_DICT_ROOMS = 2
+
+# raw content dictionaries of typical chat and presence payloads, the most
+# frequent content comes last where zlib finds it first: common words, then
+# the encoded UserDict, PresenceSnapshot, PresenceDelta, UserOnlineServer and
+# UserOfflineServer of 16 users at 2022-01-01, frozen as published, the
+# encodings change with the wire format, the dictionaries must not
+
+# built from the presence msgs before the rooms
+_CHAT_DICT_BYTES = base64.b64decode(
+    "dGhlIHlvdSBhbmQgdGhhdCBoYXZlIGZvciBub3Qgd2l0aCB0aGlzIGJ1dCB3aGF0IGFy"
+    "ZSBqdXN0IG9rIHllcyBubyB0aGFua3MgaGVsbG8gaGkgZ29vZCBtb3JuaW5nIG5pZ2h0"
+    "IHNlZSBsYXRlciBsb2wgaGFoYSBzdXJlIHdoeSBob3cgd2hlbiB3aGVyZSBwbGVhc2Ug"
+    "c29ycnkgdG9kYXkgdG9tb3Jyb3cgVHJhY2ViYWNrIChtb3N0IHJlY2VudCBjYWxsIGxh"
+    "c3QpOgogIEZpbGUgIiIsIGxpbmUgLCBpbiAKRXJyb3I6IEV4Y2VwdGlvbjogTm9uZSBU"
+    "cnVlIEZhbHNlIHNlbGYgcmV0dXJuIGltcG9ydCBkZWYgAQUAAAABfhLvnAAGc2VydmVy"
+    "pAFPbmxpbmUgdXNlcnM6IFsndXNlcjAnLCAndXNlcjEnLCAndXNlcjInLCAndXNlcjMn"
+    "LCAndXNlcjQnLCAndXNlcjUnLCAndXNlcjYnLCAndXNlcjcnLCAndXNlcjgnLCAndXNl"
+    "cjknLCAndXNlcjEwJywgJ3VzZXIxMScsICd1c2VyMTInLCAndXNlcjEzJywgJ3VzZXIx"
+    "NCcsICd1c2VyMTUnXRAFdXNlcjAFdXNlcjEFdXNlcjIFdXNlcjMFdXNlcjQFdXNlcjUF"
+    "dXNlcjYFdXNlcjcFdXNlcjgFdXNlcjkGdXNlcjEwBnVzZXIxMQZ1c2VyMTIGdXNlcjEz"
+    "BnVzZXIxNAZ1c2VyMTUBEAAAAAF+Eu+cAAZzZXJ2ZXIQT25saW5lIHVzZXJzOiAxNgEQ"
+    "BXVzZXIwBXVzZXIxBXVzZXIyBXVzZXIzBXVzZXI0BXVzZXI1BXVzZXI2BXVzZXI3BXVz"
+    "ZXI4BXVzZXI5BnVzZXIxMAZ1c2VyMTEGdXNlcjEyBnVzZXIxMwZ1c2VyMTQGdXNlcjE1"
+    "AREAAAABfhLvnAAGc2VydmVyIGpvaW5lZDogWyd1c2VyJ10sIGxlZnQ6IFsndXNlcidd"
+    "AgEEdXNlcgEEdXNlcgEIAAAAAX4S75wABnNlcnZlchBgdXNlcmAgaXMgb25saW5lAQkA"
+    "AAABfhLvnAAGc2VydmVyEWB1c2VyYCBpcyBvZmZsaW5l")
+
+# the same with the room of the presence msgs
+_CHAT_DICT_ROOMS_BYTES = base64.b64decode(
+    "dGhlIHlvdSBhbmQgdGhhdCBoYXZlIGZvciBub3Qgd2l0aCB0aGlzIGJ1dCB3aGF0IGFy"
+    "ZSBqdXN0IG9rIHllcyBubyB0aGFua3MgaGVsbG8gaGkgZ29vZCBtb3JuaW5nIG5pZ2h0"
+    "IHNlZSBsYXRlciBsb2wgaGFoYSBzdXJlIHdoeSBob3cgd2hlbiB3aGVyZSBwbGVhc2Ug"
+    "c29ycnkgdG9kYXkgdG9tb3Jyb3cgVHJhY2ViYWNrIChtb3N0IHJlY2VudCBjYWxsIGxh"
+    "c3QpOgogIEZpbGUgIiIsIGxpbmUgLCBpbiAKRXJyb3I6IEV4Y2VwdGlvbjogTm9uZSBU"
+    "cnVlIEZhbHNlIHNlbGYgcmV0dXJuIGltcG9ydCBkZWYgAQUAAAABfhLvnAAGc2VydmVy"
+    "pAFPbmxpbmUgdXNlcnM6IFsndXNlcjAnLCAndXNlcjEnLCAndXNlcjInLCAndXNlcjMn"
+    "LCAndXNlcjQnLCAndXNlcjUnLCAndXNlcjYnLCAndXNlcjcnLCAndXNlcjgnLCAndXNl"
+    "cjknLCAndXNlcjEwJywgJ3VzZXIxMScsICd1c2VyMTInLCAndXNlcjEzJywgJ3VzZXIx"
+    "NCcsICd1c2VyMTUnXRAFdXNlcjAFdXNlcjEFdXNlcjIFdXNlcjMFdXNlcjQFdXNlcjUF"
+    "dXNlcjYFdXNlcjcFdXNlcjgFdXNlcjkGdXNlcjEwBnVzZXIxMQZ1c2VyMTIGdXNlcjEz"
+    "BnVzZXIxNAZ1c2VyMTUBEAAAAAF+Eu+cAAZzZXJ2ZXIQT25saW5lIHVzZXJzOiAxNgEQ"
+    "BXVzZXIwBXVzZXIxBXVzZXIyBXVzZXIzBXVzZXI0BXVzZXI1BXVzZXI2BXVzZXI3BXVz"
+    "ZXI4BXVzZXI5BnVzZXIxMAZ1c2VyMTEGdXNlcjEyBnVzZXIxMwZ1c2VyMTQGdXNlcjE1"
+    "BWxvYmJ5AREAAAABfhLvnAAGc2VydmVyIGpvaW5lZDogWyd1c2VyJ10sIGxlZnQ6IFsn"
+    "dXNlciddAgEBBHVzZXIBBHVzZXIFbG9iYnkBCAAAAAF+Eu+cAAZzZXJ2ZXIQYHVzZXJg"
+    "IGlzIG9ubGluZQEJAAAAAX4S75wABnNlcnZlchFgdXNlcmAgaXMgb2ZmbGluZQ==")
+
+# a published dictionary never changes, add a new id for a new one
+_DICTIONARY_SHA1 = {
+    CHAT_DICT: "0e1aec77dacc441493919aaa8c5313a999df3584",
+    CHAT_DICT_ROOMS: "396d9b91177ed77689850cd07c6025cb13dd6180",
+}
+
+_DICTIONARIES: Dict[int, bytes] = {
+    CHAT_DICT: _CHAT_DICT_BYTES,
+    CHAT_DICT_ROOMS: _CHAT_DICT_ROOMS_BYTES,
+}
+for _dict_id, _raw in _DICTIONARIES.items():
+    if hashlib.sha1(_raw).hexdigest() != _DICTIONARY_SHA1[_dict_id]:
+        raise RuntimeError(f"compression dictionary {_dict_id} changed, "
+                           f"publish a new id instead")
+
+
+class Compressor(ABC):
+    name = ""
+    algorithm_id = 0
+
+    @abstractmethod
+    def compress(self, data: bytes, dict_id: int = NO_DICT) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes, dict_id: int = NO_DICT,
+                   max_size: int = 0) -> bytes:
+        pass
+
+
+class ZlibCompressor(Compressor):
+    name = "zlib"
+    algorithm_id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data: bytes, dict_id: int = NO_DICT) -> bytes:
+        if dict_id == NO_DICT:
+            return zlib.compress(data, self.level)
+        compressor = zlib.compressobj(self.level, zdict=_DICTIONARIES[dict_id])
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes, dict_id: int = NO_DICT,
+                   max_size: int = 0) -> bytes:
+        if dict_id == NO_DICT:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=_DICTIONARIES[dict_id])
+        try:
+            result = decompressor.decompress(data, max_size)
+        except zlib.error as exp:
+            raise MsgDecodeError(f"invalid zlib payload: {exp}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise MsgDecodeError("truncated or too large zlib payload")
+        return result
+
+
+class ZstdCompressor(Compressor):
+    name = "zstd"
+    algorithm_id = 2
+
+    def __init__(self, level=3):
+        self.level = level
+        self._dicts = {
+            dict_id: zstandard.ZstdCompressionDict(
+                raw, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            for dict_id, raw in _DICTIONARIES.items()}
+        # contexts are reused, building them costs more than a small msg,
+        # one per thread, a zstd context must not be used concurrently
+        self._local = threading.local()
+
+    def _contexts(self) -> threading.local:
+        local = self._local
+        if not hasattr(local, "compressors"):
+            local.compressors = {}
+            local.decompressors = {}
+        return local
+
+    def _compressor(self, dict_id: int) -> "zstandard.ZstdCompressor":
+        compressors = self._contexts().compressors
+        compressor = compressors.get(dict_id)
+        if compressor is None:
+            if dict_id == NO_DICT:
+                compressor = zstandard.ZstdCompressor(level=self.level)
+            else:
+                compressor = zstandard.ZstdCompressor(
+                    level=self.level, dict_data=self._dicts[dict_id])
+            compressors[dict_id] = compressor
+        return compressor
+
+    def _decompressor(self, dict_id: int) -> "zstandard.ZstdDecompressor":
+        decompressors = self._contexts().decompressors
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id == NO_DICT:
+                decompressor = zstandard.ZstdDecompressor()
+            else:
+                decompressor = zstandard.ZstdDecompressor(
+                    dict_data=self._dicts[dict_id])
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def compress(self, data: bytes, dict_id: int = NO_DICT) -> bytes:
+        return self._compressor(dict_id).compress(data)
+
+    def decompress(self, data: bytes, dict_id: int = NO_DICT,
+                   max_size: int = 0) -> bytes:
+        try:
+            # `max_output_size` only applies to frames without a content size
+            if max_size and zstandard.frame_content_size(data) > max_size:
+                raise MsgDecodeError("too large zstd payload")
+            return self._decompressor(dict_id).decompress(
+                data, max_output_size=max_size)
+        except zstandard.ZstdError as exp:
+            raise MsgDecodeError(f"invalid zstd payload: {exp}")
+
+
+def available_compressors() -> List[str]:
+    """names in order of preference"""
+    names = []
+    if zstandard is not None:
+        names.append(ZstdCompressor.name)
+    names.append(ZlibCompressor.name)
+    return names
+
+
+def is_compressed_payload(data: bytes) -> bool:
+    return (len(data) >= _FRAME_SIZE and data[0] == WIRE_VERSION
+            and data[1] == COMPRESSED_TAG)
+
+
+class PayloadCompressor(object):
+    """
+        the compressors of one side, `pack` an encoded msg box for a peer that
+        negotiated `name`, `unpack` any compressed datagram received
+    """
+
+    def __init__(self, threshold: Optional[int] = None,
+                 dict_id: int = CHAT_DICT,
+                 max_size: Optional[int] = None):
+        # smaller payloads are sent as is, the frame and the compressor
+        # setup would cost more than the saved bytes
+        self.threshold = (MsgConfig.COMPRESSION_THRESHOLD
+                          if threshold is None else threshold)
+        self.dict_id = dict_id
+        self.max_size = max_size or MsgConfig.MAX_CHUNKED_LENGTH
+        self._by_name: Dict[str, Compressor] = {}
+        self._by_id: Dict[int, Compressor] = {}
+        for compressor in self._new_compressors():
+            self._by_name[compressor.name] = compressor
+            self._by_id[compressor.algorithm_id] = compressor
+
+    @staticmethod
+    def _new_compressors() -> List[Compressor]:
+        compressors = [ZlibCompressor()]
+        if zstandard is not None:
+            compressors.append(ZstdCompressor())
+        return compressors
+
+    def choose(self, offered: Iterable[str]) -> str:
+        """the first of `offered` available here, "" for none"""
+        for name in offered:
+            if name in self._by_name:
+                return name
+        return ""
+
+    def pack(self, payload: bytes, name: str) -> bytes:
+        compressor = self._by_name.get(name)
+        if compressor is None or len(payload) < self.threshold:
+            return payload
+        compressed = compressor.compress(payload, self.dict_id)
+        if len(compressed) + _FRAME_SIZE >= len(payload):
+            return payload
+        return bytes([WIRE_VERSION, COMPRESSED_TAG, compressor.algorithm_id,
+                      self.dict_id]) + compressed
+
+    def unpack(self, data: bytes) -> bytes:
+        if not is_compressed_payload(data):
+            return data
+        compressor = self._by_id.get(data[2])
+        if compressor is None:
+            raise MsgDecodeError(f"unsupported compression: {data[2]}")
+        dict_id = data[3]
+        if dict_id != NO_DICT and dict_id not in _DICTIONARIES:
+            raise MsgDecodeError(f"unknown compression dictionary: {dict_id}")
+        return compressor.decompress(data[_FRAME_SIZE:], dict_id,
+                                     self.max_size)
+
+
+if __name__ == "__main__":
+    # compression ratio and cpu cost per msg size
+    import timeit
+
+    codec = BinaryCodec()
+    chat = ("hey, did you see the build failed again? I think the test of "
+            "the heartbeat is flaky, let me check the log later ")
+    samples = []
+    for size in (64, 256, 1024, 4096, 16384):
+        text = (chat * (size // len(chat) + 1))[:size]
+        samples.append((f"UserMsg {size}", codec.encode(UserMsg("walker",
+                                                                text))))
+    for users in (10, 100, 1000):
+        samples.append((f"UserDict {users}", codec.encode(
+            UserDict(dict.fromkeys(f"walker{i}" for i in range(users))))))
+
+    print(f"available: {available_compressors()}")
+    print(f"{'payload':<16}{'algo':<6}{'dict':<6}{'bytes':>8}{'packed':>8}"
+          f"{'ratio':>7}{'pack us':>9}{'unpack us':>11}")
+    for dict_id in (NO_DICT, CHAT_DICT, CHAT_DICT_ROOMS):
+        packer = PayloadCompressor(threshold=0, dict_id=dict_id)
+        for label, payload in samples:
+            for name in available_compressors():
+                packed = packer.pack(payload, name)
+                number = 500
+                pack_cost = timeit.timeit(lambda: packer.pack(payload, name),
+                                          number=number) / number
+                unpack_cost = timeit.timeit(lambda: packer.unpack(packed),
+                                            number=number) / number
+                assert packer.unpack(packed) == payload
+                print(f"{label:<16}{name:<6}{dict_id:<6}{len(payload):>8}"
+                      f"{len(packed):>8}{len(payload) / len(packed):>7.2f}"
+                      f"{pack_cost * 1e6:>9.1f}{unpack_cost * 1e6:>11.1f}")
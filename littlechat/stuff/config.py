@@ -1,2 +1,100 @@
 class MsgConfig(object):
     MSG_LENGTH = 65535
+    # larger msgs are sent as `MsgChunk`s of this many bytes, small enough for
+    # a 1500 bytes ethernet MTU with the ip/udp and chunk headers
+    CHUNK_SIZE = 1200
+    MAX_CHUNKED_LENGTH = 1024 * 1024
+    # partially received chunked msgs, per receiver
+    REASSEMBLY_TIMEOUT = 10
+    REASSEMBLY_MAX_BYTES = 8 * 1024 * 1024
+    MAX_USERNAME_LENGTH = 32
+    MAX_ROOM_NAME_LENGTH = 32
+    # rooms a user is in at once, the lobby included
+    MAX_ROOMS_PER_USER = 8
+    # wire codec used to send msg boxes: "binary" or "pickle"
+    WIRE_CODEC = "binary"
+    # accept pickled msg boxes from clients/servers before 0.0.8, only for a
+    # mixed version rollout, unpickling a datagram runs what its sender wants
+    PICKLE_COMPAT = False
+    # heartbeat interval asked at login, an idle client only sends a small
+    # ping every interval, servers before 0.0.8 still get a heartbeat per
+    # second
+    HEARTBEAT_INTERVAL = 5
+    # compression algorithms offered at login in order of preference, see
+    # `littlechat.stuff.compression`, empty to send everything uncompressed
+    COMPRESSION = ["zstd", "zlib"]
+    COMPRESSION_THRESHOLD = 256
+    # the server logs every `UserMsg` under ~/.littlechat/history, see
+    # `littlechat.stuff.history`, fsync policy: "always", "batch" or "off"
+    HISTORY = True
+    HISTORY_FSYNC = "batch"
+    HISTORY_FSYNC_INTERVAL = 1
+    HISTORY_SEGMENT_BYTES = 16 * 1024 * 1024
+    HISTORY_RETENTION_BYTES = 256 * 1024 * 1024
+    # most records answered to one `HistoryRequest`, a client asks for the
+    # last HISTORY_ON_LOGIN msgs at login, or for up to HISTORY_CATCH_UP
+    # msgs it missed since its last session on the same server
+    HISTORY_PAGE = 1000
+    HISTORY_ON_LOGIN = 50
+    HISTORY_CATCH_UP = 10000
+    # datagrams the server queues per peer, the oldest of the lowest
+    # priority are dropped beyond, see `littlechat.stuff.outbound`, also the
+    # frames a reliable channel holds while its window is full
+    OUTBOUND_QUEUE_DEPTH = 1024
+    # token buckets of the server, per source addr on every datagram before
+    # it is decoded, the burst lets the chunks of a 1MB paste through, and
+    # per user on its chat msgs, see `littlechat.stuff.ratelimit`
+    RATE_LIMIT = True
+    RATE_LIMIT_ADDR_RATE = 500
+    RATE_LIMIT_ADDR_BURST = 1000
+    RATE_LIMIT_USER_RATE = 5
+    RATE_LIMIT_USER_BURST = 20
+    # most bytes of an invalid datagram echoed in the `ExceptionMsg`
+    EXCEPTION_ECHO_LENGTH = 64
+    # server metrics, see `littlechat.utils.util_metrics`, dumped every
+    # METRICS_DUMP_INTERVAL seconds under ~/.littlechat/metrics (0: never),
+    # served on http://127.0.0.1:METRICS_PORT/metrics (0: not served)
+    METRICS_DUMP_INTERVAL = 15
+    METRICS_PORT = 0
+    # log records are written by a listener thread, see
+    # `littlechat.utils.util_log`, beyond LOG_QUEUE_SIZE waiting ones they
+    # are dropped rather than block the sender
+    LOG_ASYNC = True
+    LOG_QUEUE_SIZE = 10000
+    LOG_JSON = False
+    # the log file is rotated beyond LOG_MAX_BYTES, LOG_BACKUP_COUNT kept
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_BACKUP_COUNT = 3
+    # the records at or below LOG_SAMPLE_LEVEL, the ones written per msg,
+    # are logged once every LOG_SAMPLE_EVERY per call site
+    LOG_SAMPLE_EVERY = 100
+    LOG_SAMPLE_LEVEL = "DEBUG"
+    # share of the chat msgs traced from the Enter of the sender to the
+    # screens of the peers, see `littlechat.stuff.tracing`, the last
+    # TRACE_KEEP traces are exported under ~/.littlechat/traces at exit
+    TRACE_SAMPLE_RATE = 0.0
+    TRACE_KEEP = 1000
+    TRACE_EXPORT = True
+    # msgs of the chat page kept in memory (0: all), older ones are moved to
+    # a temporary file of up to MSG_LIST_SPILL_BYTES and read back
+    # MSG_LIST_PAGE at a time when scrolled to, widgets are only built for
+    # the msgs within MSG_LIST_MARGIN of the focus, see
+    # `littlechat.front.front_msg_walker`
+    MSG_LIST_CAP = 2000
+    MSG_LIST_SPILL = True
+    MSG_LIST_SPILL_BYTES = 64 * 1024 * 1024
+    MSG_LIST_PAGE = 200
+    MSG_LIST_MARGIN = 100
+    # ask the server at login for the acked, retransmitted and ordered
+    # delivery of `littlechat.stuff.reliable`, both directions
+    RELIABLE = False
+    # frames in flight per peer, further ones wait
+    RELIABLE_WINDOW = 256
+    # an ack waits this long for traffic to ride on
+    RELIABLE_ACK_DELAY = 0.02
+    # period of the retransmission/ack timer
+    RELIABLE_TICK = 0.01
+    RELIABLE_MIN_RTO = 0.05
+    RELIABLE_MAX_RTO = 3
+    # a frame is given up after this many retransmissions
+    RELIABLE_MAX_RETRIES = 8
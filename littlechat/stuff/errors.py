@@ -7,3 +7,7 @@ class MsgTooLong(Exception):
 
 class ServerNotReachable(Exception):
     pass
+
+
+class MsgDecodeError(Exception):
+    pass
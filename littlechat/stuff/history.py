@@ -0,0 +1,320 @@
+"""
+    append-only log of the msgs fanned out by the server, so a client can
+    fetch what it missed
+
+    the log is a directory of segments, each one a pair of files named after
+    the sequence number of its first record:
+
+        <base seq>.log  records: seq(8B) | length(4B) | crc32(4B) | payload
+        <base seq>.idx  mmap'd array of the log offset of every record,
+                        slot `seq - base seq`
+
+    only the last segment is written, older ones are sealed (index trimmed to
+    its records) and dropped oldest first beyond the retention
+"""
+import os
+import mmap
+import time
+import zlib
+import bisect
+import struct
+import logging
+from typing import *
+from threading import Lock
+
+from littlechat.stuff.config import MsgConfig
+
+logger = logging.getLogger("server")
+
+RECORD_HEADER = struct.Struct("!QII")
+INDEX_ENTRY = struct.Struct("!Q")
+
+# `fsync` policies
+FSYNC_ALWAYS = "always"
+FSYNC_BATCH = "batch"
+FSYNC_OFF = "off"
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_OFF)
+
+_sync_fd = getattr(os, "fdatasync", os.fsync)
+
+
+class _Segment(object):
+
+    def __init__(self, directory: str, base_seq: int, index_entries: int,
+                 sealed: bool):
+        self.base_seq = base_seq
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.sealed = sealed
+        self.count = 0
+        self.size = 0
+        self._fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT,
+                                 0o644)
+        self._index: Optional[mmap.mmap] = None
+        if sealed:
+            self.size = os.fstat(self._fd).st_size
+            index_size = os.fstat(self._index_fd).st_size
+            self.count = index_size // INDEX_ENTRY.size
+            if self.count:
+                self._index = mmap.mmap(self._index_fd, index_size,
+                                        access=mmap.ACCESS_READ)
+            return
+        # sparse, only the pages of written entries take disk space
+        os.ftruncate(self._index_fd, index_entries * INDEX_ENTRY.size)
+        self._index = mmap.mmap(self._index_fd,
+                                index_entries * INDEX_ENTRY.size)
+        self._recover()
+
+    def _recover(self):
+        """index the valid records, cut a torn write at the end"""
+        file_size = os.fstat(self._fd).st_size
+        offset = 0
+        while offset + RECORD_HEADER.size <= file_size:
+            header = os.pread(self._fd, RECORD_HEADER.size, offset)
+            seq, length, crc = RECORD_HEADER.unpack(header)
+            end = offset + RECORD_HEADER.size + length
+            if seq != self.base_seq + self.count or end > file_size:
+                break
+            payload = os.pread(self._fd, length, offset + RECORD_HEADER.size)
+            if zlib.crc32(payload) != crc:
+                break
+            INDEX_ENTRY.pack_into(self._index,
+                                  self.count * INDEX_ENTRY.size, offset)
+            self.count += 1
+            offset = end
+        if offset != file_size:
+            logger.warning(f"history {self.log_path} cut at {offset} of "
+                           f"{file_size} bytes")
+            os.ftruncate(self._fd, offset)
+        self.size = offset
+
+    @property
+    def next_seq(self) -> int:
+        return self.base_seq + self.count
+
+    def append(self, seq: int, payload: bytes):
+        record = RECORD_HEADER.pack(seq, len(payload),
+                                    zlib.crc32(payload)) + payload
+        os.pwrite(self._fd, record, self.size)
+        INDEX_ENTRY.pack_into(self._index, self.count * INDEX_ENTRY.size,
+                              self.size)
+        self.count += 1
+        self.size += len(record)
+
+    def read(self, seq: int) -> bytes:
+        offset, = INDEX_ENTRY.unpack_from(
+            self._index, (seq - self.base_seq) * INDEX_ENTRY.size)
+        header = os.pread(self._fd, RECORD_HEADER.size, offset)
+        _, length, _ = RECORD_HEADER.unpack(header)
+        return os.pread(self._fd, length, offset + RECORD_HEADER.size)
+
+    def sync(self):
+        _sync_fd(self._fd)
+
+    def seal(self):
+        """no more appends, the index is trimmed to the records"""
+        self.sync()
+        self._index.flush()
+        self._index.close()
+        self._index = None
+        os.ftruncate(self._index_fd, self.count * INDEX_ENTRY.size)
+        if self.count:
+            self._index = mmap.mmap(self._index_fd,
+                                    self.count * INDEX_ENTRY.size,
+                                    access=mmap.ACCESS_READ)
+        self.sealed = True
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        os.close(self._fd)
+        os.close(self._index_fd)
+
+    def delete(self):
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class MessageLog(object):
+    """
+        segments of one directory, the sequence numbers start at 1 and never
+        repeat, even once their segment is dropped
+
+        fsync policy, the index is rebuilt from the log at open, so only the
+        log is synced:
+        - "always": every append, a crash loses nothing acknowledged
+        - "batch": at most every `fsync_interval` seconds, by `append` or
+          `sync_if_due`, a crash loses that much
+        - "off": left to the kernel, a crash of the process loses nothing,
+          one of the host loses what was not written back yet
+    """
+
+    def __init__(self, directory: str, fsync: Optional[str] = None,
+                 fsync_interval: Optional[float] = None,
+                 segment_bytes: Optional[int] = None,
+                 retention_bytes: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        fsync = fsync or MsgConfig.HISTORY_FSYNC
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {fsync}, "
+                             f"choose from {list(FSYNC_POLICIES)}")
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = (MsgConfig.HISTORY_FSYNC_INTERVAL
+                               if fsync_interval is None else fsync_interval)
+        self.segment_bytes = segment_bytes or MsgConfig.HISTORY_SEGMENT_BYTES
+        self.retention_bytes = (retention_bytes
+                                or MsgConfig.HISTORY_RETENTION_BYTES)
+        # a record takes at least its header, the index never fills first
+        self._index_entries = self.segment_bytes // RECORD_HEADER.size + 1
+        self.clock = clock
+        self._lock = Lock()
+        self._last_sync = clock()
+        self._unsynced = 0
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+
+        base_seqs = sorted(int(name[:-4]) for name in os.listdir(directory)
+                           if name.endswith(".log") and name[:-4].isdigit())
+        self._segments: List[_Segment] = [
+            _Segment(directory, base_seq, self._index_entries, sealed=True)
+            for base_seq in base_seqs[:-1]]
+        last_base = base_seqs[-1] if base_seqs else 1
+        self._segments.append(_Segment(directory, last_base,
+                                       self._index_entries, sealed=False))
+        self._base_seqs = [segment.base_seq for segment in self._segments]
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    @property
+    def first_seq(self) -> int:
+        return self._segments[0].base_seq
+
+    @property
+    def next_seq(self) -> int:
+        """the seq of the next append"""
+        return self._segments[-1].next_seq
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self._segments)
+
+    def append(self, payload: bytes) -> int:
+        """write `payload` as the next record, return its seq"""
+        with self._lock:
+            active = self._segments[-1]
+            record_size = RECORD_HEADER.size + len(payload)
+            if active.count and active.size + record_size > self.segment_bytes:
+                active = self._rotate_locked()
+            seq = active.next_seq
+            active.append(seq, payload)
+            self._unsynced += 1
+            if self.fsync == FSYNC_ALWAYS:
+                self._sync_locked()
+            elif self.fsync == FSYNC_BATCH:
+                if self.clock() - self._last_sync >= self.fsync_interval:
+                    self._sync_locked()
+            return seq
+
+    def _rotate_locked(self) -> _Segment:
+        sealed = self._segments[-1]
+        sealed.seal()
+        self._unsynced = 0
+        self._last_sync = self.clock()
+        active = _Segment(self.directory, sealed.next_seq,
+                          self._index_entries, sealed=False)
+        self._segments.append(active)
+        self._base_seqs.append(active.base_seq)
+        while (len(self._segments) > 1
+               and self.size > self.retention_bytes):
+            dropped = self._segments.pop(0)
+            self._base_seqs.pop(0)
+            dropped.delete()
+            logger.info(f"history segment {dropped.base_seq} dropped")
+        return active
+
+    def _sync_locked(self):
+        if self._unsynced:
+            self._segments[-1].sync()
+            self._unsynced = 0
+        self._last_sync = self.clock()
+
+    def sync(self):
+        with self._lock:
+            self._sync_locked()
+
+    def sync_if_due(self):
+        """for the batch policy, called periodically by the owner"""
+        if (self.fsync != FSYNC_BATCH or not self._unsynced
+                or self.clock() - self._last_sync < self.fsync_interval):
+            return
+        self.sync()
+
+    def read(self, seq: int) -> Optional[bytes]:
+        """None if `seq` was dropped or not written yet"""
+        with self._lock:
+            if not self.first_seq <= seq < self.next_seq:
+                return None
+            index = bisect.bisect_right(self._base_seqs, seq) - 1
+            return self._segments[index].read(seq)
+
+    def read_range(self, start_seq: int, limit: int
+                   ) -> List[Tuple[int, bytes]]:
+        """the records from `start_seq` on, at most `limit`"""
+        with self._lock:
+            seq = max(start_seq, self.first_seq)
+            end = min(seq + limit, self.next_seq)
+            records = []
+            index = bisect.bisect_right(self._base_seqs, seq) - 1
+            while seq < end:
+                segment = self._segments[index]
+                while seq < end and seq < segment.next_seq:
+                    records.append((seq, segment.read(seq)))
+                    seq += 1
+                index += 1
+            return records
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._sync_locked()
+            for segment in self._segments:
+                segment.close()
+
+
+if __name__ == "__main__":
+    # write throughput per fsync policy
+    import shutil
+    import tempfile
+
+    payload = b"x" * 120
+    print(f"{'policy':<8}{'msgs':>8}{'msgs/s':>12}{'MB/s':>8}")
+    for policy, msgs in ((FSYNC_OFF, 100000), (FSYNC_BATCH, 100000),
+                         (FSYNC_ALWAYS, 2000)):
+        directory = tempfile.mkdtemp(prefix="littlechat-history-")
+        try:
+            log = MessageLog(directory, fsync=policy, fsync_interval=0.05,
+                             segment_bytes=4 * 1024 * 1024)
+            start = time.perf_counter()
+            for _ in range(msgs):
+                log.append(payload)
+            log.sync()
+            cost = time.perf_counter() - start
+            assert log.read(msgs // 2) == payload
+            log.close()
+            reopened = MessageLog(directory, fsync=policy)
+            assert reopened.next_seq == msgs + 1
+            reopened.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        print(f"{policy:<8}{msgs:>8}{msgs / cost:>12.0f}"
+              f"{msgs * len(payload) / cost / 1e6:>8.1f}")
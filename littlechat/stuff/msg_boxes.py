@@ -1,15 +1,42 @@
 import logging
+import pickle
+import struct
 import time
 from typing import *
 from abc import ABC, abstractmethod
 
 from datetime import datetime
 from copy import deepcopy
-from threading import Lock
+
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.errors import MsgDecodeError
+from littlechat.stuff.presence import PresenceRegistry
+from littlechat.stuff.rooms import DEFAULT_ROOM
+from littlechat.stuff.tracing import Trace, MAX_TRACE_STAMPS, STAGE_NAMES
 
 logger = logging.getLogger("server")
 
+_WIRE_TYPES: Dict[int, type] = {}
+
+
+def wire_type(tag: int):
+    """
+        register a msg box class with a type tag of the binary wire format,
+        tags are part of the protocol, never reuse or change a published one
+    """
+
+    def register(cls):
+        if tag in _WIRE_TYPES:
+            raise ValueError(f"wire tag {tag} is already used by "
+                             f"{_WIRE_TYPES[tag].__name__}")
+        cls.WIRE_TAG = tag
+        _WIRE_TYPES[tag] = cls
+        return cls
 
+    return register
+
+
+@wire_type(1)
 class MsgBox(object):
 
     def __init__(self, username=None, msg=""):
@@ -20,6 +47,9 @@ class MsgBox(object):
         self.is_self = False
         self.msg_time = datetime.now()
         self.user_heartbeat_time = time.time()
+        # the stages the msg went through when sampled, see
+        # `littlechat.stuff.tracing`
+        self.trace: Optional[Trace] = None
 
     def get_msg_str(self, times=True):
         if times:
@@ -37,180 +67,835 @@ class MsgBox(object):
     def check_valid(self):
         if not self.username:
             return False
+        if len(self.username) > MsgConfig.MAX_USERNAME_LENGTH:
+            return False
 
         return True
 
+    def pack_wire_extra(self, buf: bytearray):
+        """
+            append the fields besides username, msg and msg_time to `buf`,
+            see `BinaryCodec`
+        """
+        pass
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        """read back what `pack_wire_extra` wrote, return the next pos"""
+        return pos
 
+
+@wire_type(2)
 class ServerMsg(MsgBox):
     def __init__(self, msg):
         super().__init__(username="server", msg=msg)
 
 
+@wire_type(3)
 class ExceptionMsg(ServerMsg):
     pass
 
 
+@wire_type(4)
 class DuplicatUser(ExceptionMsg):
     def __init__(self):
         super().__init__(msg="DuplicatUser")
 
 
+@wire_type(5)
 class UserDict(ServerMsg):
 
     def __init__(self, user_dict):
         super().__init__(msg=f"Online users: {list(user_dict.keys())}")
         self.user_dict = user_dict
 
+    def pack_wire_extra(self, buf: bytearray):
+        put_str_list(buf, self.user_dict.keys())
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        usernames, pos = get_str_list(data, pos)
+        # only the usernames travel, the server side records stay there
+        self.user_dict = dict.fromkeys(usernames)
+        return pos
 
+
+@wire_type(6)
 class TimeStamp(ServerMsg):
     def __init__(self, time_str):
         super().__init__(msg=time_str)
 
 
+@wire_type(7)
 class UserComeLeave(ServerMsg):
     pass
 
 
+@wire_type(8)
 class UserOnlineServer(UserComeLeave):
     def __init__(self, online_username):
         super().__init__(msg=f"`{online_username}` is online")
 
 
+@wire_type(9)
 class UserOfflineServer(UserComeLeave):
     def __init__(self, exit_username):
         super().__init__(msg=f"`{exit_username}` is offline")
 
 
+@wire_type(16)
+class PresenceSnapshot(ServerMsg):
+    """
+        the full member list of `room` at its `version`, sent to a user that
+        (re)joins or asks for a resync, `PresenceDelta`s apply on top of it
+    """
+
+    def __init__(self, version: int, usernames: Iterable[str],
+                 room: str = DEFAULT_ROOM):
+        self.version = version
+        self.usernames = list(usernames)
+        self.room = room
+        super().__init__(msg=f"Online users: {len(self.usernames)}")
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_varint(buf, self.version)
+        put_str_list(buf, self.usernames)
+        put_str(buf, self.room)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.version, pos = get_varint(data, pos)
+        self.usernames, pos = get_str_list(data, pos)
+        self.room, pos = get_str(data, pos)
+        return pos
+
+
+@wire_type(17)
+class PresenceDelta(ServerMsg):
+    """
+        the members joined and left `room` between its `base_version` and
+        `version`, versions may skip numbers when server workers share them
+    """
+
+    def __init__(self, version: int, joined: Iterable[str],
+                 left: Iterable[str], base_version: Optional[int] = None,
+                 room: str = DEFAULT_ROOM):
+        self.version = version
+        self.base_version = (version - 1 if base_version is None
+                             else base_version)
+        self.joined = list(joined)
+        self.left = list(left)
+        self.room = room
+        super().__init__(msg=f"joined: {self.joined}, left: {self.left}")
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_varint(buf, self.version)
+        put_varint(buf, self.base_version)
+        put_str_list(buf, self.joined)
+        put_str_list(buf, self.left)
+        put_str(buf, self.room)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.version, pos = get_varint(data, pos)
+        self.base_version, pos = get_varint(data, pos)
+        self.joined, pos = get_str_list(data, pos)
+        self.left, pos = get_str_list(data, pos)
+        self.room, pos = get_str(data, pos)
+        return pos
+
+
+@wire_type(10)
 class ClientMsg(MsgBox):
 
     def get_copy(self):
         return deepcopy(self)
 
+    def get_addr(self) -> Tuple[str, int]:
+        return self.ip, self.port
+
     @abstractmethod
-    def get_response_msg(self):
+    def get_response_msg(self, presence: PresenceRegistry):
         pass
 
     @abstractmethod
-    def get_broadcast_msg(self):
+    def get_broadcast_msg(self, presence: PresenceRegistry):
         pass
 
 
+@wire_type(11)
 class UserHeartbeat(ClientMsg):
 
-    def get_response_msg(self):
+    def get_response_msg(self, presence: PresenceRegistry):
         pass
 
-    def get_broadcast_msg(self):
+    def get_broadcast_msg(self, presence: PresenceRegistry):
         pass
 
-    def __init__(self, username):
+    def __init__(self, username, heartbeat_interval: float = 0,
+                 room: str = DEFAULT_ROOM):
         super().__init__(username=username, msg="heartbeat")
+        # the interval granted at login, to re-register an expired user
+        # with the same expiry, 0 for a peer that did not negotiate
+        self.heartbeat_interval = heartbeat_interval
+        # the room the client talks in, joined again with the lobby when
+        # an expired user is re-registered
+        self.room = room
 
-
+    def check_valid(self):
+        if not super().check_valid():
+            return False
+        # a pickled UserHeartbeat of version 0.0.7 lacks the room
+        room = getattr(self, "room", DEFAULT_ROOM)
+        return 0 < len(room) <= MsgConfig.MAX_ROOM_NAME_LENGTH
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_varint(buf, int(self.heartbeat_interval * 1000))
+        if self.room != DEFAULT_ROOM:
+            # the last field, absent from the lobby and from older peers
+            put_str(buf, self.room)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        millis, pos = get_varint(data, pos)
+        self.heartbeat_interval = millis / 1000
+        self.room = DEFAULT_ROOM
+        if pos < len(data):
+            self.room, pos = get_str(data, pos)
+        return pos
+
+
+@wire_type(12)
 class ConCheck(ClientMsg):
     def __init__(self):
         super().__init__(username="conCheck", msg="conCheck")
 
-    def get_response_msg(self):
+    def get_response_msg(self, presence: PresenceRegistry):
         return self
 
-    def get_broadcast_msg(self):
+    def get_broadcast_msg(self, presence: PresenceRegistry):
         pass
 
 
+@wire_type(13)
 class NewUser(ClientMsg):
+    # expiry of peers that do not negotiate a heartbeat interval
     EXPIRE_SECONDS = 3
-
-    USER_DICT: Dict[str, ClientMsg] = {
-
-    }
-
-    _USER_DICT_UPDATE_LOCK = Lock()
-
-    def __init__(self, username):
+    MIN_HEARTBEAT_INTERVAL = 1
+    MAX_HEARTBEAT_INTERVAL = 30
+    # heartbeats a user may miss before it expires
+    EXPIRE_HEARTBEATS = 3
+
+    def __init__(self, username, heartbeat_interval: float = 0,
+                 compression: Optional[Iterable[str]] = None,
+                 reliable: bool = False, traces: bool = False):
         super().__init__(username=username, msg="new_user")
         self.is_new = True
+        # asked by the client, granted in the response of the server
+        self.heartbeat_interval = heartbeat_interval
+        # granted by the server, 0 if not negotiated
+        self.expire_seconds = 0
+        # compression algorithms offered by the client in order of
+        # preference, the response holds the chosen one or nothing
+        self.compression = list(compression or [])
+        # asked by the client, granted in the response, see
+        # `littlechat.stuff.reliable`
+        self.reliable = reliable
+        # asked by the client, granted in the response, the msgs it gets
+        # keep their `trace`
+        self.traces = traces
 
     @classmethod
-    def update_user_heartbeat_time(cls, uhb: UserHeartbeat):
-        username = uhb.username
-        with cls._USER_DICT_UPDATE_LOCK:
-            if username in NewUser.USER_DICT:
-                NewUser.USER_DICT[username].user_heartbeat_time = time.time()
-            else:
-                new_user = NewUser(username)
-                new_user.ip, new_user.port = uhb.ip, uhb.port
-                NewUser.USER_DICT[username] = new_user
-                logger.info(f"user {username} is back online !!")
-
-    @classmethod
-    def check_and_clear_expired_users(cls):
-        with cls._USER_DICT_UPDATE_LOCK:
-            expired_users = []
-            for username, user in NewUser.USER_DICT.items():
-                user_hb_time = NewUser.USER_DICT[username].user_heartbeat_time
-                if time.time() - user_hb_time > cls.EXPIRE_SECONDS:
-                    expired_users.append(user)
-            for user in expired_users:
-                NewUser.USER_DICT.pop(user.username)
-
-        return expired_users
-
-    @classmethod
-    def remove_expired_user(cls, username):
-        with cls._USER_DICT_UPDATE_LOCK:
-            try:
-                cls.USER_DICT.pop(username)
-            except KeyError:
-                pass
-
-    @classmethod
-    def load_new_user(cls, msg: ClientMsg):
-        if msg.username not in cls.USER_DICT:
-            cls.USER_DICT[msg.username] = msg
-            cls.USER_DICT[msg.username] = msg
-            logger.info(f"user {msg.username} is online")
-
-    def is_user_exist(self):
-        return self.username in NewUser.USER_DICT
-
-    def get_response_msg(self):
-        if self.is_user_exist():
+    def negotiate_liveness(cls, heartbeat_interval: float
+                           ) -> Tuple[float, float]:
+        """return the granted (heartbeat_interval, expire_seconds)"""
+        if not heartbeat_interval:
+            return 0, cls.EXPIRE_SECONDS
+        heartbeat_interval = min(max(heartbeat_interval,
+                                     cls.MIN_HEARTBEAT_INTERVAL),
+                                 cls.MAX_HEARTBEAT_INTERVAL)
+        return heartbeat_interval, heartbeat_interval * cls.EXPIRE_HEARTBEATS
+
+    def pack_wire_extra(self, buf: bytearray):
+        buf.append(1 if self.is_new else 0)
+        put_varint(buf, int(self.heartbeat_interval * 1000))
+        put_varint(buf, int(self.expire_seconds * 1000))
+        put_str_list(buf, self.compression)
+        buf.append(1 if self.reliable else 0)
+        if self.traces:
+            # only sent when asked, the older peers take it as trailing bytes
+            buf.append(1)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        if pos >= len(data):
+            raise MsgDecodeError("truncated NewUser")
+        self.is_new = bool(data[pos])
+        pos += 1
+        interval_millis, pos = get_varint(data, pos)
+        expire_millis, pos = get_varint(data, pos)
+        self.heartbeat_interval = interval_millis / 1000
+        self.expire_seconds = expire_millis / 1000
+        self.compression, pos = get_str_list(data, pos)
+        # the last fields, absent from peers which do not know them
+        self.reliable = pos < len(data) and bool(data[pos])
+        pos = min(pos + 1, len(data))
+        self.traces = pos < len(data) and bool(data[pos])
+        return min(pos + 1, len(data))
+
+    def get_response_msg(self, presence: PresenceRegistry):
+        # a pickled NewUser of version 0.0.7 lacks the new attributes
+        heartbeat_interval, expire_seconds = self.negotiate_liveness(
+            getattr(self, "heartbeat_interval", 0))
+        if presence.add(self.username, self.get_addr(),
+                        expire_seconds=expire_seconds) is None:
             self.is_new = False
             return DuplicatUser()
+        presence.join_room(self.username, DEFAULT_ROOM)
 
-        self.load_new_user(self)
+        logger.info(f"user {self.username} is online")
         msg = self.get_copy()
         msg.msg = f"Welcome, {msg.username}"
+        msg.heartbeat_interval = heartbeat_interval
+        msg.expire_seconds = expire_seconds if heartbeat_interval else 0
+        # chosen by the server, see `Server.negotiate_compression`
+        msg.compression = []
+        # granted by the server, see `Server.negotiate_reliability`
+        msg.reliable = False
+        # granted by the server, see `Server.negotiate_tracing`
+        msg.traces = False
         return msg
 
-    def get_broadcast_msg(self, rsp_msg=None):
+    def get_broadcast_msg(self, presence: PresenceRegistry):
         if not self.is_new:
             return None
         return UserOnlineServer(self.username)
 
 
+@wire_type(14)
 class UserOffline(ClientMsg):
 
-    def get_response_msg(self):
+    def get_response_msg(self, presence: PresenceRegistry):
         pass
 
-    def get_broadcast_msg(self):
-        NewUser.remove_expired_user(self.username)
+    def get_broadcast_msg(self, presence: PresenceRegistry):
+        # only the user itself may sign off
+        record = presence.get_by_addr(self.get_addr())
+        if record is None or record.username != self.username:
+            return None
+        presence.remove(self.username)
         return UserOfflineServer(self.username)
 
     def __init__(self, username):
         super().__init__(username=username, msg="user exit")
 
 
+@wire_type(15)
 class UserMsg(ClientMsg):
 
-    def __init__(self, username, msg):
+    def __init__(self, username, msg, room: str = DEFAULT_ROOM):
         super().__init__(username=username, msg=msg)
+        # only the members of the room receive the msg
+        self.room = room
+        # set by the server from its history, 0 when not logged
+        self.seq = 0
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_str(buf, self.room)
+        put_varint(buf, self.seq)
 
-    def get_response_msg(self):
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.room, pos = get_str(data, pos)
+        self.seq, pos = get_varint(data, pos)
+        return pos
+
+    def get_response_msg(self, presence: PresenceRegistry):
         pass
 
-    def get_broadcast_msg(self):
+    def get_broadcast_msg(self, presence: PresenceRegistry):
+        # a pickled UserMsg of version 0.0.7 lacks the room
+        self.room = getattr(self, "room", DEFAULT_ROOM)
+        record = presence.get_by_addr(self.get_addr())
+        if (record is None or record.username != self.username
+                or self.room not in record.rooms):
+            return None
         msg = self.get_copy()
         return msg
+
+
+@wire_type(20)
+class JoinRoom(ClientMsg):
+    """answered with the `PresenceSnapshot` of the room"""
+
+    def __init__(self, username, room: str):
+        super().__init__(username=username, msg=room)
+
+    @property
+    def room(self) -> str:
+        return self.msg
+
+    def check_valid(self):
+        if not super().check_valid():
+            return False
+        return 0 < len(self.room) <= MsgConfig.MAX_ROOM_NAME_LENGTH
+
+    def get_response_msg(self, presence: PresenceRegistry):
+        record = presence.get_by_addr(self.get_addr())
+        if record is None or record.username != self.username:
+            return None
+        if (self.room not in record.rooms
+                and len(record.rooms) >= MsgConfig.MAX_ROOMS_PER_USER):
+            # each room is a set of members and a version kept by the server
+            return ExceptionMsg(msg=f"too many rooms, at most "
+                                    f"{MsgConfig.MAX_ROOMS_PER_USER}")
+        presence.join_room(self.username, self.room)
+        version, members = presence.rooms.versioned_members(self.room)
+        return PresenceSnapshot(version, members.keys(), room=self.room)
+
+    def get_broadcast_msg(self, presence: PresenceRegistry):
+        pass
+
+
+@wire_type(21)
+class LeaveRoom(JoinRoom):
+
+    def get_response_msg(self, presence: PresenceRegistry):
+        record = presence.get_by_addr(self.get_addr())
+        if record is not None and record.username == self.username:
+            presence.leave_room(self.username, self.room)
+
+
+@wire_type(18)
+class PresenceResync(ClientMsg):
+    """sent by a client that missed a `PresenceDelta` of `room`"""
+
+    def __init__(self, username, room: str = DEFAULT_ROOM):
+        super().__init__(username=username, msg="presence resync")
+        self.room = room
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_str(buf, self.room)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.room, pos = get_str(data, pos)
+        return pos
+
+    def get_response_msg(self, presence: PresenceRegistry):
+        record = presence.get_by_addr(self.get_addr())
+        if (record is None or record.username != self.username
+                or self.room not in record.rooms):
+            return None
+        version, members = presence.rooms.versioned_members(self.room)
+        return PresenceSnapshot(version, members.keys(), room=self.room)
+
+    def get_broadcast_msg(self, presence: PresenceRegistry):
+        pass
+
+
+@wire_type(22)
+class HistoryRequest(ClientMsg):
+    """
+        ask for the logged `UserMsg`s of the rooms of the user with a seq
+        after `since_seq`, oldest first, `limit` at most, or with `latest`
+        for the last `limit` ones
+
+        answered by the server with `HistoryBatch`s, see
+        `Server.on_history_request`
+    """
+
+    def __init__(self, username, since_seq: int, limit: int,
+                 latest: bool = False):
+        super().__init__(username=username, msg="history")
+        self.since_seq = since_seq
+        self.limit = limit
+        self.latest = latest
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_varint(buf, self.since_seq)
+        put_varint(buf, self.limit)
+        buf.append(1 if self.latest else 0)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.since_seq, pos = get_varint(data, pos)
+        self.limit, pos = get_varint(data, pos)
+        if pos >= len(data):
+            raise MsgDecodeError("truncated history request")
+        self.latest = bool(data[pos])
+        return pos + 1
+
+    def check_valid(self):
+        if not super().check_valid():
+            return False
+        return self.limit > 0
+
+    def get_response_msg(self, presence: PresenceRegistry):
+        pass
+
+    def get_broadcast_msg(self, presence: PresenceRegistry):
+        pass
+
+
+@wire_type(23)
+class HistoryBatch(ServerMsg):
+    """
+        one datagram of the answer to a `HistoryRequest`: encoded `UserMsg`s
+        and their seqs, `done` on the last one, the answer covered the seqs
+        up to `last_seq`, the newest logged seq was `head_seq`
+    """
+
+    def __init__(self, records: Iterable[Tuple[int, bytes]], last_seq: int,
+                 head_seq: int, done: bool):
+        self.records = list(records)
+        self.last_seq = last_seq
+        self.head_seq = head_seq
+        self.done = done
+        super().__init__(msg=f"history: {len(self.records)}")
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_varint(buf, self.last_seq)
+        put_varint(buf, self.head_seq)
+        buf.append(1 if self.done else 0)
+        put_varint(buf, len(self.records))
+        for seq, payload in self.records:
+            put_varint(buf, seq)
+            put_bytes(buf, payload)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.last_seq, pos = get_varint(data, pos)
+        self.head_seq, pos = get_varint(data, pos)
+        if pos >= len(data):
+            raise MsgDecodeError("truncated history batch")
+        self.done = bool(data[pos])
+        count, pos = get_varint(data, pos + 1)
+        self.records = []
+        for _ in range(count):
+            seq, pos = get_varint(data, pos)
+            payload, pos = get_bytes(data, pos)
+            self.records.append((seq, payload))
+        return pos
+
+
+@wire_type(19)
+class MsgChunk(ClientMsg):
+    """
+        one slice of a msg box too large for a single datagram, see
+        `littlechat.stuff.chunks`, relayed by the server as is
+    """
+
+    def __init__(self, username, msg_id: int, index: int, count: int,
+                 inner_tag: int, data: bytes, room: str = DEFAULT_ROOM):
+        super().__init__(username=username, msg="")
+        # unique per sender, receivers reassemble by (username, msg_id)
+        self.msg_id = msg_id
+        self.index = index
+        self.count = count
+        # wire tag of the chunked msg box
+        self.inner_tag = inner_tag
+        self.data = data
+        # the room of a chunked `UserMsg`, the server relays by it
+        self.room = room
+
+    def pack_wire_extra(self, buf: bytearray):
+        put_varint(buf, self.msg_id)
+        put_varint(buf, self.index)
+        put_varint(buf, self.count)
+        put_varint(buf, self.inner_tag)
+        put_bytes(buf, self.data)
+        put_str(buf, self.room)
+
+    def unpack_wire_extra(self, data: bytes, pos: int) -> int:
+        self.msg_id, pos = get_varint(data, pos)
+        self.index, pos = get_varint(data, pos)
+        self.count, pos = get_varint(data, pos)
+        self.inner_tag, pos = get_varint(data, pos)
+        self.data, pos = get_bytes(data, pos)
+        self.room, pos = get_str(data, pos)
+        return pos
+
+    def check_valid(self):
+        if not super().check_valid():
+            return False
+        return 0 <= self.index < self.count
+
+    def get_response_msg(self, presence: PresenceRegistry):
+        pass
+
+    def get_broadcast_msg(self, presence: PresenceRegistry):
+        pass
+
+
+# ------------------------------ wire codecs ------------------------------
+#
+# binary format (all integers big endian):
+#   header: version(1B) | type tag(1B) | flags(1B) | msg_time epoch millis(8B)
+#   trace:  [trace id(8B) | varint count | count * (stage(1B) | varint
+#           micros)], with FLAG_TRACE, see `littlechat.stuff.tracing`
+#   body:   [username: varint length + utf8] | msg: varint length + utf8
+#           | type specific extra fields, see `MsgBox.pack_wire_extra`
+#
+# ip and port are never sent, the receiver fills them from the datagram addr
+
+WIRE_VERSION = 1
+_WIRE_HEADER = struct.Struct("!BBBq")
+
+FLAG_NO_USERNAME = 0x01
+# a client without tracing can not decode a traced msg, only the peers which
+# asked for traces at login get them, see `NewUser.traces`
+FLAG_TRACE = 0x02
+_TRACE_ID = struct.Struct("!Q")
+
+# first byte of every pickle with protocol >= 2
+_PICKLE_PROTO_MARK = 0x80
+
+# liveness ping of an idle client, the server knows the sender by its addr
+PING_TAG = 0
+PING_PAYLOAD = bytes([WIRE_VERSION, PING_TAG])
+
+
+def put_varint(buf: bytearray, value: int):
+    if value < 0:
+        raise ValueError(f"varint must not be negative: {value}")
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def get_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data) or shift > 63:
+            raise MsgDecodeError("truncated or invalid varint")
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def put_bytes(buf: bytearray, raw: bytes):
+    put_varint(buf, len(raw))
+    buf += raw
+
+
+def get_bytes(data: bytes, pos: int) -> Tuple[bytes, int]:
+    length, pos = get_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise MsgDecodeError("truncated bytes")
+    return bytes(data[pos:end]), end
+
+
+def put_str(buf: bytearray, text: str):
+    put_bytes(buf, text.encode())
+
+
+def get_str(data: bytes, pos: int) -> Tuple[str, int]:
+    raw, pos = get_bytes(data, pos)
+    try:
+        return raw.decode(), pos
+    except UnicodeDecodeError as exp:
+        raise MsgDecodeError(f"invalid utf8 string: {exp}")
+
+
+def put_str_list(buf: bytearray, texts: Iterable[str]):
+    texts = list(texts)
+    put_varint(buf, len(texts))
+    for text in texts:
+        put_str(buf, text)
+
+
+def get_str_list(data: bytes, pos: int) -> Tuple[List[str], int]:
+    count, pos = get_varint(data, pos)
+    texts = []
+    for _ in range(count):
+        text, pos = get_str(data, pos)
+        texts.append(text)
+    return texts, pos
+
+
+def put_trace(buf: bytearray, trace: Trace):
+    buf += _TRACE_ID.pack(trace.trace_id)
+    put_varint(buf, len(trace.stamps))
+    for stage, micros in trace.stamps:
+        buf.append(stage)
+        put_varint(buf, micros)
+
+
+def get_trace(data: bytes, pos: int) -> Tuple[Trace, int]:
+    if pos + _TRACE_ID.size > len(data):
+        raise MsgDecodeError("truncated trace")
+    trace_id, = _TRACE_ID.unpack_from(data, pos)
+    count, pos = get_varint(data, pos + _TRACE_ID.size)
+    if count > MAX_TRACE_STAMPS:
+        raise MsgDecodeError(f"too many trace stamps: {count}")
+    stamps = []
+    for _ in range(count):
+        if pos >= len(data):
+            raise MsgDecodeError("truncated trace")
+        stage = data[pos]
+        if stage not in STAGE_NAMES:
+            # the stages name the hop histograms, a peer makes up none
+            raise MsgDecodeError(f"unknown trace stage: {stage}")
+        micros, pos = get_varint(data, pos + 1)
+        stamps.append((stage, micros))
+    return Trace(trace_id, stamps), pos
+
+
+def is_ping_payload(data: bytes) -> bool:
+    return data == PING_PAYLOAD
+
+
+def is_legacy_payload(data: bytes) -> bool:
+    """whether `data` is a pickled msg box sent by a version before 0.0.8"""
+    return bool(data) and data[0] == _PICKLE_PROTO_MARK
+
+
+class MsgCodec(ABC):
+    name = ""
+
+    @abstractmethod
+    def encode(self, msg: MsgBox) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes) -> MsgBox:
+        pass
+
+
+class PickleCodec(MsgCodec):
+    """the format of version 0.0.7 and before, for mixed version rollouts"""
+    name = "pickle"
+
+    def encode(self, msg: MsgBox) -> bytes:
+        trace = getattr(msg, "trace", None)
+        if trace is None:
+            return pickle.dumps(msg)
+        # an old version can not unpickle it
+        msg.trace = None
+        try:
+            return pickle.dumps(msg)
+        finally:
+            msg.trace = trace
+
+    def decode(self, data: bytes) -> MsgBox:
+        try:
+            msg = pickle.loads(data)
+        except Exception as exp:
+            raise MsgDecodeError(f"invalid pickle payload: {exp}")
+        if not isinstance(msg, MsgBox):
+            raise MsgDecodeError(f"not a msg box: {type(msg)}")
+        return msg
+
+
+class BinaryCodec(MsgCodec):
+    name = "binary"
+
+    def __init__(self, pickle_compat: Optional[bool] = None,
+                 traces: bool = True):
+        if pickle_compat is None:
+            pickle_compat = MsgConfig.PICKLE_COMPAT
+        self.pickle_compat = pickle_compat
+        # whether the traces are encoded
+        self.traces = traces
+        self._pickle_codec = PickleCodec()
+
+    def encode(self, msg: MsgBox) -> bytes:
+        flags = 0
+        if msg.username is None:
+            flags |= FLAG_NO_USERNAME
+        trace = getattr(msg, "trace", None) if self.traces else None
+        if trace is not None:
+            flags |= FLAG_TRACE
+        buf = bytearray(_WIRE_HEADER.pack(
+            WIRE_VERSION, msg.WIRE_TAG, flags,
+            int(msg.msg_time.timestamp() * 1000)))
+        if trace is not None:
+            put_trace(buf, trace)
+        if msg.username is not None:
+            put_str(buf, msg.username)
+        put_str(buf, msg.msg)
+        msg.pack_wire_extra(buf)
+        return bytes(buf)
+
+    def decode(self, data: bytes) -> MsgBox:
+        if is_legacy_payload(data):
+            if not self.pickle_compat:
+                raise MsgDecodeError("pickle payload is not allowed")
+            return self._pickle_codec.decode(data)
+
+        if len(data) < _WIRE_HEADER.size:
+            raise MsgDecodeError(f"payload too short: {len(data)}")
+        version, tag, flags, millis = _WIRE_HEADER.unpack_from(data)
+        if version != WIRE_VERSION:
+            raise MsgDecodeError(f"unsupported wire version: {version}")
+        cls = _WIRE_TYPES.get(tag)
+        if cls is None:
+            raise MsgDecodeError(f"unknown wire type tag: {tag}")
+
+        pos = _WIRE_HEADER.size
+        trace = None
+        if flags & FLAG_TRACE:
+            trace, pos = get_trace(data, pos)
+        username = None
+        if not flags & FLAG_NO_USERNAME:
+            username, pos = get_str(data, pos)
+        text, pos = get_str(data, pos)
+
+        # the constructors differ between msg types, so bypass them
+        msg: MsgBox = cls.__new__(cls)
+        msg.username = username
+        msg.ip = ""
+        msg.port = ""
+        msg.msg = text
+        msg.is_self = False
+        try:
+            msg.msg_time = datetime.fromtimestamp(millis / 1000)
+        except (OverflowError, OSError, ValueError) as exp:
+            raise MsgDecodeError(f"invalid msg_time: {exp}")
+        msg.user_heartbeat_time = time.time()
+        msg.trace = trace
+        pos = msg.unpack_wire_extra(data, pos)
+        if pos != len(data):
+            raise MsgDecodeError(f"{len(data) - pos} trailing bytes")
+        return msg
+
+
+_CODECS = {
+    PickleCodec.name: PickleCodec,
+    BinaryCodec.name: BinaryCodec,
+}
+
+
+def get_codec(name: Optional[str] = None) -> MsgCodec:
+    """
+        return the codec named `name`, default `MsgConfig.WIRE_CODEC`,
+        every codec decodes pickle payloads when `MsgConfig.PICKLE_COMPAT`
+    """
+    name = name or MsgConfig.WIRE_CODEC
+    if name not in _CODECS:
+        raise ValueError(f"unknown wire codec: {name}, "
+                         f"choose from {list(_CODECS.keys())}")
+    return _CODECS[name]()
+
+
+if __name__ == "__main__":
+    # micro benchmark, encode/decode cost and size of every codec
+    import timeit
+
+    samples = [
+        UserHeartbeat("walker"),
+        ConCheck(),
+        NewUser("walker"),
+        UserMsg("walker", "hi"),
+        UserMsg("walker", "这是一条测试消息 😊" * 20),
+        UserOnlineServer("walker"),
+        UserDict(dict.fromkeys(f"user{i}" for i in range(50))),
+    ]
+    number = 2000
+    print(f"{'msg type':<20}{'codec':<8}{'bytes':>8}"
+          f"{'encode ns':>12}{'decode ns':>12}")
+    for sample in samples:
+        for codec in (PickleCodec(), BinaryCodec()):
+            payload = codec.encode(sample)
+            enc = timeit.timeit(lambda: codec.encode(sample), number=number)
+            dec = timeit.timeit(lambda: codec.decode(payload), number=number)
+            print(f"{type(sample).__name__:<20}{codec.name:<8}"
+                  f"{len(payload):>8}{enc / number * 1e9:>12.0f}"
+                  f"{dec / number * 1e9:>12.0f}")
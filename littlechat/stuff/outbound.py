@@ -0,0 +1,239 @@
+"""
+    outbound datagrams of the server, queued per destination so a burst to a
+    large room can not hold back the responses of other users
+
+    - priority classes: control responses, then chat, then presence
+    - within a class the peers take turns, one datagram each
+    - a peer holds at most `depth` datagrams, a full queue drops its oldest
+      datagram of the lowest priority
+    - a datagram queued with a coalesce key replaces the one still queued
+      with the same key, a newer full snapshot makes the older one stale
+"""
+import time
+import logging
+from typing import *
+from threading import Condition
+from collections import deque
+
+from littlechat.stuff.config import MsgConfig
+
+logger = logging.getLogger("server")
+
+PRIORITY_CONTROL = 0
+PRIORITY_CHAT = 1
+PRIORITY_PRESENCE = 2
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_CHAT, PRIORITY_PRESENCE)
+
+
+class _PeerQueue(object):
+    __slots__ = ("addr", "classes", "scheduled", "depth", "keys")
+
+    def __init__(self, addr: Tuple[str, int]):
+        self.addr = addr
+        # per priority: [payload, started, coalesce key] lists, mutable so a
+        # coalesced payload keeps its place
+        self.classes: List[Deque[list]] = [deque() for _ in PRIORITIES]
+        # whether the peer is in the turn ring of the priority
+        self.scheduled = [False] * len(PRIORITIES)
+        self.depth = 0
+        self.keys: Dict[Hashable, list] = {}
+
+
+class OutboundQueues(object):
+    """
+        the per peer queues, thread safe, one consumer
+
+        the queue of a peer stays once empty, a broadcast to a large room
+        does not allocate one per member, `forget` the peers gone and
+        `prune` the ones never known
+    """
+
+    def __init__(self, depth: Optional[int] = None):
+        self.depth = depth or MsgConfig.OUTBOUND_QUEUE_DEPTH
+        self._cond = Condition()
+        self._peers: Dict[Tuple[str, int], _PeerQueue] = {}
+        # per priority, the peers whose turn comes, a peer removed or
+        # without datagrams of that priority any more is skipped
+        self._turns: List[Deque[_PeerQueue]] = [deque() for _ in PRIORITIES]
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self._dropped_of: Dict[Tuple[str, int], int] = {}
+
+    def __len__(self):
+        return self.queued
+
+    def put(self, payload: bytes, addrs: Iterable[Tuple[str, int]],
+            started: Optional[float] = None,
+            priority: int = PRIORITY_CHAT,
+            coalesce: Optional[Hashable] = None):
+        """queue `payload` for every addr of `addrs`"""
+        started = time.perf_counter() if started is None else started
+        with self._cond:
+            for addr in addrs:
+                self._put_locked(payload, addr, started, priority, coalesce)
+            self._cond.notify()
+
+    def _put_locked(self, payload: bytes, addr: Tuple[str, int],
+                    started: float, priority: int,
+                    coalesce: Optional[Hashable]):
+        peer = self._peers.get(addr)
+        if peer is None:
+            peer = self._peers[addr] = _PeerQueue(addr)
+        if coalesce is not None:
+            stale = peer.keys.get(coalesce)
+            if stale is not None:
+                stale[0] = payload
+                self.coalesced += 1
+                return
+        if peer.depth >= self.depth:
+            self._drop_oldest_locked(peer)
+        item = [payload, started, coalesce]
+        if coalesce is not None:
+            peer.keys[coalesce] = item
+        peer.classes[priority].append(item)
+        peer.depth += 1
+        self.queued += 1
+        if peer.depth > self.max_depth:
+            self.max_depth = peer.depth
+        if not peer.scheduled[priority]:
+            peer.scheduled[priority] = True
+            self._turns[priority].append(peer)
+
+    def _drop_oldest_locked(self, peer: _PeerQueue):
+        for priority in reversed(PRIORITIES):
+            if peer.classes[priority]:
+                self._take_locked(peer, priority)
+                self.dropped += 1
+                self._dropped_of[peer.addr] = (
+                        self._dropped_of.get(peer.addr, 0) + 1)
+                return
+
+    def _take_locked(self, peer: _PeerQueue, priority: int) -> list:
+        item = peer.classes[priority].popleft()
+        if item[2] is not None and peer.keys.get(item[2]) is item:
+            del peer.keys[item[2]]
+        peer.depth -= 1
+        self.queued -= 1
+        return item
+
+    def _pop_locked(self) -> Optional[Tuple[bytes, Tuple[str, int], float]]:
+        for priority in PRIORITIES:
+            turns = self._turns[priority]
+            while turns:
+                peer = turns.popleft()
+                if (not peer.classes[priority]
+                        or self._peers.get(peer.addr) is not peer):
+                    peer.scheduled[priority] = False
+                    continue
+                payload, started, _ = self._take_locked(peer, priority)
+                if peer.classes[priority]:
+                    # back of the ring, the other peers go first
+                    turns.append(peer)
+                else:
+                    peer.scheduled[priority] = False
+                return payload, peer.addr, started
+        return None
+
+    def get_batch(self, max_items: int, timeout: Optional[float] = None
+                  ) -> List[Tuple[bytes, Tuple[str, int], float]]:
+        """
+            up to `max_items` (payload, addr, started) in sending order,
+            waits at most `timeout` for the first one, [] when none came
+        """
+        with self._cond:
+            if not self.queued:
+                self._cond.wait(timeout)
+            items = []
+            while len(items) < max_items:
+                item = self._pop_locked()
+                if item is None:
+                    break
+                items.append(item)
+            return items
+
+    def forget(self, addr: Tuple[str, int]):
+        """a peer gone, its queued datagrams with it"""
+        with self._cond:
+            peer = self._peers.pop(addr, None)
+            if peer is not None:
+                self.queued -= peer.depth
+            self._dropped_of.pop(addr, None)
+
+    def prune(self, keep: Callable[[Tuple[str, int]], bool]) -> int:
+        """drop the empty queues of the peers not to `keep`, return how many"""
+        with self._cond:
+            idle = [addr for addr, peer in self._peers.items()
+                    if not peer.depth and not keep(addr)]
+            for addr in idle:
+                del self._peers[addr]
+                self._dropped_of.pop(addr, None)
+            return len(idle)
+
+    def peer_stats(self, addr: Tuple[str, int]) -> dict:
+        with self._cond:
+            peer = self._peers.get(addr)
+            return {
+                "depth": peer.depth if peer is not None else 0,
+                "dropped": self._dropped_of.get(addr, 0),
+            }
+
+    def stats(self, top: int = 5) -> dict:
+        with self._cond:
+            depths = sorted(((peer.depth, addr)
+                             for addr, peer in self._peers.items()
+                             if peer.depth), reverse=True)[:top]
+            most_dropped = sorted(self._dropped_of.items(),
+                                  key=lambda item: item[1],
+                                  reverse=True)[:top]
+            return {
+                "queued": self.queued,
+                "peers": len(self._peers),
+                "max_depth": self.max_depth,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "deepest": [(f"{addr[0]}:{addr[1]}", depth)
+                            for depth, addr in depths],
+                "most_dropped": [(f"{addr[0]}:{addr[1]}", dropped)
+                                 for addr, dropped in most_dropped],
+            }
+
+
+if __name__ == "__main__":
+    # a response queued behind a broadcast to 10k users, one global queue
+    # vs the per peer queues
+    from queue import Queue
+
+    users = [("127.0.0.1", 20000 + i) for i in range(10000)]
+    payload = b"x" * 64
+
+    fifo = Queue()
+    fifo.put((payload, users))
+    fifo.put((b"response", [("127.0.0.1", 1)]))
+    position = 0
+    while True:
+        data, addrs = fifo.get()
+        position += len(addrs)
+        if data == b"response":
+            break
+
+    queues = OutboundQueues(depth=1024)
+    # the first broadcast creates the queues of the users
+    queues.put(payload, users)
+    while queues.get_batch(64, timeout=0):
+        pass
+    start = time.perf_counter()
+    queues.put(payload, users, priority=PRIORITY_CHAT)
+    put_cost = time.perf_counter() - start
+    queues.put(b"response", [("127.0.0.1", 1)], priority=PRIORITY_CONTROL)
+    first = queues.get_batch(1)[0]
+    start = time.perf_counter()
+    while queues.get_batch(64, timeout=0):
+        pass
+    pop_cost = time.perf_counter() - start
+    print(f"response sent after {position} datagrams with one queue, "
+          f"after {0 if first[0] == b'response' else '?'} with per peer "
+          f"queues")
+    print(f"per peer queues: {put_cost * 1e6 / len(users):.2f} us per "
+          f"datagram queued, {pop_cost * 1e6 / len(users):.2f} us taken")
@@ -0,0 +1,384 @@
+import time
+import itertools
+from typing import *
+from threading import Lock
+
+from littlechat.stuff.rooms import RoomIndex
+from littlechat.utils.util_timer import TimingWheel
+
+
+class PresenceTracker(object):
+    """
+        heartbeat deadlines of the online users
+
+        `touch` is O(1) and `pop_expired` is O(expired), instead of scanning
+        every user on every check
+    """
+
+    def __init__(self, expire_seconds: float = 3, tick=0.1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.expire_seconds = expire_seconds
+        self.clock = clock
+        # one revolution covers the expiry, so a key is moved at most once
+        # per heartbeat interval
+        slots = int(expire_seconds / tick) + 2
+        self._wheel = TimingWheel(tick=tick, slots=slots, now=clock())
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def __contains__(self, username):
+        return username in self._wheel
+
+    def touch(self, username: str, expire_seconds: Optional[float] = None):
+        if expire_seconds is None:
+            expire_seconds = self.expire_seconds
+        with self._lock:
+            self._wheel.schedule(username, self.clock() + expire_seconds)
+
+    def forget(self, username: str):
+        with self._lock:
+            self._wheel.cancel(username)
+
+    def pop_expired(self) -> List[str]:
+        with self._lock:
+            return self._wheel.advance(self.clock())
+
+
+class PresenceRecord(object):
+    """what the server remembers of an online user, a few fixed fields"""
+    __slots__ = ("username", "addr", "last_seen", "session_id",
+                 "expire_seconds", "rooms")
+
+    def __init__(self, username: str, addr: Tuple[str, int], last_seen: float,
+                 session_id: int, expire_seconds: float):
+        self.username = username
+        self.addr = addr
+        # `time.monotonic` of the last datagram from this user
+        self.last_seen = last_seen
+        self.session_id = session_id
+        # negotiated at login, see `NewUser.negotiate_liveness`
+        self.expire_seconds = expire_seconds
+        # the member -> rooms index, see `RoomIndex`
+        self.rooms: Set[str] = set()
+
+    def __repr__(self):
+        return (f"PresenceRecord({self.username!r}, {self.addr}, "
+                f"session_id={self.session_id})")
+
+
+PresenceChangeCallback = Callable[
+    [int, List[PresenceRecord], List[PresenceRecord]], None]
+# (room, base_version, version, joined, left)
+RoomChangeCallback = Callable[
+    [str, int, int, List[PresenceRecord], List[PresenceRecord]], None]
+
+
+class PresenceRegistry(object):
+    """
+        the online users of a server, keyed by username with a reverse index
+        by addr
+
+        writers serialize on a lock and publish a new immutable snapshot on
+        every join/leave, readers (the fan-out) use `snapshot` without any
+        lock, a heartbeat only touches `last_seen` in place
+
+        every join/leave bumps `version` and calls `on_change(version, joined,
+        left)` under the lock, so the callback sees the changes in order,
+        `next_version` replaces the local counter when several registries
+        (server workers) share one version sequence
+
+        the users join rooms, every room has its own version, bumped with
+        `on_room_change(room, base_version, version, joined, left)` under
+        the lock, a user that goes offline leaves all its rooms
+    """
+
+    def __init__(self, expire_seconds: float = 3,
+                 clock: Callable[[], float] = time.monotonic,
+                 on_change: Optional[PresenceChangeCallback] = None,
+                 next_version: Optional[Callable[[], int]] = None,
+                 on_room_change: Optional[RoomChangeCallback] = None):
+        self.clock = clock
+        self.on_change = on_change
+        self.next_version = next_version
+        self.on_room_change = on_room_change
+        self.rooms = RoomIndex()
+        self._tracker = PresenceTracker(expire_seconds=expire_seconds,
+                                        clock=clock)
+        self._lock = Lock()
+        self._by_name: Dict[str, PresenceRecord] = {}
+        self._by_addr: Dict[Tuple[str, int], PresenceRecord] = {}
+        # (version, snapshot), replaced as a whole so readers see both at once
+        self._published: Tuple[int, Dict[str, PresenceRecord]] = (0, {})
+        self._session_ids = itertools.count(1)
+
+    @property
+    def expire_seconds(self) -> float:
+        return self._tracker.expire_seconds
+
+    @property
+    def version(self) -> int:
+        return self._published[0]
+
+    def __len__(self):
+        return len(self._published[1])
+
+    def __contains__(self, username):
+        return username in self._published[1]
+
+    def _publish(self, joined=(), left=()):
+        version = self._published[0]
+        if joined or left:
+            version = (self.next_version() if self.next_version is not None
+                       else version + 1)
+        self._published = (version, dict(self._by_name))
+        if (joined or left) and self.on_change is not None:
+            self.on_change(version, list(joined), list(left))
+
+    def snapshot(self) -> Dict[str, PresenceRecord]:
+        """a consistent view, must not be modified"""
+        return self._published[1]
+
+    def versioned_snapshot(self) -> Tuple[int, Dict[str, PresenceRecord]]:
+        return self._published
+
+    def get(self, username: str) -> Optional[PresenceRecord]:
+        return self._published[1].get(username)
+
+    def get_by_addr(self, addr: Tuple[str, int]) -> Optional[PresenceRecord]:
+        return self._by_addr.get(addr)
+
+    def usernames(self) -> List[str]:
+        return list(self._published[1].keys())
+
+    def addrs(self, exclude_username: Optional[str] = None
+              ) -> List[Tuple[str, int]]:
+        return [record.addr for username, record in self._published[1].items()
+                if username != exclude_username]
+
+    def _add_locked(self, username, addr, expire_seconds
+                    ) -> Tuple[PresenceRecord, Optional[PresenceRecord]]:
+        """return the new record and the one evicted from `addr` if any"""
+        if expire_seconds is None:
+            expire_seconds = self.expire_seconds
+        record = PresenceRecord(username, addr, self.clock(),
+                                next(self._session_ids), expire_seconds)
+        evicted = self._by_addr.get(addr)
+        if evicted is not None and evicted.username != username:
+            # the addr is reused by another user, the old one is gone
+            self._by_name.pop(evicted.username, None)
+            self._tracker.forget(evicted.username)
+            self._leave_rooms_locked([evicted])
+        else:
+            evicted = None
+        self._by_name[username] = record
+        self._by_addr[addr] = record
+        self._tracker.touch(username, expire_seconds)
+        return record, evicted
+
+    def add(self, username: str, addr: Tuple[str, int],
+            expire_seconds: Optional[float] = None
+            ) -> Optional[PresenceRecord]:
+        """register a new user, None if the username is already online"""
+        with self._lock:
+            if username in self._by_name:
+                return None
+            record, evicted = self._add_locked(username, addr,
+                                               expire_seconds)
+            self._publish(joined=[record], left=[evicted] if evicted else [])
+            return record
+
+    def touch_addr(self, addr: Tuple[str, int]) -> Optional[PresenceRecord]:
+        """
+            note any datagram from `addr`, O(1) and without the registry lock,
+            return the record of the sender, None if unknown
+        """
+        record = self._by_addr.get(addr)
+        if record is not None:
+            record.last_seen = self.clock()
+            self._tracker.touch(record.username, record.expire_seconds)
+        return record
+
+    def refresh(self, username: str, addr: Tuple[str, int],
+                expire_seconds: Optional[float] = None) -> bool:
+        """
+            note a heartbeat, re-register a user already expired,
+            return True if the user was re-registered
+
+            the heartbeat of a username online behind another addr is
+            dropped, a client which moved logs in again with `NewUser`
+        """
+        with self._lock:
+            record = self._by_name.get(username)
+            if record is not None:
+                if record.addr == addr:
+                    record.last_seen = self.clock()
+                    self._tracker.touch(username, record.expire_seconds)
+                return False
+            new_record, evicted = self._add_locked(username, addr,
+                                                   expire_seconds)
+            self._publish(joined=[new_record],
+                          left=[evicted] if evicted else [])
+            return True
+
+    def _remove_locked(self, username) -> Optional[PresenceRecord]:
+        record = self._by_name.pop(username, None)
+        if record is None:
+            return None
+        if self._by_addr.get(record.addr) is record:
+            del self._by_addr[record.addr]
+        self._tracker.forget(username)
+        return record
+
+    def remove(self, username: str) -> Optional[PresenceRecord]:
+        with self._lock:
+            record = self._remove_locked(username)
+            if record is not None:
+                self._leave_rooms_locked([record])
+                self._publish(left=[record])
+            return record
+
+    def _next_room_version(self, room: str) -> int:
+        if self.next_version is not None:
+            return self.next_version()
+        return self.rooms.get_version(room) + 1
+
+    def _notify_room(self, room, base_version, version, joined=(), left=()):
+        if self.on_room_change is not None:
+            self.on_room_change(room, base_version, version, list(joined),
+                                list(left))
+
+    def _leave_rooms_locked(self, records: List[PresenceRecord], notify=True):
+        """every room of `records` gets one version bump for all of them"""
+        left_by_room: Dict[str, List[PresenceRecord]] = {}
+        for record in records:
+            for room in record.rooms:
+                left_by_room.setdefault(room, []).append(record)
+            record.rooms = set()
+        for room, left in left_by_room.items():
+            base_version = self.rooms.get_version(room)
+            version = (self._next_room_version(room) if notify
+                       else base_version)
+            for record in left:
+                self.rooms.leave(room, record.username, version)
+            if notify:
+                self._notify_room(room, base_version, version, left=left)
+
+    def join_room(self, username: str, room: str) -> bool:
+        """False if the user is offline or already in `room`"""
+        with self._lock:
+            record = self._by_name.get(username)
+            if record is None or room in record.rooms:
+                return False
+            base_version = self.rooms.get_version(room)
+            version = self._next_room_version(room)
+            self.rooms.join(room, username, record.addr, version)
+            record.rooms.add(room)
+            self._notify_room(room, base_version, version, joined=[record])
+            return True
+
+    def leave_room(self, username: str, room: str) -> bool:
+        """False if the user is offline or not in `room`"""
+        with self._lock:
+            record = self._by_name.get(username)
+            if record is None or room not in record.rooms:
+                return False
+            base_version = self.rooms.get_version(room)
+            version = self._next_room_version(room)
+            self.rooms.leave(room, username, version)
+            record.rooms.discard(room)
+            self._notify_room(room, base_version, version, left=[record])
+            return True
+
+    def apply_remote_room(self, room: str, version: int, joined: List[str],
+                          left: List[str]):
+        """mirror the room changes published by another registry"""
+        with self._lock:
+            for username in left:
+                record = self._by_name.get(username)
+                if record is not None:
+                    record.rooms.discard(room)
+                self.rooms.leave(room, username, version)
+            for username in joined:
+                record = self._by_name.get(username)
+                if record is None:
+                    continue
+                record.rooms.add(room)
+                self.rooms.join(room, username, record.addr, version)
+
+    def apply_remote(self, version: int, joined: List[PresenceRecord],
+                     left: List[PresenceRecord]):
+        """
+            mirror the changes published by another registry sharing the
+            version sequence, its users are not expired here and `on_change`
+            is not called, the other side already announced the changes
+        """
+        with self._lock:
+            for record in left:
+                current = self._by_name.get(record.username)
+                if current is not None and current.addr == record.addr:
+                    self._remove_locked(record.username)
+                    # the other registry announces the room changes
+                    self._leave_rooms_locked([current], notify=False)
+            for record in joined:
+                current = self._by_name.get(record.username)
+                if current is not None:
+                    if self._by_addr.get(current.addr) is current:
+                        del self._by_addr[current.addr]
+                    record.rooms = current.rooms
+                    for room in current.rooms:
+                        self.rooms.move(room, record.username, record.addr)
+                self._by_name[record.username] = record
+                self._by_addr[record.addr] = record
+                # the other registry owns its expiry now
+                self._tracker.forget(record.username)
+            self._published = (max(version, self._published[0]),
+                               dict(self._by_name))
+
+    def expire(self) -> List[PresenceRecord]:
+        """remove and return the users whose heartbeat expired"""
+        with self._lock:
+            expired = []
+            for username in self._tracker.pop_expired():
+                record = self._remove_locked(username)
+                if record is not None:
+                    expired.append(record)
+            if expired:
+                self._leave_rooms_locked(expired)
+                self._publish(left=expired)
+            return expired
+
+
+if __name__ == "__main__":
+    # 10k simulated users with 1 Hz heartbeats, one expiry check after every
+    # heartbeat like `Server.client_alive_check` does
+    users = [f"user{i}" for i in range(10000)]
+    sim_now = [0.0]
+
+    tracker = PresenceTracker(expire_seconds=3, clock=lambda: sim_now[0])
+    for user in users:
+        tracker.touch(user)
+    seconds = 5
+    start = time.perf_counter()
+    for second in range(seconds):
+        for i, user in enumerate(users):
+            sim_now[0] = second + i / len(users)
+            tracker.touch(user)
+            tracker.pop_expired()
+    cost = (time.perf_counter() - start) / seconds
+    print(f"tracker: {cost * 1000:.1f} ms per simulated second, "
+          f"online: {len(tracker)}")
+
+    # the former full scan of the user dict, only a slice of the heartbeats
+    # is run and the cost is extrapolated
+    last_seen = {user: 0.0 for user in users}
+    sample = 200
+    start = time.perf_counter()
+    for i, user in enumerate(users[:sample]):
+        now = i / len(users)
+        last_seen[user] = now
+        expired = [u for u, t in last_seen.items() if now - t > 3]
+    cost = (time.perf_counter() - start) / sample * len(users)
+    print(f"full scan: {cost * 1000:.1f} ms per simulated second "
+          f"(extrapolated from {sample} heartbeats)")
@@ -0,0 +1,88 @@
+"""
+    token buckets of the server: one per source addr, checked on every
+    datagram before it is decoded, one per user for its chat msgs
+"""
+import time
+from typing import *
+from threading import Lock
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+    __slots__ = ("tokens", "stamp", "notified")
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+        # when the sender was last told it is throttled
+        self.notified = float("-inf")
+
+
+class RateLimiter(object):
+    """
+        `rate` tokens per second up to `burst` per key, a spoofed flood of
+        sources can not grow it beyond `max_keys`, the least recently seen
+        key goes first and comes back with a full bucket
+
+        thread safe, the async engine pays an uncontended lock
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 65536,
+                 notify_interval: float = 1.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.notify_interval = notify_interval
+        self.clock = clock
+        self._lock = Lock()
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+        self.notified = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key: Hashable, cost: float = 1.0) -> bool:
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evicted += 1
+                bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            else:
+                self._buckets.move_to_end(key)
+                bucket.tokens = min(self.burst, bucket.tokens
+                                    + (now - bucket.stamp) * self.rate)
+                bucket.stamp = now
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                self.allowed += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def should_notify(self, key: Hashable) -> bool:
+        """at most once per `notify_interval` for a throttled `key`"""
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or now - bucket.notified < self.notify_interval:
+                return False
+            bucket.notified = now
+            self.notified += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "keys": len(self._buckets),
+                "allowed": self.allowed,
+                "throttled": self.throttled,
+                "notified": self.notified,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,426 @@
+"""
+    opt-in reliable, in order delivery over the datagrams of one peer,
+    negotiated at login by `NewUser.reliable`
+
+    reliable frame:
+        version(1B) | RELIABLE_TAG(1B) | flags(1B) | [seq varint]
+        | cumulative ack varint | sack block count varint
+        | (first - cumulative ack, length) varints per block
+        | [forward varint] | payload
+
+    a frame given up after `max_retries` is never sent again, till the peer
+    acks past it the frames carry FLAG_FORWARD and the highest seq the
+    sender no longer waits for, the receiver skips its missing ones
+
+    every frame acks what its sender received so far, acks ride on the
+    traffic, a bare ack (no FLAG_DATA) only goes out when nothing carried
+    the ack within `ack_delay`, or in place of the liveness ping
+
+    retransmission: per frame after the RFC 6298 timeout with exponential
+    backoff, or at once when a frame sent later was acked first (RACK)
+"""
+import time
+import logging
+from typing import *
+from threading import Lock
+from collections import OrderedDict, deque
+
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.errors import MsgDecodeError
+from littlechat.stuff.msg_boxes import WIRE_VERSION, put_varint, get_varint
+
+logger = logging.getLogger("server")
+
+RELIABLE_TAG = 0xfe
+FLAG_DATA = 0x01
+FLAG_FORWARD = 0x02
+MAX_SACK_BLOCKS = 4
+# the most a frame adds to its payload, with seqs below 2 ** 35
+MAX_HEADER_LENGTH = 3 + 5 + 5 + 1 + MAX_SACK_BLOCKS * (5 + 5) + 5
+
+
+def is_reliable_frame(data: bytes) -> bool:
+    return (len(data) >= 3 and data[0] == WIRE_VERSION
+            and data[1] == RELIABLE_TAG)
+
+
+class RttEstimator(object):
+    """smoothed rtt and retransmission timeout of RFC 6298, in seconds"""
+
+    def __init__(self, initial_rto: float = 0.5, min_rto: float = 0.05,
+                 max_rto: float = 3.0):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.rto = initial_rto
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto),
+                       self.max_rto)
+
+
+class _Outgoing(object):
+    __slots__ = ("seq", "payload", "first_sent", "last_sent", "retries",
+                 "lost")
+
+    def __init__(self, seq: int, payload: bytes, now: float):
+        self.seq = seq
+        self.payload = payload
+        self.first_sent = now
+        self.last_sent = now
+        self.retries = 0
+        self.lost = False
+
+
+class ReliableChannel(object):
+    """
+        both directions with one peer, thread safe
+
+        - `send` frames a payload, `receive` reads a frame back and returns
+          the payloads now in order
+        - `poll` must be called every few milliseconds, it returns the
+          frames due: retransmissions, payloads the window admits now and
+          bare acks
+    """
+
+    def __init__(self, window: Optional[int] = None,
+                 ack_delay: Optional[float] = None,
+                 max_retries: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window = window or MsgConfig.RELIABLE_WINDOW
+        self.ack_delay = (MsgConfig.RELIABLE_ACK_DELAY if ack_delay is None
+                          else ack_delay)
+        self.max_retries = max_retries or MsgConfig.RELIABLE_MAX_RETRIES
+        self.clock = clock
+        self.rtt = RttEstimator(min_rto=MsgConfig.RELIABLE_MIN_RTO,
+                                max_rto=MsgConfig.RELIABLE_MAX_RTO)
+        self._lock = Lock()
+        # sending side, in seq order
+        self._next_seq = 1
+        self._unacked: "OrderedDict[int, _Outgoing]" = OrderedDict()
+        # a slow peer holds at most OUTBOUND_QUEUE_DEPTH, the oldest go
+        self._waiting: Deque[bytes] = deque(
+            maxlen=MsgConfig.OUTBOUND_QUEUE_DEPTH)
+        # highest seq given up, and the cumulative ack of the peer, the
+        # frames carry the forward point till the peer acks past it
+        self._abandoned = 0
+        self._peer_received = 0
+        self._forward_sent = 0.0
+        # receiving side, every seq up to `_received` was delivered
+        self._received = 0
+        self._out_of_order: Dict[int, bytes] = {}
+        self._ack_due: Optional[float] = None
+
+        self.sent = 0
+        self.retransmitted = 0
+        self.duplicates = 0
+        self.given_up = 0
+        self.skipped = 0
+        self.overflowed = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._unacked)
+
+    # ---------------------------- frames ----------------------------
+
+    def _sack_blocks(self) -> List[Tuple[int, int]]:
+        """the lowest received ranges above the cumulative ack"""
+        blocks = []
+        for seq in sorted(self._out_of_order):
+            if blocks and seq == blocks[-1][1] + 1:
+                blocks[-1][1] = seq
+                continue
+            if len(blocks) == MAX_SACK_BLOCKS:
+                break
+            blocks.append([seq, seq])
+        return [(first, last) for first, last in blocks]
+
+    def _forward_locked(self) -> int:
+        """every seq up to it was acked or given up, 0: nothing to skip"""
+        if self._abandoned <= self._peer_received:
+            return 0
+        first_unacked = (next(iter(self._unacked)) if self._unacked
+                         else self._next_seq)
+        return max(first_unacked - 1, self._peer_received)
+
+    def _frame(self, seq: Optional[int], payload: bytes = b"") -> bytes:
+        forward = self._forward_locked()
+        flags = ((FLAG_DATA if seq is not None else 0)
+                 | (FLAG_FORWARD if forward else 0))
+        buf = bytearray([WIRE_VERSION, RELIABLE_TAG, flags])
+        if seq is not None:
+            put_varint(buf, seq)
+        put_varint(buf, self._received)
+        blocks = self._sack_blocks()
+        put_varint(buf, len(blocks))
+        for first, last in blocks:
+            put_varint(buf, first - self._received)
+            put_varint(buf, last - first + 1)
+        if forward:
+            put_varint(buf, forward)
+            self._forward_sent = self.clock()
+        # this frame carries the ack
+        self._ack_due = None
+        return bytes(buf) + payload
+
+    @staticmethod
+    def parse(frame: bytes, next_seq: Optional[int] = None
+              ) -> Tuple[Optional[int], int, List[Tuple[int, int]], int,
+                         bytes]:
+        """
+            (seq or None for a bare ack, cumulative ack, sack blocks,
+            forward point or 0, payload), the acks must be below `next_seq`,
+            the next seq sent to the peer, when given
+        """
+        if not is_reliable_frame(frame):
+            raise MsgDecodeError("not a reliable frame")
+        pos = 3
+        seq = None
+        if frame[2] & FLAG_DATA:
+            seq, pos = get_varint(frame, pos)
+        cumulative, pos = get_varint(frame, pos)
+        if next_seq is not None and cumulative >= next_seq:
+            raise MsgDecodeError(f"ack of {cumulative} never sent")
+        count, pos = get_varint(frame, pos)
+        if count > MAX_SACK_BLOCKS:
+            raise MsgDecodeError(f"too many sack blocks: {count}")
+        blocks = []
+        for _ in range(count):
+            offset, pos = get_varint(frame, pos)
+            length, pos = get_varint(frame, pos)
+            first = cumulative + offset
+            last = first + length - 1
+            if not length or (next_seq is not None and last >= next_seq):
+                raise MsgDecodeError(f"invalid sack block: {first}+{length}")
+            blocks.append((first, last))
+        forward = 0
+        if frame[2] & FLAG_FORWARD:
+            forward, pos = get_varint(frame, pos)
+        return seq, cumulative, blocks, forward, frame[pos:]
+
+    # ------------------------- sending side -------------------------
+
+    def send(self, payload: bytes) -> Optional[bytes]:
+        """the frame to send now, None if it waits for the window"""
+        with self._lock:
+            if self._waiting or len(self._unacked) >= self.window:
+                if len(self._waiting) == self._waiting.maxlen:
+                    self.overflowed += 1
+                self._waiting.append(payload)
+                return None
+            return self._send_locked(payload)
+
+    def _send_locked(self, payload: bytes) -> bytes:
+        seq = self._next_seq
+        self._next_seq += 1
+        self._unacked[seq] = _Outgoing(seq, payload, self.clock())
+        self.sent += 1
+        return self._frame(seq, payload)
+
+    def _on_ack_locked(self, cumulative: int,
+                       blocks: List[Tuple[int, int]]):
+        now = self.clock()
+        newest: Optional[_Outgoing] = None
+        self._peer_received = max(self._peer_received, cumulative)
+        acked = []
+        for seq in self._unacked:
+            if seq > cumulative:
+                break
+            acked.append(seq)
+        for first, last in blocks:
+            # the window bounds the walk, not the length sent by the peer
+            for seq in self._unacked:
+                if seq > last:
+                    break
+                if seq >= first:
+                    acked.append(seq)
+        for seq in acked:
+            outgoing = self._unacked.pop(seq, None)
+            if outgoing is None:
+                continue
+            if newest is None or outgoing.last_sent > newest.last_sent:
+                newest = outgoing
+        if newest is None:
+            return
+        # Karn: a retransmitted frame says nothing about the rtt
+        if not newest.retries:
+            self.rtt.sample(now - newest.first_sent)
+        # sent before the newest frame acked and not acked: lost, unless
+        # the reordering window still covers it
+        reorder_window = (self.rtt.srtt or 0) / 4
+        for outgoing in self._unacked.values():
+            if outgoing.last_sent + reorder_window < newest.last_sent:
+                outgoing.lost = True
+
+    # ------------------------ receiving side ------------------------
+
+    def _skip_to_locked(self, forward: int) -> List[bytes]:
+        """the peer gave up the frames up to `forward`, stop waiting"""
+        if forward <= self._received:
+            return []
+        if forward > self._received + self.window:
+            logger.warning(f"reliable forward to {forward} beyond the "
+                           f"window, ignored")
+            return []
+        delivered = []
+        for seq in range(self._received + 1, forward + 1):
+            payload = self._out_of_order.pop(seq, None)
+            if payload is None:
+                self.skipped += 1
+            else:
+                delivered.append(payload)
+        self._received = forward
+        # the ack tells the peer to stop sending the forward point
+        self._ack_due = self.clock()
+        return delivered
+
+    def receive(self, frame: bytes) -> List[bytes]:
+        """the payloads delivered in order by `frame`, maybe none"""
+        seq, cumulative, blocks, forward, payload = self.parse(
+            frame, self._next_seq)
+        with self._lock:
+            self._on_ack_locked(cumulative, blocks)
+            delivered = self._skip_to_locked(forward) if forward else []
+            if seq is None:
+                return self._deliver_locked(delivered)
+            now = self.clock()
+            if seq <= self._received or seq in self._out_of_order:
+                # our ack got lost, repeat it at once
+                self.duplicates += 1
+                self._ack_due = now
+                return self._deliver_locked(delivered)
+            if seq > self._received + self.window:
+                logger.warning(f"reliable frame {seq} beyond the window, "
+                               f"dropped")
+                return self._deliver_locked(delivered)
+            if seq != self._received + 1:
+                # a hole, the sack tells the peer at once
+                self._out_of_order[seq] = payload
+                self._ack_due = now
+                return self._deliver_locked(delivered)
+            delivered.append(payload)
+            self._received = seq
+            due = now + self.ack_delay
+            if self._ack_due is None or due < self._ack_due:
+                self._ack_due = due
+            return self._deliver_locked(delivered)
+
+    def _deliver_locked(self, delivered: List[bytes]) -> List[bytes]:
+        """`delivered` and the frames waiting behind them"""
+        while self._received + 1 in self._out_of_order:
+            self._received += 1
+            delivered.append(self._out_of_order.pop(self._received))
+        return delivered
+
+    # ----------------------------- timer -----------------------------
+
+    def poll(self) -> List[bytes]:
+        """the frames due now"""
+        with self._lock:
+            now = self.clock()
+            frames = []
+            given_up = []
+            for outgoing in self._unacked.values():
+                timeout = self.rtt.rto * (2 ** outgoing.retries)
+                if not outgoing.lost and now - outgoing.last_sent < timeout:
+                    continue
+                if outgoing.retries >= self.max_retries:
+                    given_up.append(outgoing.seq)
+                    continue
+                outgoing.retries += 1
+                outgoing.lost = False
+                outgoing.last_sent = now
+                self.retransmitted += 1
+                frames.append(self._frame(outgoing.seq, outgoing.payload))
+            for seq in given_up:
+                del self._unacked[seq]
+                self.given_up += 1
+                self._abandoned = max(self._abandoned, seq)
+                logger.warning(f"reliable frame {seq} given up after "
+                               f"{self.max_retries} retries")
+            while self._waiting and len(self._unacked) < self.window:
+                frames.append(self._send_locked(self._waiting.popleft()))
+            if self._ack_due is not None and now >= self._ack_due:
+                frames.append(self._frame(None))
+            elif (not frames and self._forward_locked()
+                  and now - self._forward_sent >= self.rtt.rto):
+                # nothing else carries the forward point to the peer
+                frames.append(self._frame(None))
+            return frames
+
+    def ack_frame(self) -> bytes:
+        """a bare ack, sent in place of the liveness ping"""
+        with self._lock:
+            return self._frame(None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sent": self.sent,
+                "retransmitted": self.retransmitted,
+                "duplicates": self.duplicates,
+                "given_up": self.given_up,
+                "skipped": self.skipped,
+                "overflowed": self.overflowed,
+                "waiting": len(self._waiting),
+                "in_flight": len(self._unacked),
+                "srtt": self.rtt.srtt,
+                "rto": self.rtt.rto,
+            }
+
+
+if __name__ == "__main__":
+    # a frame lost till given up, the ones sent after it still come
+    # through, and a sack of a huge range costs no more than the window
+    class _Clock(object):
+        now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    clock = _Clock()
+    sender = ReliableChannel(max_retries=2, clock=clock)
+    receiver = ReliableChannel(clock=clock)
+
+    def _exchange(frames: List[bytes], lost_seq: int = 0) -> List[bytes]:
+        delivered = []
+        for _ in range(100):
+            for frame in frames:
+                if not lost_seq or sender.parse(frame)[0] != lost_seq:
+                    delivered.extend(receiver.receive(frame))
+            for frame in receiver.poll():
+                sender.receive(frame)
+            clock.now += 0.05
+            frames = sender.poll()
+        return delivered
+
+    assert _exchange([sender.send(b"lost")], lost_seq=1) == []
+    assert sender.given_up == 1
+    frames = [sender.send(f"msg {i}".encode()) for i in range(300)]
+    delivered = _exchange([frame for frame in frames if frame])
+    assert delivered == [f"msg {i}".encode() for i in range(300)], \
+        len(delivered)
+    assert receiver.skipped == 1 and not sender.in_flight
+    print(f"1 frame given up, {len(delivered)} of 300 delivered after it")
+
+    # a sack block of 10 ** 8 seqs, refused before any walk
+    flood = ReliableChannel()
+    for i in range(flood.window):
+        flood.send(b"x")
+    buf = bytearray([WIRE_VERSION, RELIABLE_TAG, 0])
+    for value in (0, 1, 1, 10 ** 8):
+        put_varint(buf, value)
+    start = time.perf_counter()
+    try:
+        flood.receive(bytes(buf))
+    except MsgDecodeError as exp:
+        print(f"huge sack refused in "
+              f"{(time.perf_counter() - start) * 1e6:.0f} us: {exp}")
@@ -0,0 +1,131 @@
+from typing import *
+
+# every user joins it at login, version 0.0.7 clients only know this one
+DEFAULT_ROOM = "lobby"
+
+
+class Room(object):
+    __slots__ = ("name", "version", "members")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.version = 0
+        # username -> addr, replaced as a whole so the fan-out reads it
+        # without a lock
+        self.members: Dict[str, Tuple[str, int]] = {}
+
+
+class RoomIndex(object):
+    """
+        room -> members index of the online users, the member -> rooms side
+        is `PresenceRecord.rooms`
+
+        only changed under the lock of the `PresenceRegistry` owning it, the
+        fan-out reads `addrs` without any lock, its cost grows with the room,
+        not with the server population
+    """
+
+    def __init__(self):
+        self._rooms: Dict[str, Room] = {}
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def __contains__(self, room):
+        return room in self._rooms
+
+    def names(self) -> List[str]:
+        return list(self._rooms.keys())
+
+    def get_version(self, room: str) -> int:
+        found = self._rooms.get(room)
+        return found.version if found is not None else 0
+
+    def get_members(self, room: str) -> Dict[str, Tuple[str, int]]:
+        """a consistent view, must not be modified"""
+        found = self._rooms.get(room)
+        return found.members if found is not None else {}
+
+    def versioned_members(self, room: str
+                          ) -> Tuple[int, Dict[str, Tuple[str, int]]]:
+        found = self._rooms.get(room)
+        if found is None:
+            return 0, {}
+        # a change replaces the members, then the version, reading them in
+        # the other order pairs an old version with newer members at worst,
+        # the deltas in between then apply as no-ops
+        version = found.version
+        return version, found.members
+
+    def addrs(self, room: str, exclude_username: Optional[str] = None
+              ) -> List[Tuple[str, int]]:
+        members = self.get_members(room)
+        return [addr for username, addr in members.items()
+                if username != exclude_username]
+
+    def join(self, room: str, username: str, addr: Tuple[str, int],
+             version: int) -> bool:
+        """False if `username` is already a member"""
+        found = self._rooms.get(room)
+        if found is None:
+            found = self._rooms[room] = Room(room)
+        elif found.members.get(username) == addr:
+            return False
+        members = dict(found.members)
+        members[username] = addr
+        found.members = members
+        found.version = max(found.version, version)
+        return True
+
+    def leave(self, room: str, username: str, version: int) -> bool:
+        """False if `username` is not a member"""
+        found = self._rooms.get(room)
+        if found is None or username not in found.members:
+            return False
+        members = dict(found.members)
+        del members[username]
+        if not members:
+            del self._rooms[room]
+            return True
+        found.members = members
+        found.version = max(found.version, version)
+        return True
+
+    def move(self, room: str, username: str, addr: Tuple[str, int]):
+        """a member behind a new addr, not a change of the member list"""
+        found = self._rooms.get(room)
+        if found is None or username not in found.members:
+            return
+        members = dict(found.members)
+        members[username] = addr
+        found.members = members
+
+
+if __name__ == "__main__":
+    # fan-out cost of one msg, 10k users in 100 rooms vs all in one room
+    import time
+    import socket as soc
+    from littlechat.stuff.presence import PresenceRegistry
+
+    sink = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sender = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    payload = b"x" * 64
+    users = 10000
+    for rooms in (1, 100):
+        presence = PresenceRegistry(expire_seconds=60)
+        for i in range(users):
+            presence.add(f"user{i}", ("127.0.0.1", 20000 + i))
+            presence.join_room(f"user{i}", f"room{i % rooms}")
+        msgs = 20
+        start = time.perf_counter()
+        sent = 0
+        for i in range(msgs):
+            for _ in presence.rooms.addrs(f"room{i % rooms}", f"user{i}"):
+                # every user port is the sink, the kernel drops what the
+                # sink does not read
+                sender.sendto(payload, sink.getsockname())
+                sent += 1
+        cost = (time.perf_counter() - start) / msgs
+        print(f"{users} users in {rooms:>3} rooms: {sent // msgs:>5} "
+              f"datagrams, {cost * 1000:.2f} ms per msg")
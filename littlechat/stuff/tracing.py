@@ -0,0 +1,194 @@
+"""
+    end to end latency of the chat msgs: a sampled msg carries a trace id and
+    a timestamp per stage it went through, from the Enter of the sender to
+    the screen of every peer
+
+        input -> client_send -> server_recv -> server_fanout -> peer_recv
+              -> peer_show -> peer_draw
+
+    the time between two stamps goes to a histogram of that hop, the last
+    traces can be exported in the chrome trace event format, to open with
+    chrome://tracing or https://ui.perfetto.dev
+
+    a stamp is the wall clock of its host in micros, moved forward by the
+    monotonic clock, the hops between two hosts are as right as their clocks
+    agree, a negative one counts as 0
+
+    a msg not sampled costs a None check per stage
+"""
+import json
+import time
+import random
+from typing import *
+from threading import Lock
+from collections import deque
+
+from littlechat.stuff.config import MsgConfig
+from littlechat.utils.util_metrics import Histogram, MetricsRegistry
+
+STAGE_INPUT = 1
+STAGE_CLIENT_SEND = 2
+STAGE_SERVER_RECV = 3
+STAGE_SERVER_FANOUT = 4
+STAGE_PEER_RECV = 5
+STAGE_PEER_SHOW = 6
+STAGE_PEER_DRAW = 7
+
+STAGE_NAMES = {
+    STAGE_INPUT: "input",
+    STAGE_CLIENT_SEND: "client_send",
+    STAGE_SERVER_RECV: "server_recv",
+    STAGE_SERVER_FANOUT: "server_fanout",
+    STAGE_PEER_RECV: "peer_recv",
+    STAGE_PEER_SHOW: "peer_show",
+    STAGE_PEER_DRAW: "peer_draw",
+}
+
+# the process a stage happens in, for the trace export
+_SENDER, _SERVER, _RECEIVER = 1, 2, 3
+_STAGE_SIDES = {
+    STAGE_INPUT: _SENDER,
+    STAGE_CLIENT_SEND: _SENDER,
+    STAGE_SERVER_RECV: _SERVER,
+    STAGE_SERVER_FANOUT: _SERVER,
+    STAGE_PEER_RECV: _RECEIVER,
+    STAGE_PEER_SHOW: _RECEIVER,
+    STAGE_PEER_DRAW: _RECEIVER,
+}
+_SIDE_NAMES = {_SENDER: "sender", _SERVER: "server", _RECEIVER: "receiver"}
+
+# a trace off the wire carries at most this many stamps
+MAX_TRACE_STAMPS = 16
+
+_WALL_ANCHOR = time.time()
+_MONOTONIC_ANCHOR = time.monotonic()
+
+
+def now_micros() -> int:
+    """the wall clock in micros, never going back within the process"""
+    return int((_WALL_ANCHOR + time.monotonic() - _MONOTONIC_ANCHOR) * 1e6)
+
+
+def stage_name(stage: int) -> str:
+    return STAGE_NAMES.get(stage, f"stage{stage}")
+
+
+class Trace(object):
+    __slots__ = ("trace_id", "stamps")
+
+    def __init__(self, trace_id: int,
+                 stamps: Optional[List[Tuple[int, int]]] = None):
+        self.trace_id = trace_id
+        # (stage, micros), in the order they were taken
+        self.stamps: List[Tuple[int, int]] = stamps or []
+
+    def stamp(self, stage: int):
+        if len(self.stamps) < MAX_TRACE_STAMPS:
+            self.stamps.append((stage, now_micros()))
+
+    def hops(self) -> List[Tuple[str, int, int]]:
+        """(name, start micros, micros) of every hop"""
+        return [(f"{stage_name(stage)}->{stage_name(next_stage)}", start,
+                 max(0, end - start))
+                for (stage, start), (next_stage, end)
+                in zip(self.stamps, self.stamps[1:])]
+
+    def __repr__(self):
+        return f"Trace({self.trace_id:016x}, {self.stamps})"
+
+
+def stamp(msg, stage: int):
+    """stamp the trace of `msg` if it was sampled"""
+    trace = getattr(msg, "trace", None)
+    if trace is not None:
+        trace.stamp(stage)
+
+
+class Tracer(object):
+    """
+        samples the traces started here, aggregates every trace recorded, in
+        the histograms `trace_hop_seconds` of `registry`, keeps the last
+        `keep` for the export
+    """
+
+    def __init__(self, sample_rate: Optional[float] = None,
+                 keep: Optional[int] = None,
+                 registry: Optional[MetricsRegistry] = None):
+        self.sample_rate = (MsgConfig.TRACE_SAMPLE_RATE
+                            if sample_rate is None else sample_rate)
+        self.registry = registry or MetricsRegistry()
+        self._lock = Lock()
+        self._hops: Dict[str, Histogram] = {}
+        self._kept: Deque[Trace] = deque(
+            maxlen=MsgConfig.TRACE_KEEP if keep is None else keep)
+        self.started = 0
+        self.recorded = 0
+
+    def start(self, stage: int) -> Optional[Trace]:
+        """a new trace stamped at `stage`, None when not sampled"""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        self.started += 1
+        trace = Trace(random.getrandbits(64))
+        trace.stamp(stage)
+        return trace
+
+    def _hop(self, name: str) -> Histogram:
+        histogram = self._hops.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._hops.get(name)
+                if histogram is None:
+                    histogram = self._hops[name] = self.registry.histogram(
+                        "trace_hop_seconds",
+                        "seconds between two stages of a traced msg",
+                        hop=name)
+        return histogram
+
+    def record(self, trace: Optional[Trace]):
+        if trace is None or len(trace.stamps) < 2:
+            return
+        for name, _, micros in trace.hops():
+            self._hop(name).observe(micros / 1e6)
+        self._hop("total").observe(
+            max(0, trace.stamps[-1][1] - trace.stamps[0][1]) / 1e6)
+        self._kept.append(trace)
+        self.recorded += 1
+
+    def summary(self) -> Dict[str, dict]:
+        """count and mean millis per hop"""
+        summary = {}
+        for name, histogram in sorted(self._hops.items()):
+            count = sum(histogram.counts)
+            if count:
+                summary[name] = {
+                    "count": count,
+                    "mean_ms": round(histogram.sum / count * 1000, 3),
+                }
+        return summary
+
+    def chrome_events(self) -> List[dict]:
+        events = [{"name": "process_name", "ph": "M", "pid": side,
+                   "args": {"name": name}}
+                  for side, name in _SIDE_NAMES.items()]
+        for trace in list(self._kept):
+            trace_id = f"{trace.trace_id:016x}"
+            for (name, start, micros), (stage, _) in zip(trace.hops(),
+                                                         trace.stamps[1:]):
+                events.append({
+                    "name": name, "cat": "littlechat", "ph": "X",
+                    "ts": start, "dur": micros,
+                    "pid": _STAGE_SIDES.get(stage, _SERVER),
+                    # a row per trace, not a thread
+                    "tid": trace.trace_id & 0x7fffffff,
+                    "args": {"trace_id": trace_id},
+                })
+        return events
+
+    def export_chrome(self, path: str) -> int:
+        """write the kept traces to `path`, return how many"""
+        traces = len(self._kept)
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": self.chrome_events(),
+                       "displayTimeUnit": "ms"}, fp)
+        return traces
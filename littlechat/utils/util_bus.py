@@ -0,0 +1,55 @@
+"""
+    datagram bus between the processes of one host, every member binds a unix
+    datagram socket in a shared directory and publishes to all the others
+"""
+import os
+import logging
+import socket as soc
+from typing import *
+
+logger = logging.getLogger("server")
+
+
+class LocalBus(object):
+    MAX_EVENT_SIZE = 65535
+
+    def __init__(self, directory: str, member: int, members: int):
+        self.directory = directory
+        self.member = member
+        self.members = members
+        self._socket = soc.socket(soc.AF_UNIX, soc.SOCK_DGRAM)
+        self._socket.bind(self.get_path(member))
+        # publishing never waits for a slow member
+        self._send_socket = soc.socket(soc.AF_UNIX, soc.SOCK_DGRAM)
+        self._send_socket.setblocking(False)
+        self._peer_paths = [self.get_path(i) for i in range(members)
+                            if i != member]
+
+    def get_path(self, member: int) -> str:
+        return os.path.join(self.directory, f"member{member}.sock")
+
+    def publish(self, payload: bytes):
+        for path in self._peer_paths:
+            try:
+                self._send_socket.sendto(payload, path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # that member did not bind yet or is gone
+                logger.warning(f"bus member {path} is not reachable")
+            except BlockingIOError:
+                logger.error(f"bus member {path} is overloaded, event lost")
+
+    def recv(self, timeout: Optional[float] = 0.5) -> Optional[bytes]:
+        self._socket.settimeout(timeout)
+        try:
+            payload, _ = self._socket.recvfrom(self.MAX_EVENT_SIZE)
+            return payload
+        except soc.timeout:
+            return None
+
+    def close(self):
+        self._socket.close()
+        self._send_socket.close()
+        try:
+            os.unlink(self.get_path(self.member))
+        except FileNotFoundError:
+            pass
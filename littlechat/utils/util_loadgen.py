@@ -0,0 +1,440 @@
+"""
+    loopback load generator for the server engines, reports round trip
+    packets/sec and p50/p99 latency, the server cpu spent on the liveness
+    of idle clients, the time a client needs to catch up with a backlog and
+    how a client fares while others flood the server
+
+        python -m littlechat.utils.util_loadgen --senders 4 --duration 3
+"""
+import os
+import time
+import select
+import argparse
+import socket as soc
+import multiprocessing as mp
+from typing import *
+
+from littlechat.stuff.msg_boxes import (ConCheck, NewUser, UserHeartbeat,
+                                        UserMsg, HistoryRequest, HistoryBatch,
+                                        PING_PAYLOAD, get_codec)
+from littlechat.stuff.compression import PayloadCompressor
+from littlechat.stuff.config import MsgConfig
+from littlechat.utils.util_udp import mmsg_supported
+
+LOOPBACK = "127.0.0.1"
+
+
+def _run_server(port, engine, server_kwargs):
+    from littlechat.server import get_server_class
+    from littlechat.workers import serve_workers
+
+    workers = server_kwargs.pop("workers", 1)
+    if workers > 1:
+        serve_workers(port, workers, engine=engine, **server_kwargs)
+        return
+    get_server_class(engine)(port=port, **server_kwargs).serve()
+
+
+def start_server_process(port, engine="thread", **server_kwargs
+                         ) -> mp.Process:
+    # a daemon process can not start the worker processes
+    daemon = server_kwargs.get("workers", 1) <= 1
+    process = mp.Process(target=_run_server,
+                         args=(port, engine, server_kwargs), daemon=daemon)
+    process.start()
+    wait_server_ready(port)
+    return process
+
+
+def wait_server_ready(port, timeout=5.0):
+    codec = get_codec()
+    sock = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.sendto(codec.encode(ConCheck()), (LOOPBACK, port))
+            try:
+                sock.recvfrom(65535)
+                return
+            except soc.timeout:
+                continue
+        raise TimeoutError(f"server on port {port} is not ready")
+    finally:
+        sock.close()
+
+
+def _concheck_sender(port, duration, window, result_q):
+    """
+        keep `window` ConCheck in flight, the server echoes them back, the
+        msg text carries a sequence number to measure every round trip
+    """
+    codec = get_codec()
+    probe = ConCheck()
+    addr = (LOOPBACK, port)
+    sock = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    sock.setblocking(False)
+    in_flight: Dict[str, float] = {}
+    latencies = []
+    seq = 0
+
+    def send_probe():
+        nonlocal seq
+        seq += 1
+        probe.msg = str(seq)
+        payload = codec.encode(probe)
+        in_flight[probe.msg] = time.perf_counter()
+        sock.sendto(payload, addr)
+
+    deadline = time.perf_counter() + duration
+    for _ in range(window):
+        send_probe()
+    while time.perf_counter() < deadline:
+        readable, _, _ = select.select([sock], [], [], 0.2)
+        if not readable:
+            # lost packets, refill the window
+            in_flight.clear()
+            for _ in range(window):
+                send_probe()
+            continue
+        while True:
+            try:
+                data, _ = sock.recvfrom(65535)
+            except BlockingIOError:
+                break
+            sent_at = in_flight.pop(codec.decode(data).msg, None)
+            if sent_at is not None:
+                latencies.append(time.perf_counter() - sent_at)
+            send_probe()
+    sock.close()
+    result_q.put(latencies)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def concheck_load(port, senders=4, duration=3.0, window=32
+                  ) -> Tuple[float, List[float]]:
+    """
+        round trip packets per second of `senders` parallel processes and
+        every measured round trip latency in seconds
+    """
+    result_q = mp.Queue()
+    processes = [mp.Process(target=_concheck_sender,
+                            args=(port, duration, window, result_q))
+                 for _ in range(senders)]
+    for process in processes:
+        process.start()
+    latencies = []
+    for _ in processes:
+        latencies.extend(result_q.get())
+    for process in processes:
+        process.join()
+    return len(latencies) / duration, latencies
+
+
+def bench_server(port, senders, duration, engine="thread", **server_kwargs
+                 ) -> Tuple[float, List[float]]:
+    server_process = start_server_process(port, engine=engine,
+                                          **server_kwargs)
+    try:
+        return concheck_load(port, senders=senders, duration=duration)
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+
+def idle_clients_cost(port, clients=2000, seconds=3,
+                      heartbeat_interval: float = 0) -> float:
+    """
+        server cpu seconds per simulated second to keep `clients` idle users
+        online, run in process on the datagram handler of the async engine
+
+        `heartbeat_interval` 0 is the legacy full heartbeat every second,
+        otherwise the negotiated ping every interval
+    """
+    from littlechat.async_server import AsyncServer
+
+    srv = AsyncServer(port=port)
+    codec = get_codec()
+    addrs = [(LOOPBACK, 30000 + i) for i in range(clients)]
+    for i, addr in enumerate(addrs):
+        srv.handle_datagram(codec.encode(NewUser(
+            username=f"user{i}", heartbeat_interval=heartbeat_interval)),
+            addr)
+    heartbeats = [codec.encode(UserHeartbeat(username=f"user{i}"))
+                  for i in range(clients)]
+
+    start = time.process_time()
+    for second in range(seconds):
+        if not heartbeat_interval:
+            for payload, addr in zip(heartbeats, addrs):
+                srv.handle_datagram(payload, addr)
+            continue
+        # the pings of one interval are spread over its seconds
+        share = len(addrs) / heartbeat_interval
+        for addr in addrs[int(second % heartbeat_interval * share):
+                          int((second % heartbeat_interval + 1) * share)]:
+            srv.handle_datagram(PING_PAYLOAD, addr)
+    cost = (time.process_time() - start) / seconds
+    srv.close()
+    return cost
+
+
+def _flooder(port, duration, payload, rate):
+    """send `payload` from one addr, `rate` datagrams per second"""
+    sock = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    sock.setblocking(False)
+    started = time.perf_counter()
+    sent = 0
+    while time.perf_counter() < started + duration:
+        # bursts of 100, the same load whatever the cpu left to the server
+        for _ in range(100):
+            try:
+                sock.sendto(payload, (LOOPBACK, port))
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+        sent += 100
+        time.sleep(max(0.0, started + sent / rate - time.perf_counter()))
+    sock.close()
+
+
+def flood_responsiveness(port, flooders=2, duration=3.0, engine="thread",
+                         rate=15000, interval=0.01
+                         ) -> Tuple[float, List[float]]:
+    """
+        share of the `ConCheck`s a client sends every `interval` answered
+        within 0.2 s, and their round trips in seconds, while `flooders`
+        processes send `rate` invalid datagrams per second each
+    """
+    server_process = start_server_process(port, engine)
+    # looks like a pickle, fails to decode, answered with an `ExceptionMsg`
+    payload = b"\x80\x04" + b"x" * 512
+    processes = [mp.Process(target=_flooder,
+                            args=(port, duration, payload, rate))
+                 for _ in range(flooders)]
+    codec = get_codec()
+    probe = ConCheck()
+    sock = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    latencies = []
+    sent = 0
+    try:
+        for process in processes:
+            process.start()
+        # the flood goes first
+        time.sleep(0.2)
+        deadline = time.perf_counter() + duration - 0.4
+        while time.perf_counter() < deadline:
+            sent += 1
+            probe.msg = str(sent)
+            started = time.perf_counter()
+            sock.sendto(codec.encode(probe), (LOOPBACK, port))
+            timeout_at = started + 0.2
+            while time.perf_counter() < timeout_at:
+                sock.settimeout(max(0.001, timeout_at - time.perf_counter()))
+                try:
+                    data, _ = sock.recvfrom(65535)
+                except soc.timeout:
+                    break
+                if codec.decode(data).msg == probe.msg:
+                    latencies.append(time.perf_counter() - started)
+                    break
+            time.sleep(max(0.0, started + interval - time.perf_counter()))
+    finally:
+        sock.close()
+        for process in processes:
+            process.join()
+        server_process.terminate()
+        server_process.join()
+    return len(latencies) / max(1, sent), latencies
+
+
+def _login(port, username) -> soc.socket:
+    codec = get_codec()
+    sock = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+    sock.settimeout(2)
+    sock.sendto(codec.encode(NewUser(username=username,
+                                     heartbeat_interval=30)),
+                (LOOPBACK, port))
+    sock.recvfrom(65535)
+    return sock
+
+
+def _fetch_history(sock, port, username, since_seq, page, latest=False
+                   ) -> Tuple[int, List[HistoryBatch]]:
+    """page through the history after `since_seq`, return the last seq"""
+    codec = get_codec()
+    compressor = PayloadCompressor()
+    batches = []
+    sock.sendto(codec.encode(HistoryRequest(username, since_seq, page,
+                                            latest=latest)),
+                (LOOPBACK, port))
+    while True:
+        data, _ = sock.recvfrom(65535)
+        msg_box = codec.decode(compressor.unpack(data))
+        if not isinstance(msg_box, HistoryBatch):
+            continue
+        batches.append(msg_box)
+        if not msg_box.done:
+            continue
+        if msg_box.last_seq >= msg_box.head_seq:
+            return msg_box.last_seq, batches
+        sock.sendto(codec.encode(HistoryRequest(username, msg_box.last_seq,
+                                                page)), (LOOPBACK, port))
+
+
+def history_catch_up(port, backlog=10000) -> Tuple[float, float, float]:
+    """
+        seconds for a client to fetch a backlog of `backlog` msgs once logged
+        in again, then to render them into a `MainPage` in bulk, and one by
+        one with a render of the msg list each, as before the history
+        (extrapolated)
+    """
+    from littlechat.front.main_page import MainPage
+
+    server_process = start_server_process(port)
+    try:
+        codec = get_codec()
+        writer = _login(port, "writer")
+        reader = _login(port, "reader")
+        head_seq, _ = _fetch_history(reader, port, "reader", 0, 1,
+                                     latest=True)
+        reader.settimeout(1)
+        for block in range(0, backlog, 100):
+            for i in range(block, min(block + 100, backlog)):
+                writer.sendto(codec.encode(UserMsg("writer",
+                                                   f"backlog msg {i}")),
+                              (LOOPBACK, port))
+            # paced by the fan-out to the reader, a burst of the whole
+            # backlog would overflow the receive buffer of the server
+            try:
+                for _ in range(block, min(block + 100, backlog)):
+                    reader.recvfrom(65535)
+            except soc.timeout:
+                pass
+
+        start = time.perf_counter()
+        reader = _login(port, "reader2")
+        last_seq, batches = _fetch_history(reader, port, "reader2", head_seq,
+                                           MsgConfig.HISTORY_PAGE)
+        msgs = []
+        for batch in batches:
+            for seq, payload in batch.records:
+                msg_box = codec.decode(payload)
+                msg_box.seq = seq
+                msgs.append(msg_box)
+        fetch_cost = time.perf_counter() - start
+        if len(msgs) < backlog:
+            print(f"only {len(msgs)} of {backlog} msgs logged")
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    size = (120, 40)
+    page = MainPage("reader2")
+    start = time.perf_counter()
+    page.show_history(msgs)
+    page.msg_list_line.render(size)
+    bulk_cost = time.perf_counter() - start
+    page.close()
+
+    # far too slow for the whole backlog, extrapolated from the first msgs,
+    # an underestimate as every render costs more with a longer list
+    sample = msgs[:500]
+    page = MainPage("reader2")
+    start = time.perf_counter()
+    for msg_box in sample:
+        page.show_msg(msg_box, is_self=False)
+        page.msg_list_line.render(size)
+    one_by_one_cost = ((time.perf_counter() - start) / max(1, len(sample))
+                       * len(msgs))
+    page.close()
+    return fetch_cost, bulk_cost, one_by_one_cost
+
+
+BENCH_CASES = [
+    ("thread", {}),
+    ("thread", {"batch_io": True}),
+    ("async", {}),
+]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sp", "--server-port", default=23898, type=int)
+    parser.add_argument("--senders", default=4, type=int)
+    parser.add_argument("--duration", default=3.0, type=float)
+    parser.add_argument("--idle-clients", default=2000, type=int)
+    parser.add_argument("--backlog", default=10000, type=int)
+    parser.add_argument("--max-workers", default=os.cpu_count() or 1,
+                        type=int)
+    parser.add_argument("--flooders", default=2, type=int)
+    args = parser.parse_args(argv)
+    # the load of the senders is the point, not a flood to throttle
+    MsgConfig.RATE_LIMIT = False
+
+    print(f"recvmmsg/sendmmsg available: {mmsg_supported()}")
+    print(f"{'engine':<8}{'options':<20}{'packets/sec':>12}"
+          f"{'p50 ms':>10}{'p99 ms':>10}")
+    for engine, server_kwargs in BENCH_CASES:
+        pps, latencies = bench_server(args.server_port, args.senders,
+                                      args.duration, engine=engine,
+                                      **server_kwargs)
+        print(f"{engine:<8}{str(server_kwargs):<20}{pps:>12.0f}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}"
+              f"{percentile(latencies, 99) * 1000:>10.2f}")
+
+    print(f"\nSO_REUSEPORT workers, {os.cpu_count()} cpus")
+    print(f"{'workers':<8}{'packets/sec':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    base_pps = 0.0
+    for workers in range(1, args.max_workers + 1):
+        # one sender process per worker at least, the kernel spreads them
+        # by their source port
+        pps, latencies = bench_server(args.server_port,
+                                      max(args.senders, workers * 2),
+                                      args.duration, workers=workers)
+        base_pps = base_pps or pps
+        print(f"{workers:<8}{pps:>12.0f}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}"
+              f"{percentile(latencies, 99) * 1000:>10.2f}"
+              f"  x{pps / base_pps:.2f}")
+
+    print(f"\nserver cpu per simulated second, "
+          f"{args.idle_clients} idle clients")
+    for label, interval in (("heartbeat 1s", 0),
+                            (f"ping {MsgConfig.HEARTBEAT_INTERVAL}s",
+                             MsgConfig.HEARTBEAT_INTERVAL)):
+        cost = idle_clients_cost(args.server_port, clients=args.idle_clients,
+                                 heartbeat_interval=interval)
+        print(f"{label:<16}{cost * 1000:>8.2f} ms, "
+              f"{cost / args.idle_clients * 1e6:.2f} us per client")
+
+    fetch_cost, bulk_cost, one_by_one_cost = history_catch_up(
+        args.server_port, backlog=args.backlog)
+    print(f"\ncatch up with {args.backlog} missed msgs: fetched in "
+          f"{fetch_cost * 1000:.0f} ms, rendered in bulk in "
+          f"{bulk_cost * 1000:.0f} ms, one by one in "
+          f"{one_by_one_cost * 1000:.0f} ms (extrapolated)")
+
+    print(f"\na client among {args.flooders} flooders of invalid datagrams")
+    print(f"{'engine':<8}{'rate limit':<12}{'answered':>10}{'p50 ms':>10}"
+          f"{'p99 ms':>10}")
+    for engine in ("thread", "async"):
+        for rate_limit in (False, True):
+            MsgConfig.RATE_LIMIT = rate_limit
+            answered, latencies = flood_responsiveness(
+                args.server_port, flooders=args.flooders,
+                duration=args.duration, engine=engine)
+            print(f"{engine:<8}{str(rate_limit):<12}{answered:>10.0%}"
+                  f"{percentile(latencies, 50) * 1000:>10.2f}"
+                  f"{percentile(latencies, 99) * 1000:>10.2f}")
+    MsgConfig.RATE_LIMIT = False
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,123 @@
 import sys
+import copy
+import json
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from typing import *
+from queue import Queue, Full
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from littlechat.utils.util_path import get_log_path
+from littlechat.stuff.config import MsgConfig
+
+# logger name -> the listener writing its records
+_listeners: Dict[str, QueueListener] = {}
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """hands the records to a listener thread, drops them when it lags"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+            what the listener needs, the msg merged with its args and the
+            traceback as text, formatted by the handlers behind it
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """
+        per call site, lets the first record at or below `level` through,
+        then one of every `every`, for the logs written once per msg
+    """
+
+    def __init__(self, every: int, level: int = logging.DEBUG):
+        super().__init__()
+        self.every = every
+        self.level = level
+        self.sampled_out = 0
+        self._seen: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level or self.every <= 1:
+            return True
+        site = (record.pathname, record.lineno)
+        seen = self._seen.get(site, 0)
+        self._seen[site] = seen + 1
+        if seen % self.every:
+            self.sampled_out += 1
+            return False
+        record.sample_every = self.every
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        sample_every = getattr(record, "sample_every", None)
+        if sample_every:
+            entry["sample_every"] = sample_every
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _stop_listener(name: str):
+    listener = _listeners.pop(name, None)
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def _stop_listeners():
+    for name in list(_listeners):
+        _stop_listener(name)
+
+
+atexit.register(_stop_listeners)
 
 
 def set_scripts_logging(_file_, logger=None, level=logging.DEBUG,
-                        console_log=True, file_log=True, file_mode="w"):
+                        console_log=True, file_log=True, file_mode="w",
+                        async_log: Optional[bool] = None,
+                        json_format: Optional[bool] = None,
+                        max_bytes: Optional[int] = None,
+                        backup_count: Optional[int] = None,
+                        sample_every: Optional[int] = None,
+                        sample_level: Optional[Union[int, str]] = None):
     """
         为了是脚本log安装正确，请把此函数的调用放在脚本的最上面， 例：
             from commons import set_scripts_logging
@@ -14,11 +126,32 @@ def set_scripts_logging(_file_, logger=None, level=logging.DEBUG,
             import logging
             import ..others..
 
+        the options left None come from MsgConfig.LOG_*
+
     @_file_:
     @level:
+    @async_log: the handlers run in a listener thread, a log call only
+                queues the record
+    @json_format: the file log as json lines
+    @max_bytes: the log file is rotated beyond it, 0: never
+    @backup_count: rotated files kept
+    @sample_every: one of every `sample_every` records at or below
+                   `sample_level` per call site is logged
     @return:
     """
     log_filename = get_log_path(_file_)
+    async_log = MsgConfig.LOG_ASYNC if async_log is None else async_log
+    json_format = MsgConfig.LOG_JSON if json_format is None else json_format
+    max_bytes = MsgConfig.LOG_MAX_BYTES if max_bytes is None else max_bytes
+    backup_count = (MsgConfig.LOG_BACKUP_COUNT if backup_count is None
+                    else backup_count)
+    sample_every = (MsgConfig.LOG_SAMPLE_EVERY if sample_every is None
+                    else sample_every)
+    sample_level = (MsgConfig.LOG_SAMPLE_LEVEL if sample_level is None
+                    else sample_level)
+    if isinstance(sample_level, str):
+        sample_level = logging.getLevelName(sample_level.upper())
+
     if logger is None:
         logger = logging.getLogger()
     # 解除第三方 logger 广播日志
@@ -27,29 +160,110 @@ def set_scripts_logging(_file_, logger=None, level=logging.DEBUG,
                 and log_name != logger.name
                 and _log.parent.name == logger.name):
             _log.propagate = False
+    _stop_listener(logger.name)
     if logger.handlers:  # 防止有多个 handler
         logger.handlers.clear()
+    for _filter in list(logger.filters):
+        if isinstance(_filter, SamplingFilter):
+            logger.removeFilter(_filter)
+
+    handlers = []
     if console_log:
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setFormatter(
             logging.Formatter("%(asctime)s [line:%(lineno)d] %(levelname)s "
                               "%(message)s"))
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
 
     if file_log:
-        file_handler = logging.FileHandler(filename=log_filename,
-                                           mode=file_mode)
-        file_handler.setFormatter(logging.Formatter(
-            ("%(asctime)s %(filename)s [line:%(lineno)d] %(levelname)s %(message)s")
-        ))
+        if file_mode == "w" and max_bytes:
+            # a rotating handler always appends
+            open(log_filename, "w").close()
+        file_handler = RotatingFileHandler(filename=log_filename,
+                                           mode=file_mode,
+                                           maxBytes=max_bytes,
+                                           backupCount=backup_count,
+                                           encoding="utf-8")
+        if json_format:
+            file_handler.setFormatter(JsonFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter(
+                "%(asctime)s %(filename)s [line:%(lineno)d] %(levelname)s "
+                "%(message)s"))
+        handlers.append(file_handler)
 
-        logger.addHandler(file_handler)
+    if async_log and handlers:
+        queue_handler = NonBlockingQueueHandler(
+            Queue(MsgConfig.LOG_QUEUE_SIZE))
+        listener = QueueListener(queue_handler.queue, *handlers,
+                                 respect_handler_level=True)
+        listener.start()
+        _listeners[logger.name] = listener
+        logger.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    if sample_every > 1:
+        logger.addFilter(SamplingFilter(sample_every, sample_level))
 
     logger.setLevel(level=level)
     logger.info("\nLog_filename: {}".format(log_filename))
     return log_filename
 
 
+def share_scripts_logging(logger: logging.Logger):
+    """
+        before forking processes which log to `logger`: its records go
+        through a process safe queue to the listener of this process, a
+        single writer rotates the file
+    """
+    import multiprocessing as mp
+    from multiprocessing.util import Finalize
+
+    listener = _listeners.get(logger.name)
+    if listener is None:
+        return
+    queue_handler = next(handler for handler in logger.handlers
+                         if isinstance(handler, NonBlockingQueueHandler))
+    listener.stop()
+    queue_handler.queue = mp.Queue(MsgConfig.LOG_QUEUE_SIZE)
+    listener = QueueListener(queue_handler.queue, *listener.handlers,
+                             respect_handler_level=True)
+    listener.start()
+    _listeners[logger.name] = listener
+    # before multiprocessing closes the queue at exit
+    Finalize(listener, _stop_listener, args=(logger.name,), exitpriority=20)
+
+
+def get_logging_stats(logger: logging.Logger) -> dict:
+    stats = {"dropped": 0, "sampled_out": 0}
+    for handler in logger.handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            stats["dropped"] += handler.dropped
+    for _filter in logger.filters:
+        if isinstance(_filter, SamplingFilter):
+            stats["sampled_out"] += _filter.sampled_out
+    return stats
+
+
 if __name__ == "__main__":
+    import time
+
+    # time a log call holds the calling thread, synchronous vs queued
     test_logger = logging.getLogger("test")
-    set_scripts_logging(__file__, logger=test_logger)
+    for async_log in (False, True):
+        set_scripts_logging(__file__, logger=test_logger, console_log=False,
+                            async_log=async_log, sample_every=1)
+        costs = []
+        for i in range(5000):
+            start = time.perf_counter()
+            test_logger.info(f"msg {i} from 127.0.0.1:40000")
+            costs.append(time.perf_counter() - start)
+            if not i % 5:
+                # the receive loop waiting for datagrams
+                time.sleep(0.0005)
+        costs.sort()
+        print(f"{'queued' if async_log else 'synchronous':<12} "
+              f"p50 {costs[len(costs) // 2] * 1e6:.1f} us, "
+              f"p99 {costs[int(len(costs) * 0.99)] * 1e6:.1f} us")
+    _stop_listeners()
@@ -0,0 +1,267 @@
+"""
+    udp proxy in front of a server which loses, delays and reorders the
+    datagrams of both directions, to try the reliable delivery of
+    `littlechat.stuff.reliable` on loopback
+
+        python -m littlechat.utils.util_lossy_proxy --loss 0.1 --reorder 0.1
+"""
+import time
+import heapq
+import random
+import argparse
+import selectors
+import itertools
+import socket as soc
+from typing import *
+
+from littlechat.stuff.msg_boxes import NewUser, UserMsg, get_codec
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.reliable import ReliableChannel, is_reliable_frame
+from littlechat.utils.util_thread import new_thread_daemon
+
+LOOPBACK = "127.0.0.1"
+
+
+class LossyProxy(object):
+    """
+        every client gets its own upstream socket, like behind a NAT
+
+        - `loss`: share of the datagrams dropped
+        - `delay`: seconds every datagram is held
+        - `reorder`: share of the datagrams held `reorder_delay` seconds
+          more, so the next ones overtake them
+    """
+
+    def __init__(self, target: Tuple[str, int], port: int = 0,
+                 loss: float = 0.0, delay: float = 0.0,
+                 reorder: float = 0.0, reorder_delay: float = 0.01,
+                 seed: Optional[int] = None):
+        self.target = target
+        self.loss = loss
+        self.delay = delay
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self._random = random.Random(seed)
+        self.listen_socket = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+        self.listen_socket.bind((LOOPBACK, port))
+        self.addr = self.listen_socket.getsockname()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.listen_socket, selectors.EVENT_READ)
+        # client addr -> upstream socket, upstream socket -> client addr
+        self._upstreams: Dict[Tuple, soc.socket] = {}
+        self._clients: Dict[soc.socket, Tuple] = {}
+        # (due, order, socket, datagram, destination)
+        self._scheduled: List[tuple] = []
+        self._order = itertools.count()
+        self.is_close = False
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def _upstream_of(self, client_addr: Tuple) -> soc.socket:
+        upstream = self._upstreams.get(client_addr)
+        if upstream is None:
+            upstream = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+            upstream.bind((LOOPBACK, 0))
+            self._upstreams[client_addr] = upstream
+            self._clients[upstream] = client_addr
+            self._selector.register(upstream, selectors.EVENT_READ)
+        return upstream
+
+    def _schedule(self, sock: soc.socket, datagram: bytes, dst: Tuple):
+        if self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        due = time.monotonic() + self.delay
+        if self._random.random() < self.reorder:
+            due += self.reorder_delay
+            self.reordered += 1
+        heapq.heappush(self._scheduled,
+                       (due, next(self._order), sock, datagram, dst))
+
+    def _flush_due(self) -> Optional[float]:
+        """send what is due, return the seconds until the next one"""
+        now = time.monotonic()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            _, _, sock, datagram, dst = heapq.heappop(self._scheduled)
+            try:
+                sock.sendto(datagram, dst)
+                self.forwarded += 1
+            except OSError:
+                pass
+        if not self._scheduled:
+            return None
+        return self._scheduled[0][0] - now
+
+    @new_thread_daemon
+    def start(self):
+        while not self.is_close:
+            timeout = self._flush_due()
+            for key, _ in self._selector.select(
+                    0.1 if timeout is None else timeout):
+                sock = key.fileobj
+                try:
+                    datagram, addr = sock.recvfrom(65535)
+                except OSError:
+                    continue
+                if sock is self.listen_socket:
+                    upstream = self._upstream_of(addr)
+                    self._schedule(upstream, datagram, self.target)
+                else:
+                    self._schedule(self.listen_socket, datagram,
+                                   self._clients[sock])
+
+    def close(self):
+        self.is_close = True
+        time.sleep(0.2)
+        self._selector.close()
+        for sock in [self.listen_socket, *self._clients]:
+            sock.close()
+
+
+class _TestUser(object):
+    """a raw client of the harness, polled by its owner"""
+
+    def __init__(self, username: str, server: Tuple[str, int],
+                 reliable: bool):
+        self.username = username
+        self.server = server
+        self.codec = get_codec()
+        self.sock = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+        self.sock.bind((LOOPBACK, 0))
+        self.channel: Optional[ReliableChannel] = None
+        self.sock.settimeout(2)
+        self.sock.sendto(self.codec.encode(NewUser(
+            username, heartbeat_interval=MsgConfig.HEARTBEAT_INTERVAL,
+            reliable=reliable)), server)
+        rsp = self.codec.decode(self.sock.recvfrom(65535)[0])
+        if reliable and not getattr(rsp, "reliable", False):
+            raise RuntimeError(f"reliability refused to {username}")
+        if reliable:
+            self.channel = ReliableChannel()
+        self.sock.setblocking(False)
+
+    def send(self, msg: UserMsg):
+        payload = self.codec.encode(msg)
+        if self.channel is not None:
+            payload = self.channel.send(payload)
+            if payload is None:
+                return
+        self.sock.sendto(payload, self.server)
+
+    def poll(self) -> List[object]:
+        """the msg boxes received, then the frames due"""
+        msg_boxes = []
+        while True:
+            try:
+                datagram, _ = self.sock.recvfrom(65535)
+            except BlockingIOError:
+                break
+            if is_reliable_frame(datagram):
+                payloads = (self.channel.receive(datagram)
+                            if self.channel is not None else [])
+            else:
+                payloads = [datagram]
+            msg_boxes.extend(self.codec.decode(payload)
+                             for payload in payloads)
+        if self.channel is not None:
+            for frame in self.channel.poll():
+                self.sock.sendto(frame, self.server)
+        return msg_boxes
+
+    def close(self):
+        self.sock.close()
+
+
+def run_trial(server_port: int, msgs: int, reliable: bool, loss: float,
+              reorder: float, delay: float, interval: float = 0.002,
+              seed: int = 7) -> dict:
+    """one user sends `msgs` to another through the proxy"""
+    proxy = LossyProxy((LOOPBACK, server_port), delay=delay,
+                       reorder_delay=max(0.01, delay * 2), seed=seed)
+    proxy.start()
+    mode = "reliable" if reliable else "plain"
+    sender = _TestUser(f"sender-{mode}", proxy.addr, reliable)
+    receiver = _TestUser(f"receiver-{mode}", proxy.addr, reliable)
+    # the logins went through unharmed, the chat does not
+    proxy.loss, proxy.reorder = loss, reorder
+
+    sent_at: Dict[int, float] = {}
+    received: List[int] = []
+    latencies = []
+    next_send = time.monotonic()
+    deadline = None
+    while True:
+        now = time.monotonic()
+        if len(sent_at) < msgs and now >= next_send:
+            sent_at[len(sent_at)] = time.perf_counter()
+            sender.send(UserMsg(sender.username, str(len(sent_at) - 1)))
+            next_send = now + interval
+        elif len(sent_at) == msgs and deadline is None:
+            deadline = now + 5
+        sender.poll()
+        for msg_box in receiver.poll():
+            if isinstance(msg_box, UserMsg):
+                index = int(msg_box.msg)
+                received.append(index)
+                latencies.append(time.perf_counter() - sent_at[index])
+        if len(received) == msgs or (deadline and now > deadline):
+            break
+        time.sleep(MsgConfig.RELIABLE_TICK / 2)
+
+    latencies.sort()
+    stats = sender.channel.stats() if sender.channel else {}
+    result = {
+        "delivered": len(received),
+        "in_order": received == sorted(received),
+        "complete": received == list(range(msgs)),
+        "retransmitted": stats.get("retransmitted", 0),
+        "dropped_by_proxy": proxy.dropped,
+        "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+    }
+    sender.close()
+    receiver.close()
+    proxy.close()
+    return result
+
+
+def main(argv: Optional[List[str]] = None):
+    from littlechat.utils.util_loadgen import start_server_process
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", default=47300, type=int)
+    parser.add_argument("--engine", default="thread", type=str)
+    parser.add_argument("--msgs", default=500, type=int)
+    parser.add_argument("--loss", default=0.1, type=float)
+    parser.add_argument("--reorder", default=0.1, type=float)
+    parser.add_argument("--delay", default=0.005, type=float,
+                        help="one way, seconds")
+    args = parser.parse_args(argv)
+
+    # no history files for a test server
+    MsgConfig.HISTORY = False
+    server_process = start_server_process(args.port, args.engine)
+    try:
+        print(f"{args.msgs} msgs, loss {args.loss:.0%} and reorder "
+              f"{args.reorder:.0%} each way, {args.delay * 1000:.0f} ms "
+              f"one way, {args.engine} server")
+        print(f"{'mode':<10}{'delivered':>10}{'in order':>10}"
+              f"{'complete':>10}{'resent':>8}{'p50 ms':>8}{'p99 ms':>8}")
+        for reliable in (False, True):
+            result = run_trial(args.port, args.msgs, reliable, args.loss,
+                               args.reorder, args.delay)
+            print(f"{'reliable' if reliable else 'plain':<10}"
+                  f"{result['delivered']:>10}{str(result['in_order']):>10}"
+                  f"{str(result['complete']):>10}"
+                  f"{result['retransmitted']:>8}"
+                  f"{result['p50'] * 1000:>8.1f}"
+                  f"{result['p99'] * 1000:>8.1f}")
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+    in process counters, gauges and histograms, rendered in the prometheus
+    text format, served on a local http port or dumped to a file
+
+    updates take no lock, almost every metric of the server has a single
+    writer thread, two threads updating one may rarely lose an update, a
+    read may see a histogram between its count and its sum
+
+        curl http://127.0.0.1:9300/metrics
+"""
+import os
+import time
+import bisect
+import logging
+from typing import *
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("server")
+
+# seconds, from a datagram handled to a fan-out waiting behind a burst
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{value}"'.replace("\n", "\\n")
+        for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(object):
+    TYPE = ""
+
+    def __init__(self, name: str, help_text: str,
+                 labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels or {}
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """only goes up, or reads a count kept elsewhere with `function`"""
+    TYPE = "counter"
+
+    def __init__(self, name: str, help_text: str,
+                 labels: Optional[Dict[str, str]] = None,
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text, labels)
+        self.function = function
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        return [(self.name, self.labels, value)]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help_text: str,
+                 labels: Optional[Dict[str, str]] = None,
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        counts = list(self.counts)
+        total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append((f"{self.name}_bucket",
+                            {**self.labels, "le": _format_value(bound)},
+                            cumulative))
+        samples.append((f"{self.name}_sum", self.labels, total))
+        samples.append((f"{self.name}_count", self.labels, cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+        the metrics of one process, a name may come with several label sets,
+        all of one type
+    """
+
+    def __init__(self, prefix: str = "littlechat_"):
+        self.prefix = prefix
+        self._lock = Lock()
+        # name -> metrics with that name, in registration order
+        self._metrics: Dict[str, List[_Metric]] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            family = self._metrics.setdefault(metric.name, [])
+            if family and family[0].TYPE != metric.TYPE:
+                raise ValueError(f"metric {metric.name} is a "
+                                 f"{family[0].TYPE}, not a {metric.TYPE}")
+            family.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, function=None,
+                **labels) -> Counter:
+        return self._register(Counter(self.prefix + name, help_text, labels,
+                                      function=function))
+
+    def gauge(self, name: str, help_text: str, function=None,
+              **labels) -> Gauge:
+        return self._register(Gauge(self.prefix + name, help_text, labels,
+                                    function=function))
+
+    def histogram(self, name: str, help_text: str,
+                  buckets: Sequence[float] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help_text, labels,
+                                        buckets=buckets))
+
+    def render(self) -> str:
+        """the prometheus text exposition format, version 0.0.4"""
+        with self._lock:
+            families = [(name, list(family))
+                        for name, family in self._metrics.items()]
+        lines = []
+        for name, family in families:
+            lines.append(f"# HELP {name} {family[0].help_text}")
+            lines.append(f"# TYPE {name} {family[0].TYPE}")
+            for metric in family:
+                # noinspection PyBroadException
+                try:
+                    samples = metric.samples()
+                except Exception as exp:
+                    logger.error(f"metric {name} failed: {exp}")
+                    continue
+                for sample_name, labels, value in samples:
+                    lines.append(f"{sample_name}{_format_labels(labels)} "
+                                 f"{_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsFileDumper(object):
+    """write the registry to `path` every `interval` seconds, atomically"""
+
+    def __init__(self, registry: MetricsRegistry, path: str,
+                 interval: float, clock: Callable[[], float] = time.monotonic):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self._last_dump = float("-inf")
+
+    def dump(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as fp:
+                fp.write(self.registry.render())
+            os.replace(tmp_path, self.path)
+        except OSError as exp:
+            logger.error(f"metrics dump to {self.path} failed: {exp}")
+        self._last_dump = self.clock()
+
+    def dump_if_due(self):
+        """called periodically by the owner"""
+        if self.clock() - self._last_dump >= self.interval:
+            self.dump()
+
+
+class MetricsHttpServer(object):
+    """`GET /metrics` on a local port, in a daemon thread"""
+
+    def __init__(self, registry: MetricsRegistry, port: int,
+                 host: str = "127.0.0.1"):
+        registry_ = registry
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.addr = self.httpd.server_address
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        logger.info(f"metrics on http://{self.addr[0]}:{self.addr[1]}"
+                    f"/metrics")
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    # cost of the hot path instruments
+    registry = MetricsRegistry()
+    counter = registry.counter("datagrams_total", "datagrams")
+    histogram = registry.histogram("stage_seconds", "latency", stage="handle")
+    rounds = 200000
+    start = time.perf_counter()
+    for _ in range(rounds):
+        counter.inc()
+    counter_cost = (time.perf_counter() - start) / rounds
+    start = time.perf_counter()
+    for i in range(rounds):
+        histogram.observe(i * 1e-8)
+    histogram_cost = (time.perf_counter() - start) / rounds
+    print(f"counter inc {counter_cost * 1e9:.0f} ns, histogram observe "
+          f"{histogram_cost * 1e9:.0f} ns")
+    print(registry.render())
@@ -0,0 +1,90 @@
+"""
+    redraw time of the chat page with a long msg list, with and without the
+    canvases kept by `FrontMsgWidget`, no terminal needed
+
+        python -m littlechat.utils.util_render_bench --msgs 5000
+"""
+import time
+import random
+import argparse
+from typing import *
+
+from littlechat.stuff.msg_boxes import UserMsg
+from littlechat.front.main_page import MainPage
+from littlechat.front.front_msg import FrontMsgWidget
+
+_WORDS = ["hello", "ok", "see you", "明天见", "你好世界", "👋", "😀", "🎉",
+          "the build is green", "长消息的渲染时间", "at 10:30", "✌"]
+
+
+def _fill_page(msgs: int, seed: int = 7) -> MainPage:
+    rnd = random.Random(seed)
+    page = MainPage(username="alice")
+    for i in range(msgs):
+        username = "alice" if i % 3 else "bob"
+        text = " ".join(rnd.choice(_WORDS)
+                        for _ in range(rnd.randint(1, 40)))
+        page.show_msg(UserMsg(username, text), is_self=username == "alice")
+    return page
+
+
+def _draw(page: MainPage, size: Tuple[int, int]):
+    # the msg list box, what the screen does with its canvas
+    for _ in page.msg_list_line.render(size, focus=True).content():
+        pass
+
+
+def measure(msgs: int, size: Tuple[int, int], redraws: int,
+            cached: bool) -> Dict[str, float]:
+    """millis per redraw: idle, after a new msg, after a page up"""
+    FrontMsgWidget.CACHED_SIZES = 2 if cached else 0
+    page = _fill_page(msgs)
+    try:
+        _draw(page, size)
+        result = {}
+
+        start = time.perf_counter()
+        for _ in range(redraws):
+            _draw(page, size)
+        result["idle"] = (time.perf_counter() - start) / redraws * 1000
+
+        start = time.perf_counter()
+        for i in range(redraws):
+            page.show_msg(UserMsg("bob", f"new msg {i} 你好 😀"),
+                          is_self=False)
+            _draw(page, size)
+        result["new msg"] = (time.perf_counter() - start) / redraws * 1000
+
+        msg_list = page.msg_list
+        start = time.perf_counter()
+        for _ in range(redraws):
+            msg_list.focus_position = max(
+                page.msg_walker.first_position,
+                msg_list.focus_position - size[1] // 2)
+            _draw(page, size)
+        result["page up"] = (time.perf_counter() - start) / redraws * 1000
+        return result
+    finally:
+        page.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--msgs", default=5000, type=int)
+    parser.add_argument("--cols", default=160, type=int)
+    parser.add_argument("--rows", default=48, type=int)
+    parser.add_argument("--redraws", default=30, type=int)
+    args = parser.parse_args(argv)
+
+    size = (args.cols, args.rows)
+    print(f"{args.msgs} msgs, {args.cols}x{args.rows}, ms per redraw")
+    print(f"{'canvases':<10}{'idle':>10}{'new msg':>10}{'page up':>10}")
+    for cached in (False, True):
+        result = measure(args.msgs, size, args.redraws, cached)
+        print(f"{'kept' if cached else 'rendered':<10}"
+              f"{result['idle']:>10.2f}{result['new msg']:>10.2f}"
+              f"{result['page up']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
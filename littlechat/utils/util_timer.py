@@ -0,0 +1,101 @@
+import math
+from typing import *
+
+
+class TimingWheel(object):
+    """
+        hashed timing wheel for many timeouts of the same order, like the
+        heartbeat expiry of every online user
+
+        - `schedule` of a known key to a later deadline only updates a dict,
+          the key is moved lazily when its old slot comes up
+        - `advance` only looks at the slots passed since the last call, so it
+          costs O(expired + keys rescheduled in those slots)
+
+        all times are in seconds of the same clock, usually `time.monotonic`
+    """
+
+    def __init__(self, tick=0.1, slots=64, now=0.0):
+        if slots < 2:
+            raise ValueError(f"a timing wheel needs 2 slots at least: {slots}")
+        self.tick = tick
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._deadlines: Dict[Hashable, float] = {}
+        # absolute tick index of the slot each key is placed in
+        self._slot_of: Dict[Hashable, int] = {}
+        # the last absolute tick already processed
+        self._cursor = int(now / tick)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def get_deadline(self, key) -> Optional[float]:
+        return self._deadlines.get(key)
+
+    def _place(self, key, deadline: float):
+        n = len(self._slots)
+        at = math.ceil(deadline / self.tick)
+        at = min(max(at, self._cursor + 1), self._cursor + n - 1)
+        self._slots[at % n].add(key)
+        self._slot_of[key] = at
+
+    def _unplace(self, key):
+        at = self._slot_of.pop(key, None)
+        if at is not None:
+            self._slots[at % len(self._slots)].discard(key)
+
+    def schedule(self, key, deadline: float):
+        """(re)arm the timeout of `key`"""
+        old_deadline = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if old_deadline is None:
+            self._place(key, deadline)
+        elif deadline < old_deadline:
+            # the old slot may come too late
+            self._unplace(key)
+            self._place(key, deadline)
+
+    def cancel(self, key) -> bool:
+        if self._deadlines.pop(key, None) is None:
+            return False
+        self._unplace(key)
+        return True
+
+    def advance(self, now: float) -> List[Hashable]:
+        """pop and return the keys whose deadline <= `now`"""
+        n = len(self._slots)
+        target = int(now / self.tick)
+        if target - self._cursor > n:
+            # every key lives within one revolution
+            self._cursor = target - n
+        expired = []
+        while self._cursor < target:
+            self._cursor += 1
+            index = self._cursor % n
+            slot = self._slots[index]
+            if not slot:
+                continue
+            self._slots[index] = set()
+            for key in slot:
+                deadline = self._deadlines[key]
+                if deadline <= now:
+                    del self._deadlines[key]
+                    del self._slot_of[key]
+                    expired.append(key)
+                else:
+                    self._place(key, deadline)
+        return expired
+
+
+if __name__ == "__main__":
+    wheel = TimingWheel(tick=0.1, slots=8)
+    wheel.schedule("a", 0.25)
+    wheel.schedule("b", 2.0)
+    wheel.schedule("c", 0.35)
+    wheel.schedule("a", 1.05)
+    wheel.cancel("c")
+    for t in (0.3, 0.5, 1.0, 1.1, 2.5):
+        print(t, wheel.advance(t))
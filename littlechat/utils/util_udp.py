@@ -0,0 +1,291 @@
+"""
+    batched udp io, drain many datagrams per wakeup and flush many datagrams
+    per syscall
+
+    python's socket module does not expose `recvmmsg`/`sendmmsg`, on Linux they
+    are called through ctypes, elsewhere (or when libc can not be loaded) a
+    plain `recvfrom`/`sendto` loop is used instead
+"""
+import sys
+import errno
+import ctypes
+import ctypes.util
+import logging
+import select
+import struct
+import socket as soc
+from typing import *
+
+logger = logging.getLogger("server")
+
+MSG_DONTWAIT = 0x40
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_uint8 * 4),
+                ("sin_zero", ctypes.c_uint8 * 8)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    # noinspection PyBroadException
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_uint, ctypes.c_int]
+        libc.sendmmsg.restype = ctypes.c_int
+        return libc
+    except Exception:
+        return None
+
+
+_LIBC = _load_libc()
+
+
+_IOVEC = struct.Struct("@PN")
+_MSG_LEN = struct.Struct("@I")
+_MSG_LEN_OFFSET = _MMsgHdr.msg_len.offset
+_MMSGHDR_SIZE = ctypes.sizeof(_MMsgHdr)
+_SOCKADDR_SIZE = ctypes.sizeof(_SockAddrIn)
+_AF_INET_BYTES = struct.pack("@H", soc.AF_INET)
+_SOCKADDR_ZERO = bytes(8)
+
+
+def _inet_aton(host: str) -> bytes:
+    try:
+        return soc.inet_aton(host)
+    except OSError:
+        return soc.inet_aton(soc.gethostbyname(host))
+
+
+def mmsg_supported() -> bool:
+    return _LIBC is not None
+
+
+class BatchedUdpIO(object):
+    """
+        wraps a bound AF_INET udp socket, the socket itself stays usable for
+        plain `recvfrom`/`sendto`
+
+        the ctypes structures are allocated once and refilled with `memmove`,
+        filling them field by field would cost more than the saved syscalls
+    """
+    _ADDR_CACHE_SIZE = 65536
+
+    def __init__(self, udp_socket: soc.socket, batch_size=32,
+                 buf_size=65535, use_mmsg: Optional[bool] = None):
+        self.udp_socket = udp_socket
+        self.batch_size = batch_size
+        self.buf_size = buf_size
+        if use_mmsg is None:
+            use_mmsg = mmsg_supported()
+        self.use_mmsg = (use_mmsg and mmsg_supported()
+                         and udp_socket.family == soc.AF_INET)
+        # raw sockaddr_in <-> (ip, port)
+        self._addr_by_raw: Dict[bytes, Tuple[str, int]] = {}
+        self._raw_by_addr: Dict[Tuple[str, int], bytes] = {}
+        if self.use_mmsg:
+            self._init_recv_vectors()
+            self._init_send_vectors()
+
+    @staticmethod
+    def _new_vectors(n):
+        iovs = (_IoVec * n)()
+        names = (_SockAddrIn * n)()
+        hdrs = (_MMsgHdr * n)()
+        for i in range(n):
+            hdr = hdrs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(names[i])
+            hdr.msg_namelen = _SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(iovs[i])
+            hdr.msg_iovlen = 1
+        return iovs, names, hdrs
+
+    def _init_recv_vectors(self):
+        n = self.batch_size
+        self._recv_iovs, self._recv_names, self._recv_hdrs = \
+            self._new_vectors(n)
+        self._recv_bufs = [ctypes.create_string_buffer(self.buf_size)
+                           for _ in range(n)]
+        self._recv_buf_addrs = [ctypes.addressof(buf)
+                                for buf in self._recv_bufs]
+        for i in range(n):
+            self._recv_iovs[i].iov_base = self._recv_buf_addrs[i]
+            self._recv_iovs[i].iov_len = self.buf_size
+        # the kernel overwrites msg_namelen, restore it before every call
+        self._recv_hdrs_template = bytes(self._recv_hdrs)
+
+    def _init_send_vectors(self):
+        self._send_iovs, self._send_names, self._send_hdrs = \
+            self._new_vectors(self.batch_size)
+
+    def _cache_addr(self, raw: bytes, addr: Tuple[str, int]):
+        if len(self._addr_by_raw) >= self._ADDR_CACHE_SIZE:
+            self._addr_by_raw.clear()
+            self._raw_by_addr.clear()
+        self._addr_by_raw[raw] = addr
+        self._raw_by_addr[addr] = raw
+
+    def _addr_from_raw(self, raw: bytes) -> Tuple[str, int]:
+        addr = self._addr_by_raw.get(raw)
+        if addr is None:
+            addr = (soc.inet_ntoa(raw[4:8]),
+                    int.from_bytes(raw[2:4], "big"))
+            self._cache_addr(raw, addr)
+        return addr
+
+    def _raw_from_addr(self, addr: Tuple[str, int]) -> bytes:
+        raw = self._raw_by_addr.get(addr)
+        if raw is None:
+            raw = (_AF_INET_BYTES + addr[1].to_bytes(2, "big")
+                   + _inet_aton(addr[0]) + _SOCKADDR_ZERO)
+            self._cache_addr(raw, addr)
+        return raw
+
+    def wait_readable(self, timeout: Optional[float]) -> bool:
+        readable, _, _ = select.select([self.udp_socket], [], [], timeout)
+        return bool(readable)
+
+    def recv_batch(self, timeout: Optional[float] = 0.5
+                   ) -> List[Tuple[bytes, Tuple[str, int]]]:
+        """
+            wait at most `timeout` for the first datagram, then take everything
+            already queued in the kernel, up to `batch_size`
+        """
+        if not self.wait_readable(timeout):
+            return []
+        if self.use_mmsg:
+            return self._recv_mmsg()
+        return self._recv_loop()
+
+    def _recv_mmsg(self):
+        n = self.batch_size
+        hdrs_addr = ctypes.addressof(self._recv_hdrs)
+        ctypes.memmove(hdrs_addr, self._recv_hdrs_template,
+                       len(self._recv_hdrs_template))
+        got = _LIBC.recvmmsg(self.udp_socket.fileno(), hdrs_addr, n,
+                             MSG_DONTWAIT, None)
+        if got < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, f"recvmmsg: {errno.errorcode.get(err, err)}")
+
+        raw_hdrs = ctypes.string_at(hdrs_addr, got * _MMSGHDR_SIZE)
+        raw_names = ctypes.string_at(ctypes.addressof(self._recv_names),
+                                     got * _SOCKADDR_SIZE)
+        datagrams = []
+        for i in range(got):
+            (length,) = _MSG_LEN.unpack_from(
+                raw_hdrs, i * _MMSGHDR_SIZE + _MSG_LEN_OFFSET)
+            raw_name = raw_names[i * _SOCKADDR_SIZE:(i + 1) * _SOCKADDR_SIZE]
+            datagrams.append((ctypes.string_at(self._recv_buf_addrs[i], length),
+                              self._addr_from_raw(raw_name)))
+        return datagrams
+
+    def _recv_loop(self):
+        datagrams = []
+        while len(datagrams) < self.batch_size:
+            try:
+                datagrams.append(
+                    self.udp_socket.recvfrom(self.buf_size, MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
+                break
+        return datagrams
+
+    def send_batch(self, datagrams: Sequence[Tuple[bytes, Tuple[str, int]]]
+                   ) -> int:
+        """send all `datagrams`, return the number of syscalls used"""
+        if not datagrams:
+            return 0
+        if not self.use_mmsg:
+            for payload, addr in datagrams:
+                self._send_one(payload, addr)
+            return len(datagrams)
+
+        syscalls = 0
+        for start in range(0, len(datagrams), self.batch_size):
+            syscalls += self._send_mmsg(
+                datagrams[start:start + self.batch_size])
+        return syscalls
+
+    def _send_one(self, payload, addr):
+        try:
+            self.udp_socket.sendto(payload, addr)
+        except OSError as exp:
+            logger.error(f"send to {addr} failed: {exp}")
+
+    def _send_mmsg(self, datagrams) -> int:
+        raw_iovs = []
+        raw_names = []
+        valid = []
+        # fan-out shares one payload between many datagrams
+        payload_addrs = {}
+        for payload, addr in datagrams:
+            try:
+                raw_name = self._raw_from_addr(addr)
+            except (OSError, OverflowError, TypeError) as exp:
+                logger.error(f"invalid addr {addr}: {exp}")
+                continue
+            payload_addr = payload_addrs.get(id(payload))
+            if payload_addr is None:
+                payload_addr = ctypes.cast(payload, ctypes.c_void_p).value
+                payload_addrs[id(payload)] = payload_addr
+            raw_iovs.append(_IOVEC.pack(payload_addr, len(payload)))
+            raw_names.append(raw_name)
+            valid.append((payload, addr))
+        n = len(valid)
+        if not n:
+            return 0
+
+        raw_iovs = b"".join(raw_iovs)
+        raw_names = b"".join(raw_names)
+        ctypes.memmove(ctypes.addressof(self._send_iovs), raw_iovs,
+                       len(raw_iovs))
+        ctypes.memmove(ctypes.addressof(self._send_names), raw_names,
+                       len(raw_names))
+
+        syscalls = 0
+        sent = 0
+        fd = self.udp_socket.fileno()
+        hdrs_addr = ctypes.addressof(self._send_hdrs)
+        while sent < n:
+            got = _LIBC.sendmmsg(fd, hdrs_addr + sent * _MMSGHDR_SIZE,
+                                 n - sent, 0)
+            syscalls += 1
+            if got > 0:
+                sent += got
+                continue
+            # the failing datagram goes alone through sendto, which reports
+            # the error, then the batch continues behind it
+            payload, addr = valid[sent]
+            self._send_one(payload, addr)
+            sent += 1
+        return syscalls
@@ -0,0 +1,201 @@
+import sys
+import json
+import shutil
+import signal
+import logging
+import tempfile
+import socket as soc
+import multiprocessing as mp
+
+from littlechat.server import Server
+from littlechat.async_server import AsyncServer
+from littlechat.stuff.msg_boxes import *
+from littlechat.stuff.config import MsgConfig
+from littlechat.stuff.history import MessageLog
+from littlechat.stuff.presence import PresenceRecord
+from littlechat.utils.util_bus import LocalBus
+from littlechat.utils.util_log import share_scripts_logging
+from littlechat.utils.util_thread import new_thread
+
+logger = logging.getLogger("server")
+
+
+class _WorkerMixin(object):
+    """
+        one of the processes bound to the same port with SO_REUSEPORT, the
+        kernel hashes every client to one worker, which owns its presence:
+        heartbeats, expiry and the join/leave announcements
+
+        every worker mirrors the users and room members of the others through
+        a `LocalBus`, so any worker fans out to all users, the presence and
+        room versions come from a counter shared by all workers
+    """
+
+    def __init__(self, port, worker: int, workers: int, bus_dir: str,
+                 shared_version, **server_kwargs):
+        self.worker = worker
+        self._shared_version = shared_version
+        super().__init__(port=port, **server_kwargs)
+        self.presence.next_version = self._next_presence_version
+        self.bus = LocalBus(bus_dir, worker, workers)
+
+    def _new_socket(self) -> soc.socket:
+        udp_socket = soc.socket(soc.AF_INET, soc.SOCK_DGRAM)
+        udp_socket.setsockopt(soc.SOL_SOCKET, soc.SO_REUSEPORT, 1)
+        udp_socket.bind(self.local_addr)
+        return udp_socket
+
+    def _new_history(self) -> Optional[MessageLog]:
+        # the workers share the port, not a single writer of one log
+        return None
+
+    def _metrics_name(self) -> str:
+        return f"{self.port}-worker{self.worker}"
+
+    def _metrics_port(self) -> int:
+        # one endpoint per worker, on the ports after the configured one
+        return MsgConfig.METRICS_PORT + self.worker
+
+    def _next_presence_version(self) -> int:
+        with self._shared_version.get_lock():
+            self._shared_version.value += 1
+            return self._shared_version.value
+
+    def _on_presence_change(self, version: int, joined: List[PresenceRecord],
+                            left: List[PresenceRecord]):
+        super()._on_presence_change(version, joined, left)
+        self._publish_event({
+            "type": "presence",
+            "version": version,
+            "joined": [[r.username, *r.addr, r.addr in self._legacy_addrs]
+                       for r in joined],
+            "left": [[r.username, *r.addr] for r in left],
+        })
+
+    def _on_room_change(self, room: str, base_version: int, version: int,
+                        joined: List[PresenceRecord],
+                        left: List[PresenceRecord]):
+        super()._on_room_change(room, base_version, version, joined, left)
+        self._publish_event({
+            "type": "room",
+            "room": room,
+            "version": version,
+            "joined": [record.username for record in joined],
+            "left": [record.username for record in left],
+        })
+
+    def negotiate_compression(self, new_user: NewUser, rsp_msg: NewUser):
+        super().negotiate_compression(new_user, rsp_msg)
+        if rsp_msg.compression:
+            self._publish_event({"type": "compression",
+                                 "addr": list(new_user.get_addr()),
+                                 "name": rsp_msg.compression[0]})
+
+    def negotiate_tracing(self, new_user: NewUser, rsp_msg: NewUser):
+        super().negotiate_tracing(new_user, rsp_msg)
+        if rsp_msg.traces:
+            self._publish_event({"type": "traces",
+                                 "addr": list(new_user.get_addr())})
+
+    def _publish_event(self, event: dict):
+        self.bus.publish(json.dumps(event).encode())
+
+    def apply_event(self, event: dict):
+        if event["type"] == "compression":
+            self._compression_of[tuple(event["addr"])] = event["name"]
+            return
+        if event["type"] == "traces":
+            self._traced_addrs.add(tuple(event["addr"]))
+            return
+        if event["type"] == "room":
+            self.presence.apply_remote_room(event["room"], event["version"],
+                                            event["joined"], event["left"])
+            return
+        now = self.presence.clock()
+        joined = []
+        for username, ip, port, legacy in event["joined"]:
+            joined.append(PresenceRecord(username, (ip, port), now, 0,
+                                         self.presence.expire_seconds))
+            if legacy:
+                self._legacy_addrs.add((ip, port))
+        left = [PresenceRecord(username, (ip, port), now, 0, 0)
+                for username, ip, port in event["left"]]
+        for record in left:
+            self._compression_of.pop(record.addr, None)
+            self._traced_addrs.discard(record.addr)
+        self.presence.apply_remote(event["version"], joined, left)
+
+    @new_thread
+    def bus_receiving(self):
+        while not self.is_close:
+            # noinspection PyBroadException
+            try:
+                payload = self.bus.recv(timeout=0.5)
+                if payload is not None:
+                    self.apply_event(json.loads(payload))
+            except Exception as exp:
+                if self.is_close:
+                    return
+                logger.error(f"worker {self.worker} bus error: {exp}")
+
+    def serve(self):
+        logger.info(f"worker {self.worker} started")
+        self.bus_receiving()
+        super().serve()
+
+    def close(self):
+        super().close()
+        self.bus.close()
+
+
+class WorkerServer(_WorkerMixin, Server):
+    pass
+
+
+class AsyncWorkerServer(_WorkerMixin, AsyncServer):
+    pass
+
+
+def _run_worker(port, worker, workers, bus_dir, shared_version, engine,
+                batch_io):
+    # forked with the handler of the parent
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    worker_class = AsyncWorkerServer if engine == "async" else WorkerServer
+    worker_class(port, worker, workers, bus_dir, shared_version,
+                 batch_io=batch_io).serve()
+
+
+def serve_workers(port, workers: int, engine="thread", batch_io=False):
+    """run `workers` server processes on `port`, Linux only"""
+    if not hasattr(soc, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not supported on this platform")
+    if engine not in ("thread", "async"):
+        raise ValueError(f"unknown server engine: {engine}, "
+                         f"choose from ['thread', 'async']")
+    # one writer of the log file for all the workers
+    share_scripts_logging(logger)
+    bus_dir = tempfile.mkdtemp(prefix="littlechat-bus-")
+    shared_version = mp.Value("q", 0)
+    processes = [mp.Process(target=_run_worker,
+                            args=(port, worker, workers, bus_dir,
+                                  shared_version, engine, batch_io),
+                            daemon=True)
+                 for worker in range(workers)]
+    logger.info(f"-----{workers} {engine} workers on port {port}---------")
+    # a service manager stops the parent only, the workers go down with it
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.pid is None:
+                continue
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(bus_dir, ignore_errors=True)
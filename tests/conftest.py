@@ -0,0 +1,40 @@
+import os
+import socket
+import tempfile
+import threading
+
+import pytest
+
+# before littlechat is imported, it keeps its files under ~/.littlechat
+os.environ["HOME"] = tempfile.mkdtemp(prefix="littlechat-tests-")
+
+from littlechat.server import get_server_class  # noqa: E402
+from littlechat.stuff.config import MsgConfig  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+        udp_socket.bind(("127.0.0.1", 0))
+        return udp_socket.getsockname()[1]
+
+
+@pytest.fixture
+def config(monkeypatch):
+    """`MsgConfig` as a test sets it, restored afterwards"""
+    monkeypatch.setattr(MsgConfig, "HISTORY", False)
+    monkeypatch.setattr(MsgConfig, "METRICS_PORT", 0)
+    return MsgConfig
+
+
+@pytest.fixture(params=["thread", "async"])
+def server(request, config):
+    """a server of each engine serving on a free port"""
+    srv = get_server_class(request.param)(port=free_port())
+    thread = threading.Thread(target=srv.serve, daemon=True)
+    thread.start()
+    yield srv
+    if request.param == "async":
+        srv.loop.call_soon_threadsafe(srv.close)
+    else:
+        srv.close()
+    thread.join(timeout=2)
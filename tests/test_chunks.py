@@ -0,0 +1,78 @@
+import random
+
+from littlechat.stuff.chunks import ChunkSplitter, ChunkAssembler
+from littlechat.stuff.msg_boxes import BinaryCodec, UserMsg
+
+CHUNK_SIZE = 100
+
+
+def _chunks(payload: bytes, splitter: ChunkSplitter):
+    codec = BinaryCodec()
+    # every chunk travels encoded
+    return [codec.decode(codec.encode(chunk))
+            for chunk in splitter.split(payload, UserMsg.WIRE_TAG,
+                                        room="dev")]
+
+
+def test_reassembly_out_of_order_with_duplicates():
+    payload = BinaryCodec().encode(UserMsg("alice", "x" * 1000, room="dev"))
+    chunks = _chunks(payload, ChunkSplitter("alice", CHUNK_SIZE))
+    assert len(chunks) == -(-len(payload) // CHUNK_SIZE)
+    assert {chunk.room for chunk in chunks} == {"dev"}
+    received = chunks + chunks[:3]
+    random.Random(3).shuffle(received)
+    assembler = ChunkAssembler(chunk_size=CHUNK_SIZE)
+    results = [assembler.add(("alice", chunk.msg_id), chunk)
+               for chunk in received]
+    completed = [result for result in results if result is not None]
+    assert completed == [payload]
+    assert len(assembler) == 0
+
+
+def test_single_chunk():
+    payload = b"short"
+    chunk, = _chunks(payload, ChunkSplitter("alice", CHUNK_SIZE))
+    assert ChunkAssembler(chunk_size=CHUNK_SIZE).add(
+        ("alice", chunk.msg_id), chunk) == payload
+
+
+def test_interleaved_msgs():
+    splitter = ChunkSplitter("alice", CHUNK_SIZE)
+    first, second = b"1" * 350, b"2" * 350
+    assembler = ChunkAssembler(chunk_size=CHUNK_SIZE)
+    completed = []
+    for pair in zip(_chunks(first, splitter), _chunks(second, splitter)):
+        for chunk in pair:
+            result = assembler.add(("alice", chunk.msg_id), chunk)
+            if result is not None:
+                completed.append(result)
+    assert completed == [first, second]
+
+
+def test_expiry():
+    now = [0.0]
+    assembler = ChunkAssembler(timeout=5, chunk_size=CHUNK_SIZE,
+                               clock=lambda: now[0])
+    chunks = _chunks(b"x" * 300, ChunkSplitter("alice", CHUNK_SIZE))
+    for chunk in chunks[:-1]:
+        assert assembler.add(("alice", chunk.msg_id), chunk) is None
+    now[0] = 6
+    assert assembler.expire() == 1
+    assert assembler.dropped == 1
+    assert assembler.add(("alice", chunks[-1].msg_id), chunks[-1]) is None
+
+
+def test_bounds():
+    assembler = ChunkAssembler(max_bytes=350, max_msg_bytes=1000,
+                               chunk_size=CHUNK_SIZE)
+    splitter = ChunkSplitter("alice", CHUNK_SIZE)
+    chunk = _chunks(b"x" * 2000, splitter)[0]
+    assert assembler.add(("alice", chunk.msg_id), chunk) is None
+    assert len(assembler) == 0
+    # the oldest msg makes room for the newer one
+    old, new = _chunks(b"o" * 300, splitter), _chunks(b"n" * 300, splitter)
+    for chunk in old[:2] + new[:2]:
+        assembler.add(("alice", chunk.msg_id), chunk)
+    assert assembler.buffered_bytes <= 350
+    assert len(assembler) == 1
+    assert assembler.add(("alice", new[2].msg_id), new[2]) == b"n" * 300
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from littlechat.stuff.compression import *
+from littlechat.stuff.compression import zstandard
+from littlechat.stuff.errors import MsgDecodeError
+from littlechat.stuff.msg_boxes import BinaryCodec, UserMsg, UserDict
+
+_DICT_IDS = [NO_DICT, CHAT_DICT, CHAT_DICT_ROOMS]
+_NAMES = [
+    "zlib",
+    pytest.param("zstd", marks=pytest.mark.skipif(
+        zstandard is None, reason="zstandard is not installed")),
+]
+
+
+def _payloads():
+    codec = BinaryCodec()
+    return [codec.encode(UserMsg("alice", "hello everyone " * 20)),
+            codec.encode(UserDict(dict.fromkeys(
+                f"user{i}" for i in range(50))))]
+
+
+@pytest.mark.parametrize("dict_id", _DICT_IDS)
+@pytest.mark.parametrize("name", _NAMES)
+def test_round_trip(name, dict_id):
+    sender = PayloadCompressor(threshold=0, dict_id=dict_id)
+    receiver = PayloadCompressor()
+    for payload in _payloads():
+        packed = sender.pack(payload, name)
+        assert is_compressed_payload(packed)
+        assert len(packed) < len(payload)
+        assert receiver.unpack(packed) == payload
+
+
+@pytest.mark.parametrize("name", _NAMES)
+def test_sent_as_is(name):
+    compressor = PayloadCompressor(threshold=64)
+    short = BinaryCodec().encode(UserMsg("alice", "hi"))
+    assert compressor.pack(short, name) == short
+    # incompressible, the frame would only add bytes
+    noise = os.urandom(512)
+    assert compressor.pack(noise, name) == noise
+    assert compressor.unpack(short) == short
+
+
+def test_not_negotiated():
+    payload = _payloads()[0]
+    assert PayloadCompressor(threshold=0).pack(payload, "") == payload
+
+
+def test_choose():
+    compressor = PayloadCompressor()
+    assert compressor.choose(["brotli", "zlib"]) == "zlib"
+    assert compressor.choose(["brotli"]) == ""
+    assert compressor.choose(available_compressors()) == (
+        "zstd" if zstandard is not None else "zlib")
+
+
+@pytest.mark.parametrize("name", _NAMES)
+def test_too_large(name):
+    payload = b"x" * 10000
+    packed = PayloadCompressor(threshold=0).pack(payload, name)
+    with pytest.raises(MsgDecodeError):
+        PayloadCompressor(max_size=1000).unpack(packed)
+
+
+def test_invalid_frame():
+    packed = PayloadCompressor(threshold=0).pack(_payloads()[0], "zlib")
+    with pytest.raises(MsgDecodeError):
+        PayloadCompressor().unpack(packed[:-8])
+    # unknown dictionary
+    with pytest.raises(MsgDecodeError):
+        PayloadCompressor().unpack(packed[:3] + b"\x09" + packed[4:])
+    # unknown algorithm
+    with pytest.raises(MsgDecodeError):
+        PayloadCompressor().unpack(packed[:2] + b"\x09" + packed[3:])
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from littlechat.stuff.history import MessageLog, FSYNC_POLICIES
+
+
+def _payload(seq: int) -> bytes:
+    return f"msg {seq}".encode() * (seq % 5 + 1)
+
+
+@pytest.mark.parametrize("fsync", FSYNC_POLICIES)
+def test_append_and_read(tmp_path, fsync):
+    log = MessageLog(str(tmp_path), fsync=fsync)
+    seqs = [log.append(_payload(seq)) for seq in range(1, 101)]
+    assert seqs == list(range(1, 101))
+    assert len(log) == 100
+    assert log.read(42) == _payload(42)
+    assert log.read(0) is None
+    assert log.read(101) is None
+    assert log.read_range(95, 10) == [(seq, _payload(seq))
+                                      for seq in range(95, 101)]
+    log.close()
+
+
+def test_segments_and_reopen(tmp_path):
+    log = MessageLog(str(tmp_path), fsync="off", segment_bytes=256)
+    for seq in range(1, 201):
+        log.append(_payload(seq))
+    assert len([name for name in os.listdir(tmp_path)
+                if name.endswith(".log")]) > 1
+    # a range across several segments
+    assert log.read_range(1, 200) == [(seq, _payload(seq))
+                                      for seq in range(1, 201)]
+    log.close()
+
+    log = MessageLog(str(tmp_path), fsync="off", segment_bytes=256)
+    assert (log.first_seq, log.next_seq) == (1, 201)
+    assert log.read(150) == _payload(150)
+    assert log.append(b"after") == 201
+    assert log.read_range(200, 5) == [(200, _payload(200)), (201, b"after")]
+    log.close()
+
+
+def test_retention(tmp_path):
+    log = MessageLog(str(tmp_path), fsync="off", segment_bytes=256,
+                     retention_bytes=1024)
+    for seq in range(1, 501):
+        log.append(_payload(seq))
+    assert log.size <= 1024 + 256
+    assert log.first_seq > 1
+    # the seqs never repeat, the dropped ones read as nothing
+    assert log.read(1) is None
+    assert log.read_range(1, 3) == [(seq, _payload(seq)) for seq in
+                                    range(log.first_seq, log.first_seq + 3)]
+    assert log.next_seq == 501
+    log.close()
+
+
+def test_unknown_fsync_policy(tmp_path):
+    with pytest.raises(ValueError):
+        MessageLog(str(tmp_path), fsync="never")
@@ -0,0 +1,116 @@
+import pytest
+
+from littlechat.stuff.errors import MsgDecodeError
+from littlechat.stuff.msg_boxes import *
+from littlechat.stuff.msg_boxes import _WIRE_TYPES
+from littlechat.stuff.tracing import Trace, STAGE_INPUT, STAGE_CLIENT_SEND
+
+# the fields the receiver fills itself
+_LOCAL_FIELDS = ("ip", "port", "is_self", "user_heartbeat_time", "msg_time",
+                 "trace")
+
+
+def _samples():
+    new_user = NewUser("alice", heartbeat_interval=1.5,
+                       compression=["zstd", "zlib"], reliable=True,
+                       traces=True)
+    new_user.expire_seconds = 4.5
+    return [
+        MsgBox("alice", "hi"),
+        ServerMsg("server says"),
+        ExceptionMsg("went wrong"),
+        DuplicatUser(),
+        UserDict(dict.fromkeys(["alice", "bob"])),
+        TimeStamp("2022-01-01 00:00"),
+        UserComeLeave("somebody came"),
+        UserOnlineServer("alice"),
+        UserOfflineServer("bob"),
+        PresenceSnapshot(7, ["alice", "bob"], room="dev"),
+        PresenceDelta(8, ["carol"], ["bob"], room="dev"),
+        ClientMsg("alice", "raw"),
+        UserHeartbeat("alice", heartbeat_interval=1.5),
+        UserHeartbeat("alice", heartbeat_interval=1.5, room="dev"),
+        ConCheck(),
+        new_user,
+        NewUser("bob"),
+        UserOffline("alice"),
+        UserMsg("alice", "这是一条测试消息 😊"),
+        UserMsg("alice", "hi dev", room="dev"),
+        PresenceResync("alice", room="dev"),
+        MsgChunk("alice", 3, 1, 4, UserMsg.WIRE_TAG, b"\x00\xff" * 10,
+                 room="dev"),
+        JoinRoom("alice", "dev"),
+        LeaveRoom("alice", "dev"),
+        HistoryRequest("alice", 12, 50, latest=True),
+        HistoryBatch([(12, b"first"), (13, b"")], 13, 20, done=True),
+    ]
+
+
+def _fields(msg: MsgBox) -> dict:
+    return {name: value for name, value in vars(msg).items()
+            if name not in _LOCAL_FIELDS}
+
+
+def test_samples_cover_every_wire_type():
+    assert ({type(sample) for sample in _samples()}
+            == set(_WIRE_TYPES.values()))
+
+
+@pytest.mark.parametrize("sample", _samples(),
+                         ids=lambda sample: type(sample).__name__)
+@pytest.mark.parametrize("codec", [BinaryCodec(), PickleCodec()],
+                         ids=lambda codec: codec.name)
+def test_round_trip(codec, sample):
+    decoded = codec.decode(codec.encode(sample))
+    assert type(decoded) is type(sample)
+    assert _fields(decoded) == _fields(sample)
+    assert (int(decoded.msg_time.timestamp() * 1000)
+            == int(sample.msg_time.timestamp() * 1000))
+
+
+def test_round_trip_of_a_trace():
+    msg = UserMsg("alice", "traced")
+    msg.trace = Trace(42, [(STAGE_INPUT, 10), (STAGE_CLIENT_SEND, 300)])
+    decoded = BinaryCodec().decode(BinaryCodec().encode(msg))
+    assert decoded.trace.trace_id == 42
+    assert decoded.trace.stamps == msg.trace.stamps
+    # a peer without traces gets the msg without it
+    untraced = BinaryCodec(traces=False)
+    assert untraced.decode(untraced.encode(msg)).trace is None
+
+
+@pytest.mark.parametrize("sample", _samples(),
+                         ids=lambda sample: type(sample).__name__)
+def test_pickle_compat_on(sample):
+    payload = PickleCodec().encode(sample)
+    assert is_legacy_payload(payload)
+    decoded = BinaryCodec(pickle_compat=True).decode(payload)
+    assert _fields(decoded) == _fields(sample)
+
+
+def test_pickle_compat_off():
+    payload = PickleCodec().encode(UserMsg("alice", "hi"))
+    with pytest.raises(MsgDecodeError):
+        BinaryCodec(pickle_compat=False).decode(payload)
+
+
+def test_pickle_compat_follows_the_config(config, monkeypatch):
+    payload = PickleCodec().encode(UserMsg("alice", "hi"))
+    with pytest.raises(MsgDecodeError):
+        get_codec("binary").decode(payload)
+    monkeypatch.setattr(config, "PICKLE_COMPAT", True)
+    assert get_codec("binary").decode(payload).msg == "hi"
+
+
+@pytest.mark.parametrize("payload", [
+    b"", b"\x01", PING_PAYLOAD, b"\x09" + bytes(10), b"\x01\xfe" + bytes(9)])
+def test_invalid_payload(payload):
+    with pytest.raises(MsgDecodeError):
+        BinaryCodec().decode(payload)
+
+
+def test_truncated_payload():
+    payload = BinaryCodec().encode(UserMsg("alice", "hello there"))
+    for end in range(len(payload)):
+        with pytest.raises(MsgDecodeError):
+            BinaryCodec().decode(payload[:end])
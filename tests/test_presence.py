@@ -0,0 +1,70 @@
+from littlechat.stuff.presence import PresenceRegistry
+from littlechat.stuff.rooms import DEFAULT_ROOM
+
+ALICE = ("127.0.0.1", 5001)
+BOB = ("127.0.0.1", 5002)
+
+
+def _registry(now, **kwargs) -> PresenceRegistry:
+    return PresenceRegistry(expire_seconds=3, clock=lambda: now[0], **kwargs)
+
+
+def test_expiry():
+    now = [0.0]
+    changes = []
+    presence = _registry(now, on_change=lambda version, joined, left:
+                         changes.append((version, joined, left)))
+    presence.add("alice", ALICE)
+    presence.add("bob", BOB)
+    now[0] = 2.0
+    # any datagram keeps bob alive
+    presence.touch_addr(BOB)
+    now[0] = 3.5
+    assert [record.username for record in presence.expire()] == ["alice"]
+    assert "alice" not in presence
+    assert presence.get_by_addr(ALICE) is None
+    assert presence.usernames() == ["bob"]
+    now[0] = 5.5
+    assert [record.username for record in presence.expire()] == ["bob"]
+    assert len(presence) == 0
+    assert presence.expire() == []
+    assert [(version, [r.username for r in left])
+            for version, joined, left in changes][2:] == [(3, ["alice"]),
+                                                          (4, ["bob"])]
+
+
+def test_expiry_leaves_the_rooms():
+    now = [0.0]
+    presence = _registry(now)
+    presence.add("alice", ALICE)
+    assert presence.join_room("alice", "dev")
+    assert "alice" in presence.rooms.get_members("dev")
+    now[0] = 3.5
+    presence.expire()
+    assert "alice" not in presence.rooms.get_members("dev")
+    assert "alice" not in presence.rooms.get_members(DEFAULT_ROOM)
+
+
+def test_negotiated_expiry():
+    now = [0.0]
+    presence = _registry(now)
+    presence.add("alice", ALICE, expire_seconds=10)
+    presence.add("bob", BOB)
+    now[0] = 3.5
+    assert [record.username for record in presence.expire()] == ["bob"]
+    now[0] = 10.5
+    assert [record.username for record in presence.expire()] == ["alice"]
+
+
+def test_heartbeat_registers_an_expired_user_again():
+    now = [0.0]
+    presence = _registry(now)
+    presence.add("alice", ALICE)
+    now[0] = 2.0
+    assert not presence.refresh("alice", ALICE)
+    now[0] = 4.0
+    assert presence.expire() == []
+    now[0] = 5.5
+    assert len(presence.expire()) == 1
+    assert presence.refresh("alice", ALICE)
+    assert presence.get("alice").addr == ALICE
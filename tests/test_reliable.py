@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+from littlechat.client import Client
+from littlechat.stuff.chunks import ChunkSplitter
+from littlechat.stuff.msg_boxes import UserMsg
+from littlechat.stuff.reliable import ReliableChannel
+from littlechat.utils.util_lossy_proxy import LossyProxy
+
+MSGS = 50
+
+
+class _Page(object):
+    """the part of `MainPage` the client uses, keeps the msgs shown"""
+
+    def __init__(self):
+        self.shown = []
+
+    def show_msg(self, msg_box, is_self=True):
+        if isinstance(msg_box, UserMsg):
+            self.shown.append(msg_box.msg)
+
+    def show_history(self, msg_boxes):
+        pass
+
+    def switch_room(self, room):
+        pass
+
+
+def _login(port: int, username: str) -> Client:
+    """`Client.login` and `Client.contact` without the terminal"""
+    client = Client("127.0.0.1", port)
+    client.flush_page_draw = lambda: None
+    client.sending_msg_proxy()
+    client.send_msg(client.new_user_msg(username), direct=True)
+    client.apply_login(client.recv_server_msg(timeout=2))
+    assert client.reliable is not None
+    client.username = username
+    client._chunk_splitter = ChunkSplitter(username)
+    client.front_main_page = _Page()
+    client.receiving_server_msg()
+    client.keep_sending_heartbeat()
+    client.keep_reliable()
+    return client
+
+
+def _wait_for(check, timeout=10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.05)
+    return check()
+
+
+def _exchange(sender: Client, receiver: Client, prefix: str):
+    expected = [f"{prefix}{i}" for i in range(MSGS)]
+    for msg in expected:
+        sender.send_user_msg(msg)
+        time.sleep(0.003)
+    _wait_for(lambda: len(receiver.front_main_page.shown) >= MSGS)
+    # the retransmissions that are still late must not show up twice
+    time.sleep(0.5)
+    assert receiver.front_main_page.shown == expected
+    receiver.front_main_page.shown.clear()
+
+
+@pytest.fixture
+def proxy(server):
+    proxy = LossyProxy(("127.0.0.1", server.port), delay=0.002, seed=3)
+    proxy.start()
+    yield proxy
+    proxy.close()
+
+
+@pytest.fixture
+def clients(config, server, proxy, monkeypatch):
+    monkeypatch.setattr(config, "RELIABLE", True)
+    monkeypatch.setattr(config, "RATE_LIMIT", False)
+    logged_in = [_login(proxy.addr[1], "alice"), _login(proxy.addr[1], "bob")]
+    yield logged_in
+    for client in logged_in:
+        # `Client.close` stops the terminal page as well
+        client.is_closed = True
+        client.udp_socket.close()
+
+
+def test_in_order_without_duplicates_under_loss(proxy, clients):
+    alice, bob = clients
+    proxy.loss = 0.2
+    proxy.reorder = 0.2
+    _exchange(alice, bob, "m")
+    _exchange(bob, alice, "r")
+    assert proxy.dropped and proxy.reordered
+
+
+def test_login_again_after_the_server_forgot(server, proxy, clients):
+    alice, bob = clients
+    old_channel = bob.reliable
+    server.presence.remove("bob")
+    # the next ack of bob is answered by a pong, bob logs in again
+    assert _wait_for(lambda: bob.reliable not in (None, old_channel)
+                     and server.presence.get("bob") is not None)
+    assert isinstance(bob.reliable, ReliableChannel)
+    proxy.loss = 0.2
+    proxy.reorder = 0.2
+    _exchange(bob, alice, "r")
+    _exchange(alice, bob, "m")